@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 """
-Parse seed generation output and add variables to version JSON files.
+Parse seed generation output and record each seed's variables in
+extracted_text/variables.json.
 
 Expects input file with blocks like:
 *** makeBook 90000 ****************************
 Reading manifest...
 ...
 vars: ['alcohol', 'alliteration', ...]
+
+or a .json seed -> variables table from variableoracle.py, which works the
+variables out without rendering any books, or a .jsonl event log written by
+collapser.py --log.
 """
 
 import json
@@ -16,6 +21,7 @@ from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent
 EXTRACTED_DIR = BASE_DIR / "extracted_text"
+VARIABLES_PATH = EXTRACTED_DIR / "variables.json"
 
 
 def parse_generation_log(log_path):
@@ -51,60 +57,88 @@ def parse_generation_log(log_path):
     return seed_vars
 
 
-def update_version_files(seed_vars):
-    """Update individual version JSON files with variables."""
+def parse_event_log(log_path):
+    """Stream a collapser.py --log event log and extract seed -> variables mapping.
 
-    updated = 0
-    for seed_id, variables in seed_vars.items():
-        version_file = EXTRACTED_DIR / f"version_{seed_id}.json"
+    Only books made from a seed are kept. Longest, shortest and author books
+    log seed -1, so events whose strategy isn't random, or whose seed is
+    negative, are skipped (parse_generation_log skips them too, as it only matches
+    numeric seeds).
+    """
+
+    seed_vars = {}
+
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"  Warning: Could not parse line {line_number}: {e}")
+                continue
 
-        if not version_file.exists():
-            print(f"  Warning: No version file for seed {seed_id}")
-            continue
+            if event.get('event') == 'variables' and 'seed' in event:
+                if event['seed'] < 0 or event.get('strategy', 'random') != 'random':
+                    continue
+                seed_vars[str(event['seed'])] = sorted(event['variables'])
+            elif event.get('event') == 'error':
+                print(f"  Note: seed {event.get('seed')} logged an error: {event.get('message')}")
 
-        with open(version_file, 'r', encoding='utf-8') as f:
-            version_data = json.load(f)
+    for seed_id, variables in seed_vars.items():
+        print(f"  Seed {seed_id}: {len(variables)} variables")
 
-        version_data['variables'] = variables
+    return seed_vars
 
-        with open(version_file, 'w', encoding='utf-8') as f:
-            json.dump(version_data, f, indent=2, ensure_ascii=False)
 
-        updated += 1
+def parse_variable_table(table_path):
+    """Load a seed -> variables table written by variableoracle.py."""
 
-    return updated
+    with open(table_path, 'r', encoding='utf-8') as f:
+        table = json.load(f)
 
+    return {str(seed): sorted(variables) for seed, variables in table.items()}
 
-def update_combined_file(seed_vars):
-    """Update the combined all_versions.json file with variables."""
 
-    combined_file = EXTRACTED_DIR / "all_versions.json"
+def update_variables_file(seed_vars):
+    """Merge seed -> variables into the variables.json sidecar.
 
-    if not combined_file.exists():
-        print("  Warning: all_versions.json not found")
-        return 0
+    Variables are kept out of the version files so adding them never rewrites
+    the (multi-MB) text; the browser merges the sidecar in when it needs it.
+    Returns the number of seeds that were new or changed.
+    """
 
-    with open(combined_file, 'r', encoding='utf-8') as f:
-        all_versions = json.load(f)
+    seed_variables = {}
+    if VARIABLES_PATH.exists():
+        with open(VARIABLES_PATH, 'r', encoding='utf-8') as f:
+            seed_variables = json.load(f)
 
     updated = 0
     for seed_id, variables in seed_vars.items():
-        if seed_id in all_versions:
-            all_versions[seed_id]['variables'] = variables
+        if seed_variables.get(seed_id) != variables:
+            seed_variables[seed_id] = variables
             updated += 1
 
-    with open(combined_file, 'w', encoding='utf-8') as f:
-        json.dump(all_versions, f, indent=2, ensure_ascii=False)
+    # One seed per line keeps the file compact and diffs readable.
+    lines = [
+        f"  {json.dumps(seed_id)}: {json.dumps(seed_variables[seed_id], ensure_ascii=False)}"
+        for seed_id in sorted(seed_variables, key=lambda s: (len(s), s))
+    ]
+    with open(VARIABLES_PATH, 'w', encoding='utf-8') as f:
+        f.write("{\n" + ",\n".join(lines) + "\n}\n")
 
     return updated
 
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python add_variables.py <generation_log.txt>")
+        print("Usage: python add_variables.py <generation_log.txt | variables.json | events.jsonl>")
         print("\nExpects a text file with generation output containing:")
         print("  *** makeBook XXXXX ***")
         print("  vars: ['var1', 'var2', ...]")
+        print("or a seed -> variables table from variableoracle.py --format=json")
+        print("or an event log from collapser.py --log=events.jsonl")
         sys.exit(1)
 
     log_path = Path(sys.argv[1])
@@ -113,7 +147,12 @@ def main():
         sys.exit(1)
 
     print(f"Parsing {log_path}...")
-    seed_vars = parse_generation_log(log_path)
+    if log_path.suffix == '.json':
+        seed_vars = parse_variable_table(log_path)
+    elif log_path.suffix == '.jsonl':
+        seed_vars = parse_event_log(log_path)
+    else:
+        seed_vars = parse_generation_log(log_path)
 
     if not seed_vars:
         print("No seed/variable data found in log file.")
@@ -121,13 +160,9 @@ def main():
 
     print(f"\nFound {len(seed_vars)} seeds with variables.")
 
-    print("\nUpdating individual version files...")
-    individual_count = update_version_files(seed_vars)
-    print(f"  Updated {individual_count} individual files.")
-
-    print("\nUpdating combined all_versions.json...")
-    combined_count = update_combined_file(seed_vars)
-    print(f"  Updated {combined_count} entries in all_versions.json.")
+    print(f"\nUpdating {VARIABLES_PATH.name}...")
+    updated_count = update_variables_file(seed_vars)
+    print(f"  Added or changed {updated_count} seeds.")
 
     print("\nDone!")
 
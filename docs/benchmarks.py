@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the generation and analysis pipelines, on the data bundled
+with the repository:
+
+    collapse      collapse the book in origin_text with a fixed seed
+    differ        differ.getTwoLeastSimilar over N extracted versions of a chapter
+    discourse     discourseVars.getDiscoursePreferredVersion over every
+                  alternative in origin_text
+    extract       extract_all_versions over sources/subcutaneans
+    levenshtein   calculate_all_distances over N extracted versions
+
+Each benchmark runs --repeat times and its median time is compared with the
+median of its last few recorded runs in the history file; anything slower by
+more than --threshold is flagged as a regression, and the script exits with
+status 1. Unless --no-record is given, the results are then appended to the
+history file, one JSON line per run.
+
+    python3 benchmarks.py
+    python3 benchmarks.py --only collapse,discourse --repeat 5
+    python3 benchmarks.py --threshold 0.1 --no-record
+
+collapse, differ and discourse run sources/source_code/benchtasks.py under
+the Python 2 interpreter given by --python2. A benchmark whose dependencies
+aren't installed is reported as skipped; one that crashes is reported as
+failed, and fails the run like a regression. The extraction writes into a
+scratch directory, leaving extracted_text alone.
+
+This repository only carries part of the collapser: quantlex, quantparse,
+fileio and the other modules collapse and discourse need aren't in the tree
+(nor is textblob), so on the bundled tree those two are always skipped and
+the Python 2 side measures differ alone. They run once the full collapser
+source is alongside benchtasks.py. levenshtein needs the Levenshtein package.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+SOURCE_DIR = BASE_DIR.parent / "sources" / "source_code"
+EXTRACTED_DIR = BASE_DIR / "extracted_text"
+HISTORY_PATH = BASE_DIR / "benchmark_history.jsonl"
+
+BENCHMARKS = ["collapse", "differ", "discourse", "extract", "levenshtein"]
+SEED = 45443
+# How many earlier runs a benchmark's baseline is taken from
+BASELINE_RUNS = 5
+
+
+# benchtasks.py's exit status for a task whose dependencies aren't installed
+MISSING_DEPENDENCY = 3
+
+
+class Skipped(Exception):
+    """A benchmark can't run here, e.g. because a dependency is missing."""
+
+
+class Failed(Exception):
+    """A benchmark crashed."""
+
+
+def run_python2(task, args, repeat, python2):
+    """Run a benchtasks.py task and return its times and info."""
+    cmd = [python2, "benchtasks.py", f"--repeat={repeat}"] + args + [task]
+    try:
+        proc = subprocess.run(cmd, cwd=SOURCE_DIR, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise Skipped(f"no Python 2 interpreter '{python2}'")
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines() or [f"exited with status {proc.returncode}"]
+        if proc.returncode == MISSING_DEPENDENCY:
+            raise Skipped(lines[-1])
+        raise Failed(lines[-1])
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    return result["times"], result["info"]
+
+
+def time_calls(fn, repeat):
+    """Call fn repeat times with its printing suppressed; return the times and
+    fn's last result."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            result = fn()
+        times.append(time.perf_counter() - started)
+    return times, result
+
+
+def load_versions(count):
+    versions = {}
+    for path in sorted(EXTRACTED_DIR.glob("version_*.json"))[:count]:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        versions[data["version_id"]] = data
+    return versions
+
+
+def bench_collapse(args):
+    return run_python2("collapse", [f"--seed={args.seed}"], args.repeat, args.python2)
+
+
+def bench_differ(args):
+    return run_python2("differ", [f"--candidates={args.candidates}", f"--chapter={args.chapter}"], args.repeat, args.python2)
+
+
+def bench_discourse(args):
+    return run_python2("discourse", [], args.repeat, args.python2)
+
+
+def bench_extract(args):
+    from extract_text_all import extract_all_versions
+    with tempfile.TemporaryDirectory() as scratch:
+        times, versions = time_calls(lambda: extract_all_versions(output_dir=scratch), args.repeat)
+    return times, {"versions": len(versions)}
+
+
+def bench_levenshtein(args):
+    try:
+        from calculate_levenshtein import calculate_all_distances
+    except ImportError as e:
+        raise Skipped(str(e))
+    versions = load_versions(args.versions)
+    times, distances = time_calls(lambda: calculate_all_distances(versions), args.repeat)
+    return times, {"versions": len(versions), "pairs": len(distances)}
+
+
+def run_benchmark(name, args):
+    """Returns the result recorded for one benchmark."""
+    try:
+        times, info = globals()["bench_" + name](args)
+    except Skipped as e:
+        return {"status": "skipped", "reason": str(e)}
+    except Exception as e:
+        return {"status": "failed", "reason": str(e) if isinstance(e, Failed) else repr(e)}
+    return {
+        "status": "ok",
+        "median": statistics.median(times),
+        "min": min(times),
+        "times": times,
+        "info": info,
+    }
+
+
+def load_history(path):
+    if not path.exists():
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def baseline(history, name, settings):
+    """Median of the benchmark's last few recorded medians, from runs with the
+    same settings, or None if it has never run."""
+    medians = [run["results"][name]["median"] for run in history
+               if run.get("settings") == settings
+               and run["results"].get(name, {}).get("status") == "ok"]
+    if not medians:
+        return None
+    return statistics.median(medians[-BASELINE_RUNS:])
+
+
+def git_commit():
+    try:
+        proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True)
+    except FileNotFoundError:
+        return None
+    return proc.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the generation and analysis pipelines.")
+    parser.add_argument('--only', help=f"comma-separated benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each benchmark (default 3)")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="flag a benchmark more than this fraction slower than its baseline (default 0.2)")
+    parser.add_argument('--history', type=Path, default=HISTORY_PATH, help=f"history file (default {HISTORY_PATH.name})")
+    parser.add_argument('--no-record', action='store_true', help="don't append this run to the history")
+    parser.add_argument('--python2', default=os.environ.get("PYTHON2", "python2.7"),
+                        help="Python 2 interpreter for the collapser benchmarks (default $PYTHON2 or python2.7)")
+    parser.add_argument('--seed', type=int, default=SEED, help=f"seed for collapse (default {SEED})")
+    parser.add_argument('--candidates', type=int, default=6, help="versions compared by differ (default 6)")
+    parser.add_argument('--chapter', default="prologue", help="chapter compared by differ (default prologue)")
+    parser.add_argument('--versions', type=int, default=4, help="versions compared by levenshtein (default 4)")
+    args = parser.parse_args()
+
+    names = BENCHMARKS if not args.only else [name.strip() for name in args.only.split(",")]
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    # Runs are only compared with runs of the same size.
+    settings = {"repeat": args.repeat, "seed": args.seed, "candidates": args.candidates,
+                "chapter": args.chapter, "versions": args.versions}
+    history = load_history(args.history)
+    results = {}
+    regressions = []
+    failures = []
+    for name in names:
+        result = run_benchmark(name, args)
+        results[name] = result
+        if result["status"] == "failed":
+            print(f"{name:12} FAILED: {result['reason']}")
+            failures.append(name)
+            continue
+        if result["status"] != "ok":
+            print(f"{name:12} skipped: {result['reason']}")
+            continue
+        base = baseline(history, name, settings)
+        line = f"{name:12} {result['median']:9.3f}s  (min {result['min']:.3f}s)"
+        if base is not None:
+            change = result["median"] / base - 1
+            line += f"  {change:+.1%} vs {base:.3f}s"
+            if change > args.threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    if not args.no_record:
+        run = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "settings": settings,
+            "results": results,
+        }
+        with open(args.history, "a", encoding="utf-8") as f:
+            f.write(json.dumps(run, sort_keys=True) + "\n")
+
+    if failures:
+        print(f"\n{len(failures)} benchmark(s) failed: {', '.join(failures)}")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}")
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
-"""Build JSON representation of Quant source files defined in origin_text/manifest.txt."""
+"""Build the index of Quant source files defined in origin_text/manifest.txt.
+
+The index lists the chapters in order with their titles, file names and a hash
+of each file's contents. The browser fetches it up front and then fetches only
+the chapter source files it needs, using the hash to make sure a cached copy
+is current.
+"""
 from __future__ import annotations
 
+import hashlib
 import json
 from pathlib import Path
 from typing import Dict, List
@@ -9,7 +16,7 @@ from typing import Dict, List
 BASE_DIR = Path(__file__).resolve().parent
 ORIGIN_DIR = BASE_DIR / "origin_text"
 MANIFEST_PATH = ORIGIN_DIR / "manifest.txt"
-OUTPUT_PATH = ORIGIN_DIR / "origin_sources.json"
+OUTPUT_PATH = ORIGIN_DIR / "origin_index.json"
 
 
 def load_manifest() -> List[str]:
@@ -43,7 +50,11 @@ def friendly_title(stem: str) -> str:
     return stem
 
 
-def build_origin_data(manifest_entries: List[str]) -> Dict[str, object]:
+def content_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+def build_origin_index(manifest_entries: List[str]) -> Dict[str, object]:
     order: List[Dict[str, str]] = []
     chapters: Dict[str, Dict[str, object]] = {}
 
@@ -54,12 +65,13 @@ def build_origin_data(manifest_entries: List[str]) -> Dict[str, object]:
 
         stem = source_path.stem
         title = friendly_title(stem)
-        content = source_path.read_text(encoding="utf-8")
+        data = source_path.read_bytes()
         chapter_info = {
             "key": stem,
             "title": title,
             "filename": entry,
-            "content": content,
+            "hash": content_hash(data),
+            "size": len(data),
         }
         order.append({"key": stem, "title": title, "filename": entry})
         chapters[stem] = chapter_info
@@ -69,12 +81,12 @@ def build_origin_data(manifest_entries: List[str]) -> Dict[str, object]:
 
 def main() -> None:
     manifest_entries = load_manifest()
-    origin_data = build_origin_data(manifest_entries)
+    origin_index = build_origin_index(manifest_entries)
     OUTPUT_PATH.write_text(
-        json.dumps(origin_data, ensure_ascii=False, indent=2),
+        json.dumps(origin_index, ensure_ascii=False, indent=2),
         encoding="utf-8",
     )
-    print(f"Wrote {OUTPUT_PATH} with {len(origin_data['chapters'])} entries.")
+    print(f"Wrote {OUTPUT_PATH} with {len(origin_index['chapters'])} entries.")
 
 
 if __name__ == "__main__":
@@ -8,15 +8,30 @@ Parse globals.txt and chapter source files to extract variable information:
 5. Inference patterns for detecting variables in uploaded EPUBs
 
 Outputs: docs/extracted_text/variable_info.json
+         docs/extracted_text/dependency_graph.json (see dependency_graph.py)
+
+Each chapter's scan is cached in docs/extracted_text/.variable_info_cache.json,
+keyed by a hash of the file, so a rebuild only rescans the chapters that have
+changed. Pass --full to ignore the cache.
 """
 
+import hashlib
 import json
 import re
+import sys
+from bisect import bisect_right
 from pathlib import Path
 
+import quant_tokenizer
+from dependency_graph import DependencyGraph
+
 BASE_DIR = Path(__file__).resolve().parent
 ORIGIN_DIR = BASE_DIR / "origin_text"
 OUTPUT_PATH = BASE_DIR / "extracted_text" / "variable_info.json"
+CACHE_PATH = BASE_DIR / "extracted_text" / ".variable_info_cache.json"
+
+# Bump when scan_chapter changes what it records, to invalidate old caches
+SCAN_VERSION = 3
 
 # Minimum pattern length for inference (shorter patterns may cause false positives)
 MIN_INFERENCE_PATTERN_LENGTH = 15
@@ -47,6 +62,8 @@ CHAPTER_MAPPING = {
     'notes': 'notes',
 }
 
+PARAGRAPH_BREAK_RE = re.compile(r'\n(?:[ \t]*\n)+')
+
 CHAPTER_ORDER = [
     'prologue', 'chapter1', 'chapter2', 'chapter3', 'chapter4',
     'chapter5', 'chapter6', 'chapter7', 'chapter8', 'chapter9',
@@ -56,141 +73,293 @@ CHAPTER_ORDER = [
 ]
 
 
-def parse_globals():
-    """Parse globals.txt to extract variable definitions, descriptions, and macros."""
-    globals_path = ORIGIN_DIR / "globals.txt"
+def scan_sources(cache=None):
+    """Read and tokenize every source file once.
+
+    Returns (globals_text, chapters, rescanned), where globals_text is the
+    contents of globals.txt (or None if missing) and chapters is a list of
+    per-chapter scans, each holding everything the later analyses need from
+    that file: direct @variable references, {Macro} references, [@var>text]
+    conditionals and DEFINE statements with the comments above them.
 
-    if not globals_path.exists():
+    If a cache dict is given (file name -> {'hash', 'scan'}), chapters whose
+    hash matches are taken from it rather than rescanned; the cache is updated
+    in place and rescanned lists the chapters that were not. The scans don't
+    depend on globals.txt, so a change there only means re-running the
+    analyses, which is cheap.
+    """
+    globals_path = ORIGIN_DIR / "globals.txt"
+    globals_text = None
+    if globals_path.exists():
+        globals_text = globals_path.read_text(encoding='utf-8')
+    else:
         print(f"Warning: {globals_path} not found")
-        return {}, {}, {}, []
 
-    variables = {}
-    macros = {}  # macro_name -> list of variables it uses
-    macro_patterns = {}  # macro_name -> {var_name: [text patterns]}
-    variable_groups = []  # List of variable groups (mutually exclusive alternatives)
-    current_comment = []
+    chapters = []
+    rescanned = []
+    seen = set()
+    for source_file in sorted(ORIGIN_DIR.glob('*.txt')):
+        if source_file.name in ('globals.txt', 'manifest.txt'):
+            continue
+        seen.add(source_file.name)
+        data = source_file.read_bytes()
+        file_hash = hashlib.sha1(data).hexdigest()
 
-    with open(globals_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.rstrip()
+        entry = cache.get(source_file.name) if cache is not None else None
+        if entry and entry['hash'] == file_hash:
+            chapters.append(scan_from_json(entry['scan']))
+            continue
 
-            # Collect comment lines
-            if line.startswith('#') and not line.startswith('# QUANT'):
-                comment_text = line[1:].strip()
-                if comment_text and not comment_text.startswith('***'):
-                    current_comment.append(comment_text)
-                continue
+        scan = scan_chapter(source_file.stem, data.decode('utf-8'))
+        chapters.append(scan)
+        rescanned.append(scan['chapter_id'])
+        if cache is not None:
+            cache[source_file.name] = {'hash': file_hash, 'scan': scan_to_json(scan)}
+
+    # Forget chapters that have been deleted
+    if cache is not None:
+        for name in list(cache):
+            if name not in seen:
+                del cache[name]
+
+    return globals_text, chapters, rescanned
+
+
+def scan_chapter(stem, content):
+    """Tokenize one chapter source file."""
+    nodes = quant_tokenizer.tokenize(content)
+
+    direct_refs = set()
+    macro_refs = set()
+    conditionals = []  # (var_name, text) for each [@varname>text...]
+    for node in nodes:
+        direct_refs.update(quant_tokenizer.variable_references(node))
+        macro_refs.update(macro.name for macro in quant_tokenizer.macro_references(node))
+        if isinstance(node, quant_tokenizer.MacroDefinition):
+            node = node.body
+        if isinstance(node, quant_tokenizer.Sequence):
+            for alt in node.alternatives:
+                if alt.conditional:
+                    conditionals.append((alt.variable, alt.text.strip()))
+
+    # Variant sites: control sequences, and macro uses outside of them
+    paragraph_starts = [m.end() for m in PARAGRAPH_BREAK_RE.finditer(content)]
+    sites = []
+    for node in nodes:
+        if isinstance(node, (quant_tokenizer.Sequence, quant_tokenizer.Macro)):
+            site_vars = node.variables if isinstance(node, quant_tokenizer.Sequence) else []
+            site_macros = invoked_macros(node)
+            if site_vars or site_macros:
+                sites.append({
+                    'paragraph': bisect_right(paragraph_starts, node.start),
+                    'start': node.start,
+                    'variables': sorted(set(site_vars)),
+                    'macros': site_macros,
+                })
+
+    defines = [
+        {
+            'raw': node.raw,
+            'description': description,
+            'variables': node.variables,
+            'preferred': [alt.variable for alt in node.alternatives if alt.variable and alt.preferred],
+            'has_probabilities': any(alt.probability is not None for alt in node.alternatives),
+        }
+        for node, description in described_definitions(nodes)
+        if isinstance(node, quant_tokenizer.Define)
+    ]
+
+    return {
+        'chapter_id': CHAPTER_MAPPING.get(stem, stem),
+        'direct_refs': direct_refs,
+        'macro_refs': macro_refs,
+        'conditionals': conditionals,
+        'defines': defines,
+        'sites': sites,
+        'macro_definitions': macro_definitions(nodes),
+    }
+
+
+def invoked_macros(node):
+    """Names of the macros a node invokes (formatting codes, which take
+    parameters, are left out)."""
+    return sorted({macro.name for macro in quant_tokenizer.macro_references(node) if not macro.params})
 
-            # Look for DEFINE statements
-            define_match = re.search(r'\[DEFINE\s+([^\]]+)\]', line)
-            if define_match:
-                define_content = define_match.group(1)
-                var_names = re.findall(r'@(\w+)', define_content)
-                description = ' '.join(current_comment) if current_comment else None
-
-                # Track if this is a group of mutually exclusive variables
-                # (more than one variable in the DEFINE, separated by |)
-                if len(var_names) > 1:
-                    variable_groups.append({
-                        'variables': var_names,
-                        'description': description,
-                        'type': 'exclusive'  # exactly one is active
-                    })
-
-                for var_name in var_names:
-                    # Check if it's optional (has ^ prefix)
-                    is_optional = f'^@{var_name}' in define_content
-                    variables[var_name] = {
-                        'description': description,
-                        'chapters': [],
-                        'usage_count': 0,
-                        'macros': [],
-                        'group': var_names if len(var_names) > 1 else None,
-                        'optional': is_optional,
-                    }
-
-                current_comment = []
-                continue
 
-            # Look for MACRO definitions
-            macro_match = re.search(r'\[MACRO\s+(\w+)\](.+)', line)
-            if macro_match:
-                macro_name = macro_match.group(1)
-                macro_content = macro_match.group(2)
-
-                # Find all variables referenced in this macro
-                vars_in_macro = re.findall(r'@(\w+)', macro_content)
-                if vars_in_macro:
-                    macros[macro_name] = list(set(vars_in_macro))
-
-                    # Track which macros each variable is used in
-                    for var_name in vars_in_macro:
-                        if var_name in variables:
-                            if macro_name not in variables[var_name]['macros']:
-                                variables[var_name]['macros'].append(macro_name)
-
-                # Extract text patterns from macro definition: @varname>text
-                macro_patterns[macro_name] = {}
-                for var_match in re.finditer(r'@(\w+)>([^|\]\[]+)', macro_content):
-                    var_name = var_match.group(1)
-                    text_snippet = var_match.group(2).strip()
-                    # Clean up the snippet (remove nested macros, keep italic text)
-                    clean_snippet = re.sub(r'\{i/([^}]+)\}', r'\1', text_snippet)
-                    clean_snippet = re.sub(r'\{[^}]+\}', '', clean_snippet)
-                    clean_snippet = clean_snippet.strip()
-                    if clean_snippet and len(clean_snippet) >= 3:
-                        if var_name not in macro_patterns[macro_name]:
-                            macro_patterns[macro_name][var_name] = []
-                        macro_patterns[macro_name][var_name].append(clean_snippet)
-
-                current_comment = []
+def macro_definitions(nodes):
+    """macro name -> the variables and macros its body uses directly."""
+    return {
+        node.name: {
+            'variables': sorted(set(node.body.variables)),
+            'macros': invoked_macros(node),
+        }
+        for node in nodes
+        if isinstance(node, quant_tokenizer.MacroDefinition) and node.body is not None
+    }
+
+
+def build_dependency_graph(globals_nodes, chapters):
+    macros = macro_definitions(globals_nodes)
+    sites = []
+    for chapter in chapters:
+        macros.update(chapter['macro_definitions'])
+        sites.extend(dict(site, chapter=chapter['chapter_id']) for site in chapter['sites'])
+    return DependencyGraph(macros, sites, CHAPTER_ORDER)
+
+
+def described_definitions(nodes, ignore_comment=None):
+    """Yield (node, description) for each DEFINE and MACRO definition.
+
+    The description is the block of comment lines directly above it, joined
+    into one string (or None). Any other content in between breaks the block.
+    """
+    current_comment = []
+    for node in nodes:
+        if isinstance(node, quant_tokenizer.Comment):
+            if ignore_comment and ignore_comment(node.text):
                 continue
+            comment_text = node.text.strip()
+            if comment_text and not comment_text.startswith('***'):
+                current_comment.append(comment_text)
+            continue
 
-            if line.strip():
-                current_comment = []
+        if isinstance(node, (quant_tokenizer.Define, quant_tokenizer.MacroDefinition)):
+            yield node, ' '.join(current_comment) if current_comment else None
+            current_comment = []
+            continue
 
-    return variables, macros, macro_patterns, variable_groups
+        if not isinstance(node, quant_tokenizer.Text) or node.text.strip():
+            current_comment = []
 
 
-def find_variable_usage(variables, macros):
-    """Scan chapter files for variable usage (direct and via macros)."""
+def clean_snippet(text_snippet):
+    """Reduce a conditional's text to plain words: keep italics, drop other codes."""
+    clean = re.sub(r'\{i/([^}]+)\}', r'\1', text_snippet)
+    clean = re.sub(r'\{[^}]+\}', '', clean)
+    return clean.strip()
 
-    for source_file in ORIGIN_DIR.glob('*.txt'):
-        if source_file.name in ('globals.txt', 'manifest.txt'):
+
+def scan_to_json(scan):
+    return {
+        'chapter_id': scan['chapter_id'],
+        'direct_refs': sorted(scan['direct_refs']),
+        'macro_refs': sorted(scan['macro_refs']),
+        'conditionals': [list(c) for c in scan['conditionals']],
+        'defines': scan['defines'],
+        'sites': scan['sites'],
+        'macro_definitions': scan['macro_definitions'],
+    }
+
+
+def scan_from_json(data):
+    return {
+        'chapter_id': data['chapter_id'],
+        'direct_refs': set(data['direct_refs']),
+        'macro_refs': set(data['macro_refs']),
+        'conditionals': [tuple(c) for c in data['conditionals']],
+        'defines': data['defines'],
+        'sites': data['sites'],
+        'macro_definitions': data['macro_definitions'],
+    }
+
+
+def load_cache():
+    """Load the per-chapter scan cache, or start an empty one."""
+    if not CACHE_PATH.exists():
+        return {}
+    try:
+        with open(CACHE_PATH, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if data.get('version') != SCAN_VERSION:
+        return {}
+    return data.get('files', {})
+
+
+def save_cache(cache):
+    CACHE_PATH.parent.mkdir(exist_ok=True)
+    with open(CACHE_PATH, 'w', encoding='utf-8') as f:
+        json.dump({'version': SCAN_VERSION, 'files': cache}, f, ensure_ascii=False)
+
+
+def parse_globals(nodes):
+    """Parse the tokenized globals.txt to extract variable definitions, descriptions, and macros."""
+
+    variables = {}
+    macros = {}  # macro_name -> list of variables it uses
+    macro_patterns = {}  # macro_name -> {var_name: [text patterns]}
+    variable_groups = []  # List of variable groups (mutually exclusive alternatives)
+
+    is_header = lambda comment: comment.startswith(' QUANT')
+
+    for node, description in described_definitions(nodes, ignore_comment=is_header):
+        if isinstance(node, quant_tokenizer.Define):
+            var_names = node.variables
+
+            # Track if this is a group of mutually exclusive variables
+            # (more than one variable in the DEFINE, separated by |)
+            if len(var_names) > 1:
+                variable_groups.append({
+                    'variables': var_names,
+                    'description': description,
+                    'type': 'exclusive'  # exactly one is active
+                })
+
+            for alt in node.alternatives:
+                if not alt.variable:
+                    continue
+                variables[alt.variable] = {
+                    'description': description,
+                    'chapters': [],
+                    'usage_count': 0,
+                    'macros': [],
+                    'group': var_names if len(var_names) > 1 else None,
+                    # Optional if author-preferred (^ prefix)
+                    'optional': alt.preferred,
+                }
             continue
 
-        stem = source_file.stem
-        chapter_id = CHAPTER_MAPPING.get(stem, stem)
-        content = source_file.read_text(encoding='utf-8')
+        # MACRO definitions
+        if node.body is None:
+            continue
+        macro_name = node.name
+
+        # Find all variables referenced in this macro
+        vars_in_macro = list(dict.fromkeys(node.body.variables))
+        if vars_in_macro:
+            macros[macro_name] = vars_in_macro
+
+            # Track which macros each variable is used in
+            for var_name in vars_in_macro:
+                if var_name in variables:
+                    if macro_name not in variables[var_name]['macros']:
+                        variables[var_name]['macros'].append(macro_name)
+
+        # Extract text patterns from macro definition: @varname>text
+        macro_patterns[macro_name] = {}
+        for alt in node.body.alternatives:
+            if not alt.conditional:
+                continue
+            snippet = clean_snippet(alt.text)
+            if snippet and len(snippet) >= 3:
+                macro_patterns[macro_name].setdefault(alt.variable, []).append(snippet)
 
-        # Find direct variable references: @varname
-        direct_refs = set(re.findall(r'@(\w+)', content))
-        for var_name in direct_refs:
-            if var_name in variables:
-                if chapter_id not in variables[var_name]['chapters']:
-                    variables[var_name]['chapters'].append(chapter_id)
-                variables[var_name]['usage_count'] += 1
-
-        # Find macro usage: {MacroName} or {MacroName/...}
-        macro_refs = set(re.findall(r'\{(\w+)(?:/[^}]*)?\}', content))
-        for macro_name in macro_refs:
-            if macro_name in macros:
-                for var_name in macros[macro_name]:
-                    if var_name in variables:
-                        if chapter_id not in variables[var_name]['chapters']:
-                            variables[var_name]['chapters'].append(chapter_id)
-                        variables[var_name]['usage_count'] += 1
+    return variables, macros, macro_patterns, variable_groups
+
+
+def find_variable_usage(variables, graph):
+    """Record which chapters use each variable (directly or through any chain
+    of macros), and how many variant sites it can change."""
 
-    # Sort chapter lists
     for var_name in variables:
-        variables[var_name]['chapters'].sort(
-            key=lambda x: CHAPTER_ORDER.index(x) if x in CHAPTER_ORDER else 999
-        )
+        variables[var_name]['chapters'] = graph.chapters_affected_by(var_name)
+        variables[var_name]['usage_count'] = len(graph.sites_affected_by(var_name))
 
     return variables
 
 
-def extract_chapter_patterns(variables, macros, macro_patterns):
+def extract_chapter_patterns(variables, macros, macro_patterns, chapters):
     """Extract text patterns for each variable to help with highlighting.
 
     Patterns come from two sources:
@@ -201,39 +370,21 @@ def extract_chapter_patterns(variables, macros, macro_patterns):
     for var_name in variables:
         variables[var_name]['patterns'] = {}
 
-    for source_file in ORIGIN_DIR.glob('*.txt'):
-        if source_file.name in ('globals.txt', 'manifest.txt'):
-            continue
-
-        stem = source_file.stem
-        chapter_id = CHAPTER_MAPPING.get(stem, stem)
-        content = source_file.read_text(encoding='utf-8')
-
-        # Find direct conditional blocks: [@varname>text...]
-        pattern = r'\[(?:\*\w+\*)?[\^]?@(\w+)>([^\[\]|]+)'
-
-        for match in re.finditer(pattern, content):
-            var_name = match.group(1)
-            text_snippet = match.group(2).strip()
+    for chapter in chapters:
+        chapter_id = chapter['chapter_id']
 
+        for var_name, text_snippet in chapter['conditionals']:
             if var_name in variables:
                 if chapter_id not in variables[var_name]['patterns']:
                     variables[var_name]['patterns'][chapter_id] = []
 
-                clean_snippet = re.sub(r'\{i/([^}]+)\}', r'\1', text_snippet)
-                clean_snippet = re.sub(r'\{[^}]+\}', '', clean_snippet)
-                clean_snippet = clean_snippet.strip()
+                snippet = clean_snippet(text_snippet)
+                if snippet and len(snippet) > 10:
+                    variables[var_name]['patterns'][chapter_id].append(snippet[:100])
 
-                if clean_snippet and len(clean_snippet) > 10:
-                    variables[var_name]['patterns'][chapter_id].append(
-                        clean_snippet[:100]
-                    )
-
-        # Find macro usage and add patterns from macro definitions
-        macro_refs = set(re.findall(r'\{(\w+)(?:/[^}]*)?\}', content))
-        for macro_name in macro_refs:
+        # Add patterns from the definitions of macros used in this chapter
+        for macro_name in sorted(chapter['macro_refs']):
             if macro_name in macro_patterns:
-                # Add patterns from this macro to the relevant variables
                 for var_name, patterns in macro_patterns[macro_name].items():
                     if var_name in variables:
                         if chapter_id not in variables[var_name]['patterns']:
@@ -245,91 +396,70 @@ def extract_chapter_patterns(variables, macros, macro_patterns):
     return variables
 
 
-def extract_chapter_variables(global_variables):
+def extract_chapter_variables(global_variables, chapters):
     """Extract variables defined within chapter files (not in globals.txt).
 
     Returns a dict: chapter_id -> list of variable definitions
     """
     chapter_variables = {}
 
-    for source_file in ORIGIN_DIR.glob('*.txt'):
-        if source_file.name in ('globals.txt', 'manifest.txt'):
-            continue
-
-        stem = source_file.stem
-        chapter_id = CHAPTER_MAPPING.get(stem, stem)
-        content = source_file.read_text(encoding='utf-8')
-
+    for chapter in chapters:
         chapter_vars = []
-        current_comment = []
-
-        for line in content.split('\n'):
-            line = line.rstrip()
-
-            # Collect comment lines
-            if line.startswith('#'):
-                comment_text = line[1:].strip()
-                if comment_text and not comment_text.startswith('***'):
-                    current_comment.append(comment_text)
-                continue
 
-            # Look for DEFINE statements
-            define_match = re.search(r'\[DEFINE\s+([^\]]+)\]', line)
-            if define_match:
-                define_content = define_match.group(1)
-                var_names = re.findall(r'@(\w+)', define_content)
-
-                # Skip if all variables are global (already in globals.txt)
-                local_vars = [v for v in var_names if v not in global_variables]
-                if not local_vars:
-                    current_comment = []
-                    continue
-
-                description = ' '.join(current_comment) if current_comment else None
-
-                # Check if it's a group (mutually exclusive)
-                is_group = len(local_vars) > 1
-
-                # Check for optional (^) prefix
-                is_optional = any(f'^@{v}' in define_content for v in local_vars)
-
-                # Extract probabilities if present
-                has_probabilities = bool(re.search(r'\d+>', define_content))
-
-                chapter_vars.append({
-                    'variables': local_vars,
-                    'description': description,
-                    'is_group': is_group,
-                    'is_optional': is_optional,
-                    'has_probabilities': has_probabilities,
-                    'raw': define_content.strip()
-                })
-
-                current_comment = []
+        for define in chapter['defines']:
+            # Skip if all variables are global (already in globals.txt)
+            local_vars = [v for v in define['variables'] if v not in global_variables]
+            if not local_vars:
                 continue
 
-            if line.strip():
-                current_comment = []
+            chapter_vars.append({
+                'variables': local_vars,
+                'description': define['description'],
+                # A group is a set of mutually exclusive alternatives
+                'is_group': len(local_vars) > 1,
+                'is_optional': any(v in define['preferred'] for v in local_vars),
+                'has_probabilities': define['has_probabilities'],
+                'raw': define['raw'].strip()
+            })
 
         if chapter_vars:
-            chapter_variables[chapter_id] = chapter_vars
+            chapter_variables[chapter['chapter_id']] = chapter_vars
 
     return chapter_variables
 
 
 def main():
-    print("Parsing globals.txt for variables and macros...")
-    variables, macros, macro_patterns, variable_groups = parse_globals()
+    full_rebuild = '--full' in sys.argv[1:]
+    cache = {} if full_rebuild else load_cache()
+
+    print("Scanning source files...")
+    globals_text, chapters, rescanned = scan_sources(cache)
+    if len(rescanned) == len(chapters):
+        print(f"  Scanned {len(chapters)} chapter files")
+    else:
+        print(f"  Rescanned {len(rescanned)} of {len(chapters)} chapter files"
+              + (f": {', '.join(rescanned)}" if rescanned else ""))
+    save_cache(cache)
+
+    globals_nodes = quant_tokenizer.tokenize(globals_text) if globals_text is not None else []
+
+    print("\nParsing globals.txt for variables and macros...")
+    variables, macros, macro_patterns, variable_groups = parse_globals(globals_nodes)
     print(f"  Found {len(variables)} variables, {len(macros)} macros")
     print(f"  Found {len(variable_groups)} variable groups (mutually exclusive sets)")
     macros_with_patterns = sum(1 for mp in macro_patterns.values() if mp)
     print(f"  {macros_with_patterns} macros have extractable text patterns")
 
+    print("\nBuilding dependency graph...")
+    graph = build_dependency_graph(globals_nodes, chapters)
+    graph.save()
+    print(f"  {len(graph.sites)} variant sites, {len(graph.macros)} macros")
+
     print("\nScanning chapters for variable usage (direct + via macros)...")
-    variables = find_variable_usage(variables, macros)
+    variables = find_variable_usage(variables, graph)
 
     print("\nExtracting text patterns (direct + from macros)...")
-    variables = extract_chapter_patterns(variables, macros, macro_patterns)
+    variables = extract_chapter_patterns(variables, macros, macro_patterns, chapters)
 
     with_chapters = sum(1 for v in variables.values() if v.get('chapters'))
     with_patterns = sum(1 for v in variables.values() if v.get('patterns'))
@@ -337,7 +467,7 @@ def main():
     print(f"  {with_patterns} variables have text patterns for highlighting")
 
     print("\nExtracting chapter-local variable definitions...")
-    chapter_variables = extract_chapter_variables(variables)
+    chapter_variables = extract_chapter_variables(variables, chapters)
     total_chapter_vars = sum(len(defs) for defs in chapter_variables.values())
     print(f"  Found {total_chapter_vars} chapter-local variable definitions in {len(chapter_variables)} chapters")
 
@@ -16,8 +16,9 @@ let bookmarkPanelPosition = { x: null, y: null };
 let filesPanelOpen = false;
 let filesPanelPosition = { x: null, y: null };
 let pendingBookmarkScroll = null;
-let originSources = null;
+let originSources = null; // origin_text/origin_index.json; each chapter's content is fetched on first use
 let originSourcesLoaded = false;
+let originChapterRequests = {}; // Source key -> pending fetch of that chapter's text
 let originSourcePanelOpen = false;
 let currentSourceKey = null;
 let sourcePanelPosition = { x: null, y: null };
@@ -27,6 +28,8 @@ let variableInfo = null; // Variable descriptions and usage patterns
 let variableGroups = null; // Mutually exclusive variable groups for inference
 let variableMacros = null; // Macro definitions for inference
 let scholarlyDescriptions = null; // Scholarly annotations (override variableInfo descriptions)
+let seedVariables = null; // Seed -> variables sidecar (extracted_text/variables.json), fetched on first use
+let seedVariablesRequest = null;
 let sourceSyntaxHighlightingEnabled = false;
 const SOURCE_VERSION_ID = 'quant_source';
 const SOURCE_VERSION_LABEL = 'Source Code';
@@ -823,12 +826,12 @@ function findMatchingDelimiter(text, startIndex, openChar, closeChar) {
 
 function getSourceChapterParagraphs(chapterId, highlighted = false) {
     const key = getSourceKeyForChapter(chapterId);
-    if (!key || !originSourcesLoaded || !originSources || !originSources.chapters[key]) {
+    if (!key || getOriginChapterContent(key) === null) {
         return [];
     }
 
     if (!sourceParagraphCache[key]) {
-        sourceParagraphCache[key] = convertSourceContentToParagraphs(originSources.chapters[key].content || '');
+        sourceParagraphCache[key] = convertSourceContentToParagraphs(getOriginChapterContent(key));
     }
 
     const cache = sourceParagraphCache[key];
@@ -837,12 +840,12 @@ function getSourceChapterParagraphs(chapterId, highlighted = false) {
 
 function getSourceChapterNormalizedParagraphs(chapterId) {
     const key = getSourceKeyForChapter(chapterId);
-    if (!key || !originSourcesLoaded || !originSources || !originSources.chapters[key]) {
+    if (!key || getOriginChapterContent(key) === null) {
         return [];
     }
 
     if (!sourceParagraphCache[key]) {
-        sourceParagraphCache[key] = convertSourceContentToParagraphs(originSources.chapters[key].content || '');
+        sourceParagraphCache[key] = convertSourceContentToParagraphs(getOriginChapterContent(key));
     }
 
     return sourceParagraphCache[key].normalized;
@@ -850,12 +853,12 @@ function getSourceChapterNormalizedParagraphs(chapterId) {
 
 function getSourceChapterRawParagraphs(chapterId) {
     const key = getSourceKeyForChapter(chapterId);
-    if (!key || !originSourcesLoaded || !originSources || !originSources.chapters[key]) {
+    if (!key || getOriginChapterContent(key) === null) {
         return [];
     }
 
     if (!sourceParagraphCache[key]) {
-        sourceParagraphCache[key] = convertSourceContentToParagraphs(originSources.chapters[key].content || '');
+        sourceParagraphCache[key] = convertSourceContentToParagraphs(getOriginChapterContent(key));
     }
 
     return sourceParagraphCache[key].raw;
@@ -1218,10 +1221,39 @@ function initializeThirdVersionControls() {
 }
 
 // Variable diff panel functions
+
+// Fetch the seed -> variables sidecar the first time variables are needed, then refresh the panel.
+function loadSeedVariables() {
+    if (seedVariablesRequest) return seedVariablesRequest;
+    seedVariablesRequest = fetch('extracted_text/variables.json')
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            seedVariables = data;
+            console.log(`Loaded variables for ${Object.keys(seedVariables).length} seeds`);
+            updateVariableDiffIfVisible();
+        })
+        .catch(error => {
+            console.error('Error loading seed variables:', error);
+            seedVariables = {};
+        });
+    return seedVariablesRequest;
+}
+
 function getVersionVariables(versionId) {
     if (!versionId) return [];
 
-    // First check allVersions (pre-loaded seeds)
+    if (seedVariables === null) {
+        loadSeedVariables();
+    } else if (seedVariables[versionId]) {
+        return seedVariables[versionId];
+    }
+
+    // Then check allVersions (older data with variables stored alongside the text)
     if (allVersions && allVersions[versionId]?.variables) {
         return allVersions[versionId].variables;
     }
@@ -1413,11 +1445,9 @@ function addViewSourceButton(paragraph, varName) {
 function findVariableSourceSnippet(varName) {
     // Get the source key for the current chapter
     const sourceKey = SOURCE_KEY_BY_CHAPTER[currentChapter];
-    if (!sourceKey || !originSources || !originSources.chapters[sourceKey]) {
-        return null;
-    }
+    if (!sourceKey) return null;
 
-    const sourceContent = originSources.chapters[sourceKey].content;
+    const sourceContent = getOriginChapterContent(sourceKey);
     if (!sourceContent) return null;
 
     // Find lines containing the variable conditional
@@ -1441,8 +1471,8 @@ function findVariableSourceSnippet(varName) {
     }
 
     // Also check globals.txt for macro definitions that use this variable
-    if (originSources.chapters['globals']) {
-        const globalsContent = originSources.chapters['globals'].content;
+    const globalsContent = getOriginChapterContent('globals');
+    if (globalsContent) {
         const globalsLines = globalsContent.split('\n');
 
         for (let i = 0; i < globalsLines.length; i++) {
@@ -1944,12 +1974,12 @@ function getSourceForRenderedParagraph(versionId, paragraphIndex, originalIndex
 // Get full source data including content-only paragraphs and macro definitions
 function getSourceChapterData(chapterId) {
     const key = getSourceKeyForChapter(chapterId);
-    if (!key || !originSourcesLoaded || !originSources || !originSources.chapters[key]) {
+    if (!key || getOriginChapterContent(key) === null) {
         return null;
     }
 
     if (!sourceParagraphCache[key]) {
-        sourceParagraphCache[key] = convertSourceContentToParagraphs(originSources.chapters[key].content || '');
+        sourceParagraphCache[key] = convertSourceContentToParagraphs(getOriginChapterContent(key));
     }
 
     return sourceParagraphCache[key];
@@ -1961,13 +1991,13 @@ function getGlobalMacros() {
         return globalMacrosCache;
     }
 
-    globalMacrosCache = new Map();
-
-    if (!originSourcesLoaded || !originSources || !originSources.chapters['globals']) {
-        return globalMacrosCache;
+    const globalsContent = getOriginChapterContent('globals');
+    if (globalsContent === null) {
+        // Not fetched yet: don't cache the empty result
+        return new Map();
     }
 
-    const globalsContent = originSources.chapters['globals'].content || '';
+    globalMacrosCache = new Map();
     const normalized = globalsContent.replace(/\r\n/g, '\n');
     const blocks = normalized.split(/\n{2,}/);
 
@@ -4649,19 +4679,23 @@ function openGlobalsModal() {
     const contentEl = document.getElementById('globals-content');
 
     // Load globals content from origin sources
-    if (originSourcesLoaded && originSources && originSources.chapters && originSources.chapters.globals) {
-        const globalsContent = originSources.chapters.globals.content || '';
+    const globalsContent = getOriginChapterContent('globals');
+    if (globalsContent !== null) {
         contentEl.innerHTML = highlightQuantSyntax(globalsContent);
     } else {
         contentEl.innerHTML = '<span style="color: #888;">Loading globals.txt...</span>';
-        // Try to load origin sources if not loaded
-        loadOriginSources().then(() => {
-            if (originSources && originSources.chapters && originSources.chapters.globals) {
-                contentEl.innerHTML = highlightQuantSyntax(originSources.chapters.globals.content || '');
-            } else {
-                contentEl.innerHTML = '<span style="color: #f66;">Could not load globals.txt</span>';
-            }
-        });
+        // Load the index first if needed, then globals.txt itself
+        const indexLoaded = originSourcesLoaded ? Promise.resolve() : loadOriginSources();
+        indexLoaded
+            .then(() => (originSourcesLoaded ? loadOriginChapter('globals') : null))
+            .then(() => {
+                const loaded = getOriginChapterContent('globals');
+                if (loaded !== null) {
+                    contentEl.innerHTML = highlightQuantSyntax(loaded);
+                } else {
+                    contentEl.innerHTML = '<span style="color: #f66;">Could not load globals.txt</span>';
+                }
+            });
     }
 
     modal.classList.remove('hidden');
@@ -6601,7 +6635,9 @@ function updateSourceContent(key) {
 
     currentSourceKey = key;
     const chapter = originSources.chapters[key];
-    contentEl.textContent = chapter.content;
+    const content = getOriginChapterContent(key);
+    // Filled in by loadOriginChapter once the text arrives
+    contentEl.textContent = content !== null ? content : 'Loading source...';
     if (headerTitle) {
         headerTitle.textContent = `${chapter.title} Source Code`;
     }
@@ -6774,16 +6810,22 @@ function loadCustomVersions() {
 
 async function loadOriginSources() {
     try {
-        const originResponse = await fetch('origin_text/origin_sources.json');
+        const originResponse = await fetch('origin_text/origin_index.json');
         if (!originResponse.ok) {
             throw new Error(`HTTP ${originResponse.status}`);
         }
         originSources = await originResponse.json();
         originSourcesLoaded = true;
+        originChapterRequests = {};
         sourceParagraphCache = {};
         globalMacrosCache = null;
         versionChapterTextCache = {};
         currentSourceKey = getSourceKeyForChapter(currentChapter);
+        // Every chapter's source view expands macros from globals.txt, so fetch it
+        // alongside the index rather than after the first chapter
+        if (originSources.chapters.globals) {
+            loadOriginChapter('globals');
+        }
         if (originSourcePanelOpen) {
             syncSourceToCurrentChapter();
         }
@@ -6797,6 +6839,58 @@ async function loadOriginSources() {
     }
 }
 
+// Source text for a chapter, or null if it isn't available yet. Asking for a
+// chapter that hasn't been fetched starts fetching it; the views that use it
+// are refreshed when it arrives.
+function getOriginChapterContent(key) {
+    if (!originSourcesLoaded || !originSources || !originSources.chapters[key]) return null;
+    const chapter = originSources.chapters[key];
+    if (typeof chapter.content === 'string') return chapter.content;
+    loadOriginChapter(key);
+    return null;
+}
+
+function loadOriginChapter(key) {
+    if (originChapterRequests[key]) return originChapterRequests[key];
+    const chapter = originSources.chapters[key];
+    // The hash changes whenever the file does, so a cached copy is never stale
+    originChapterRequests[key] = fetch(`origin_text/${chapter.filename}?v=${chapter.hash}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            return response.text();
+        })
+        .then(content => {
+            chapter.content = content;
+            delete sourceParagraphCache[key];
+            if (key === 'globals') {
+                // Anything drawn before this arrived is missing the global macros
+                globalMacrosCache = null;
+                sourceMappingCache.clear();
+                if (originSourcePanelOpen) {
+                    syncSourceToCurrentChapter();
+                }
+                displayComparison();
+                return;
+            }
+            // Chapter source views expand macros defined in globals.txt
+            getOriginChapterContent('globals');
+            sourceMappingCache.clear();
+            if (key === getSourceKeyForChapter(currentChapter)) {
+                if (originSourcePanelOpen) {
+                    syncSourceToCurrentChapter();
+                }
+                displayComparison();
+            }
+        })
+        .catch(error => {
+            // Leave the failed request in place so every redraw doesn't retry it
+            console.error(`Error loading source for ${key}:`, error);
+        });
+    return originChapterRequests[key];
+}
+
 async function loadVariableInfo() {
     try {
         const response = await fetch('extracted_text/variable_info.json');
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Dependency graph between variables, macros, variant sites and chapters.
+
+A variant site is a control sequence, or a macro invocation outside of one,
+whose text can change depending on which variables are set. Each site knows
+the variables it tests directly and the macros it invokes; macros in turn
+test variables and invoke other macros. The graph resolves those edges once
+(so a site that calls {ifLostKeys}, which calls {txt}, depends on everything
+either macro tests) and indexes the result both ways, for queries like "all
+chapters affected by @gayniko" or "all variables that can change paragraph 12
+of chapter16".
+
+build_variable_info.py builds the graph and writes it to
+docs/extracted_text/dependency_graph.json. To query it:
+
+    python3 dependency_graph.py --variable gayniko
+    python3 dependency_graph.py --chapter chapter16 [--paragraph 12]
+
+Paragraphs are counted in the source file, from 0, split on blank lines.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+BASE_DIR = Path(__file__).resolve().parent
+GRAPH_PATH = BASE_DIR / "extracted_text" / "dependency_graph.json"
+
+
+class DependencyGraph:
+
+    def __init__(self, macros: Dict[str, dict], sites: List[dict], chapter_order: List[str]):
+        """macros maps a macro name to {'variables': [...], 'macros': [...]}, the
+        variables and macros its body uses directly. Each site is a dict with
+        'chapter', 'paragraph', 'start', and the 'variables' and 'macros' it
+        uses directly."""
+        self.macros = macros
+        self.chapter_order = chapter_order
+        self.macro_variables: Dict[str, Set[str]] = {}
+        for name in macros:
+            self.variables_for_macro(name, set())
+
+        # Keep only the sites something can actually change
+        self.sites = []
+        for site in sites:
+            resolved = self.resolve(site['variables'], site['macros'])
+            if resolved:
+                self.sites.append(dict(site, id=len(self.sites), resolved=sorted(resolved)))
+
+        self.sites_by_variable: Dict[str, List[int]] = {}
+        self.sites_by_paragraph: Dict[tuple, List[int]] = {}
+        for site in self.sites:
+            for var_name in site['resolved']:
+                self.sites_by_variable.setdefault(var_name, []).append(site['id'])
+            key = (site['chapter'], site['paragraph'])
+            self.sites_by_paragraph.setdefault(key, []).append(site['id'])
+
+    def variables_for_macro(self, name: str, seen: Set[str]) -> Set[str]:
+        """Every variable a macro can depend on, through any macros it calls."""
+        if name in self.macro_variables:
+            return self.macro_variables[name]
+        if name not in self.macros or name in seen:
+            return set()
+        macro = self.macros[name]
+        found = self.resolve(macro['variables'], macro['macros'], seen | {name})
+        self.macro_variables[name] = found
+        return found
+
+    def resolve(self, variables: Iterable[str], macros: Iterable[str], seen: Optional[Set[str]] = None) -> Set[str]:
+        found = set(variables)
+        for name in macros:
+            found |= self.variables_for_macro(name, seen or set())
+        return found
+
+    def chapter_sort_key(self, chapter_id: str) -> int:
+        if chapter_id in self.chapter_order:
+            return self.chapter_order.index(chapter_id)
+        return len(self.chapter_order)
+
+    # Queries
+
+    def sites_affected_by(self, var_name: str) -> List[dict]:
+        return [self.sites[i] for i in self.sites_by_variable.get(var_name, [])]
+
+    def chapters_affected_by(self, var_name: str) -> List[str]:
+        chapters = {site['chapter'] for site in self.sites_affected_by(var_name)}
+        return sorted(chapters, key=self.chapter_sort_key)
+
+    def macros_using(self, var_name: str) -> List[str]:
+        return sorted(name for name, found in self.macro_variables.items() if var_name in found)
+
+    def variables_affecting(self, chapter_id: str, paragraph: Optional[int] = None) -> List[str]:
+        """Variables that can change a paragraph, or anywhere in a chapter if
+        no paragraph is given."""
+        found = set()
+        for (site_chapter, site_paragraph), ids in self.sites_by_paragraph.items():
+            if site_chapter != chapter_id:
+                continue
+            if paragraph is not None and site_paragraph != paragraph:
+                continue
+            for i in ids:
+                found.update(self.sites[i]['resolved'])
+        return sorted(found)
+
+    # Persistence
+
+    def to_json(self) -> dict:
+        return {
+            'chapter_order': self.chapter_order,
+            'macros': {
+                name: dict(macro, resolved=sorted(self.macro_variables.get(name, ())))
+                for name, macro in sorted(self.macros.items())
+            },
+            'sites': [
+                {key: site[key] for key in ('chapter', 'paragraph', 'start', 'variables', 'macros', 'resolved')}
+                for site in self.sites
+            ],
+            'variable_chapters': {
+                var_name: self.chapters_affected_by(var_name)
+                for var_name in sorted(self.sites_by_variable)
+            },
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'DependencyGraph':
+        macros = {
+            name: {'variables': macro['variables'], 'macros': macro['macros']}
+            for name, macro in data['macros'].items()
+        }
+        return cls(macros, data['sites'], data['chapter_order'])
+
+    def save(self, path: Path = GRAPH_PATH) -> None:
+        path.parent.mkdir(exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_json(), f, indent=1, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: Path = GRAPH_PATH) -> 'DependencyGraph':
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_json(json.load(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the variable dependency graph.")
+    parser.add_argument('--variable', help="list the chapters, macros and sites affected by a variable")
+    parser.add_argument('--chapter', help="list the variables that can change a chapter")
+    parser.add_argument('--paragraph', type=int, help="with --chapter, only this source paragraph")
+    args = parser.parse_args()
+
+    if not GRAPH_PATH.exists():
+        raise SystemExit(f"{GRAPH_PATH} not found: run build_variable_info.py first")
+    graph = DependencyGraph.load()
+
+    if args.variable:
+        var_name = args.variable.lstrip('@')
+        sites = graph.sites_affected_by(var_name)
+        print(f"@{var_name}: {len(sites)} sites")
+        print(f"  chapters: {', '.join(graph.chapters_affected_by(var_name)) or '(none)'}")
+        print(f"  macros: {', '.join(graph.macros_using(var_name)) or '(none)'}")
+        for site in sites:
+            print(f"  {site['chapter']} paragraph {site['paragraph']} (offset {site['start']})")
+    elif args.chapter:
+        where = args.chapter if args.paragraph is None else f"{args.chapter} paragraph {args.paragraph}"
+        found = graph.variables_affecting(args.chapter, args.paragraph)
+        print(f"{where}: {', '.join('@' + v for v in found) or '(no variables)'}")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
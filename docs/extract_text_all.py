@@ -161,11 +161,19 @@ def find_epub_files(base_dir):
     return sorted(epub_files, key=lambda x: x[1])
 
 
-def extract_all_versions():
-    """Extract all sections from all EPUB versions."""
+def extract_all_versions(base_dir=None, output_dir=None):
+    """Extract all sections from all EPUB versions.
 
-    base_dir = Path(__file__).parent.parent / 'sources' / 'subcutaneans'
-    output_dir = Path(__file__).parent / 'extracted_text'
+    Reads sources/subcutaneans and writes to extracted_text unless other
+    directories are given (benchmarks.py extracts into a scratch directory).
+    """
+
+    if base_dir is None:
+        base_dir = Path(__file__).parent.parent / 'sources' / 'subcutaneans'
+    if output_dir is None:
+        output_dir = Path(__file__).parent / 'extracted_text'
+    base_dir = Path(base_dir)
+    output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True)
 
     # Find all EPUB files (supports direct files or subfolders)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Tokenizer for Quant source files (the syntax described in
+sources/source_code/collapser-syntax.txt), shared by the doc-build scripts.
+
+tokenize() makes a single left-to-right pass over a file and returns a flat
+list of typed nodes:
+
+    Comment          a line starting with #
+    Text             plain text between other nodes
+    Macro            a {macro} / {format/param/...} block or a $macro reference
+    Sequence         a [control sequence] of pipe-separated alternatives
+    Define           [DEFINE ...]
+    MacroDefinition  [MACRO name][body] or [STICKY_MACRO name][body]
+    Label            [LABEL name]
+
+Each node records its start offset in the source. Alternatives inside a
+sequence or DEFINE are parsed into their parts (~ always, 80> probability,
+^ author-preferred, @variable or @variable> condition) and their text is split
+into Text and Macro parts, so callers never need to re-scan the raw source.
+Malformed input (an unclosed bracket or brace) is kept as plain text rather
+than raising, since these scripts only report on the source.
+"""
+
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Union
+
+# Next thing that isn't plain text: a comment at the start of a line, a
+# control sequence, a brace block, or a $macro reference.
+SPECIAL_RE = re.compile(r"^#|[\[{]|\$(?=[A-Za-z_])", re.M)
+DOLLAR_MACRO_RE = re.compile(r"\$([A-Za-z_][\w\-]*)")
+INLINE_RE = re.compile(r"\{([^{}]*)\}|\$([A-Za-z_][\w\-]*)")
+LABEL_RE = re.compile(r"\*(\w+)\*")
+ALTERNATIVE_RE = re.compile(
+    r"(~)?(?:(\d+)>)?(\^)?(?:@([A-Za-z_][\w\-]*)(>)?)?", re.S
+)
+HEADER_RE = re.compile(r"(DEFINE|MACRO|STICKY_MACRO|LABEL)\s+(.*)$", re.S)
+
+
+@dataclass
+class Text:
+    start: int
+    text: str
+
+
+@dataclass
+class Comment:
+    start: int
+    text: str  # without the leading #
+
+
+@dataclass
+class Macro:
+    start: int
+    name: str
+    params: List[str] = field(default_factory=list)
+    dollar: bool = False  # written as $name rather than {name}
+
+
+@dataclass
+class Alternative:
+    start: int
+    text: str  # the content after any ~, 80>, ^ and @var> prefixes
+    parts: List[Union[Text, Macro]]
+    probability: Optional[int] = None
+    preferred: bool = False
+    always: bool = False
+    variable: Optional[str] = None
+    conditional: bool = False  # @var>text rather than a bare @var
+
+    @property
+    def macros(self) -> List[Macro]:
+        return [part for part in self.parts if isinstance(part, Macro)]
+
+
+@dataclass
+class Sequence:
+    start: int
+    end: int
+    alternatives: List[Alternative]
+    label: Optional[str] = None
+
+    @property
+    def variables(self) -> List[str]:
+        return [alt.variable for alt in self.alternatives if alt.variable]
+
+
+@dataclass
+class Define:
+    start: int
+    end: int
+    raw: str  # everything after DEFINE, as written
+    alternatives: List[Alternative]
+
+    @property
+    def variables(self) -> List[str]:
+        return [alt.variable for alt in self.alternatives if alt.variable]
+
+
+@dataclass
+class MacroDefinition:
+    start: int
+    end: int
+    name: str
+    sticky: bool
+    body: Optional[Sequence]
+
+
+@dataclass
+class Label:
+    start: int
+    end: int
+    name: str
+
+
+Node = Union[Text, Comment, Macro, Sequence, Define, MacroDefinition, Label]
+
+
+def tokenize(source: str) -> List[Node]:
+    """Split Quant source into a flat list of nodes, in source order."""
+    nodes: List[Node] = []
+    pos = 0
+    text_start = 0
+    pending_macro: Optional[tuple] = None  # (name, sticky, start, end) of a MACRO header
+    length = len(source)
+
+    def flush(upto: int) -> None:
+        if upto > text_start:
+            nodes.append(Text(text_start, source[text_start:upto]))
+
+    while pos < length:
+        match = SPECIAL_RE.search(source, pos)
+        if match is None:
+            break
+        start = match.start()
+        char = source[start]
+
+        if pending_macro is not None and char != "[":
+            # A macro header not directly followed by its body
+            name, sticky, header_start, header_end = pending_macro
+            nodes.append(MacroDefinition(header_start, header_end, name, sticky, None))
+            pending_macro = None
+
+        if char == "#":
+            end = source.find("\n", start)
+            if end < 0:
+                end = length
+            flush(start)
+            nodes.append(Comment(start, source[start + 1:end]))
+            pos = text_start = end
+            continue
+
+        if char == "$":
+            macro_match = DOLLAR_MACRO_RE.match(source, start)
+            flush(start)
+            nodes.append(Macro(start, macro_match.group(1), dollar=True))
+            pos = text_start = macro_match.end()
+            continue
+
+        close = source.find("]" if char == "[" else "}", start + 1)
+        if close < 0:
+            pos = start + 1
+            continue
+
+        if char == "{":
+            flush(start)
+            nodes.append(parse_braces(source[start + 1:close], start))
+            pos = text_start = close + 1
+            continue
+
+        body = source[start + 1:close]
+        node = parse_control_sequence(body, start, close + 1)
+
+        if pending_macro is not None:
+            name, sticky, header_start, header_end = pending_macro
+            pending_macro = None
+            if isinstance(node, Sequence) and source[header_end:start].strip() == "":
+                nodes.append(MacroDefinition(header_start, close + 1, name, sticky, node))
+                pos = text_start = close + 1
+                continue
+            nodes.append(MacroDefinition(header_start, header_end, name, sticky, None))
+            text_start = header_end
+
+        flush(start)
+        if isinstance(node, tuple):
+            name, sticky = node
+            pending_macro = (name, sticky, start, close + 1)
+        else:
+            nodes.append(node)
+        pos = text_start = close + 1
+
+    if pending_macro is not None:
+        name, sticky, header_start, header_end = pending_macro
+        nodes.append(MacroDefinition(header_start, header_end, name, sticky, None))
+    flush(length)
+    return nodes
+
+
+def parse_braces(body: str, start: int) -> Macro:
+    """{name} or {name/param/param...}: a macro or formatting code."""
+    name, *params = body.split("/")
+    return Macro(start, name.strip(), params)
+
+
+def parse_control_sequence(body: str, start: int, end: int):
+    """Parse the contents of [ ... ].
+
+    Returns a node, or (name, sticky) for a MACRO header, whose body is the
+    next control sequence.
+    """
+    header = HEADER_RE.match(body)
+    if header:
+        keyword, rest = header.group(1), header.group(2)
+        if keyword == "DEFINE":
+            return Define(start, end, rest, parse_alternatives(rest, start + 1 + header.start(2)))
+        if keyword == "LABEL":
+            return Label(start, end, rest.strip())
+        return (rest.strip(), keyword == "STICKY_MACRO")
+
+    offset = start + 1
+    label = None
+    label_match = LABEL_RE.match(body)
+    if label_match:
+        label = label_match.group(1)
+        offset += label_match.end()
+        body = body[label_match.end():]
+    return Sequence(start, end, parse_alternatives(body, offset), label)
+
+
+def parse_alternatives(body: str, offset: int) -> List[Alternative]:
+    alternatives = []
+    for piece in split_alternatives(body):
+        piece_start = offset
+        offset += len(piece) + 1
+        prefix = ALTERNATIVE_RE.match(piece)
+        text = piece[prefix.end():]
+        text_offset = piece_start + prefix.end()
+        alternatives.append(Alternative(
+            start=piece_start,
+            text=text,
+            parts=list(inline_parts(text, text_offset)),
+            probability=int(prefix.group(2)) if prefix.group(2) else None,
+            preferred=bool(prefix.group(3)),
+            always=bool(prefix.group(1)),
+            variable=prefix.group(4),
+            conditional=bool(prefix.group(5)),
+        ))
+    return alternatives
+
+
+def split_alternatives(body: str) -> List[str]:
+    """Split on | outside of {braces}."""
+    pieces = []
+    depth = 0
+    last = 0
+    for pos, char in enumerate(body):
+        if char == "{":
+            depth += 1
+        elif char == "}" and depth > 0:
+            depth -= 1
+        elif char == "|" and depth == 0:
+            pieces.append(body[last:pos])
+            last = pos + 1
+    pieces.append(body[last:])
+    return pieces
+
+
+def inline_parts(text: str, offset: int) -> Iterator[Union[Text, Macro]]:
+    """Split alternative text into Text and Macro parts."""
+    pos = 0
+    for match in INLINE_RE.finditer(text):
+        if match.start() > pos:
+            yield Text(offset + pos, text[pos:match.start()])
+        if match.group(1) is not None:
+            yield parse_braces(match.group(1), offset + match.start())
+        else:
+            yield Macro(offset + match.start(), match.group(2), dollar=True)
+        pos = match.end()
+    if pos < len(text):
+        yield Text(offset + pos, text[pos:])
+
+
+def macro_references(node: Node) -> Iterator[Macro]:
+    """Every macro or formatting code used by a node, including inside alternatives."""
+    if isinstance(node, Macro):
+        yield node
+    elif isinstance(node, (Sequence, Define)):
+        for alt in node.alternatives:
+            yield from alt.macros
+    elif isinstance(node, MacroDefinition) and node.body is not None:
+        yield from macro_references(node.body)
+
+
+def variable_references(node: Node) -> Iterator[str]:
+    """Every @variable a node tests or defines."""
+    if isinstance(node, (Sequence, Define)):
+        yield from node.variables
+    elif isinstance(node, MacroDefinition) and node.body is not None:
+        yield from node.body.variables
@@ -0,0 +1,117 @@
+# Optional on-disk cache of finished books (collapser.py --cacheDir), so a repeated or retried order for the same edition copies the existing PDF/EPUB back into place instead of collapsing and rendering again. Entries are addressed by a hash of everything that decides the output (see collapser.artifactKey), including the source text and this code, so editing either simply misses the cache. Each entry is a directory of files named by role ("pdf", "epub"), plus an info.json; its mtime is touched on every use, and the least recently used entries are removed once the cache grows past its size limit.
+
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+cacheDir = None
+DEFAULT_MAX_BYTES = 2048 * 1024 * 1024
+maxBytes = DEFAULT_MAX_BYTES
+codeHashValue = None
+# Entries can be stored and restored from different threads.
+lock = threading.Lock()
+
+
+def enable(path, sizeMB = None):
+	global cacheDir, maxBytes
+	cacheDir = path if path.endswith("/") else path + "/"
+	if sizeMB is not None:
+		maxBytes = sizeMB * 1024 * 1024
+	if not os.path.isdir(cacheDir):
+		os.makedirs(cacheDir)
+
+# Turn the cache off again, e.g. between jobs run in the same process (see genservice.py).
+def disable():
+	global cacheDir, maxBytes
+	cacheDir = None
+	maxBytes = DEFAULT_MAX_BYTES
+
+def isEnabled():
+	return cacheDir is not None
+
+def makeKey(fields):
+	return hashlib.sha1(json.dumps(fields, sort_keys = True)).hexdigest()
+
+def contentHash(texts):
+	h = hashlib.sha1()
+	for text in texts:
+		h.update(hashlib.sha1(text).digest())
+	return h.hexdigest()
+
+def fileHash(paths):
+	return contentHash([open(path, "rb").read() for path in paths])
+
+# The Python files alongside this one: a change to the collapser or any renderer means a different book.
+def codeHash():
+	global codeHashValue
+	if codeHashValue is None:
+		codeHashValue = fileHash(sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))))
+	return codeHashValue
+
+# Copy a cached entry's files to the given paths ({role: path}) and return the info it was stored with. Returns None, copying nothing, unless every role is cached.
+def restore(key, paths):
+	if cacheDir is None:
+		return None
+	with lock:
+		return restoreEntry(key, paths)
+
+def restoreEntry(key, paths):
+	entry = cacheDir + key
+	if not os.path.isdir(entry):
+		return None
+	for role in paths:
+		if not os.path.isfile(os.path.join(entry, role)):
+			return None
+	for role, path in paths.items():
+		shutil.copyfile(os.path.join(entry, role), path)
+	os.utime(entry, None)
+	with open(os.path.join(entry, "info.json")) as f:
+		return json.load(f)["info"] or {}
+
+# Add files ({role: path}) to the cache under key, replacing any entry already there.
+def store(key, paths, info = None):
+	if cacheDir is None:
+		return
+	with lock:
+		storeEntry(key, paths, info)
+
+def storeEntry(key, paths, info):
+	entry = cacheDir + key
+	tmp = "%s.tmp-%d" % (entry, os.getpid())
+	if os.path.isdir(tmp):
+		shutil.rmtree(tmp)
+	os.makedirs(tmp)
+	for role, path in paths.items():
+		shutil.copyfile(path, os.path.join(tmp, role))
+	with open(os.path.join(tmp, "info.json"), "w") as f:
+		json.dump({"stored": time.time(), "files": paths, "info": info}, f, indent = 1, sort_keys = True)
+	if os.path.isdir(entry):
+		shutil.rmtree(entry)
+	os.rename(tmp, entry)
+	evict()
+
+def entrySize(entry):
+	return sum([os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry)])
+
+# Remove least recently used entries until the cache fits in maxBytes.
+def evict():
+	entries = []
+	for name in os.listdir(cacheDir):
+		entry = cacheDir + name
+		if os.path.isdir(entry) and name.find(".tmp-") < 0:
+			try:
+				entries.append((os.path.getmtime(entry), entrySize(entry), entry))
+			except OSError:
+				# Removed by another process sharing the cache.
+				continue
+	entries.sort()
+	total = sum([size for mtime, size, entry in entries])
+	while total > maxBytes and len(entries) > 1:
+		mtime, size, entry = entries.pop(0)
+		shutil.rmtree(entry, ignore_errors = True)
+		total -= size
+		print "Removed %s from the artifact cache (%d bytes)" % (entry, size)
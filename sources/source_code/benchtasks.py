@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# coding=utf-8
+
+# The Python 2 half of the benchmark suite (see docs/benchmarks.py, which runs this). Times one task a number of times on the data bundled with the repository and prints the results as a single line of JSON: {"task", "times", "info"}.
+
+#   collapse    Collapse the whole book in docs/origin_text with a fixed seed
+#   differ      differ.getTwoLeastSimilar over N extracted versions of a chapter
+#   discourse   discourseVars.getDiscoursePreferredVersion over every control sequence in docs/origin_text, with every discourse variable set
+
+import os
+import sys
+import time
+import glob
+import json
+import getopt
+import re
+from StringIO import StringIO
+
+here = os.path.dirname(os.path.abspath(__file__))
+docsDir = os.path.join(here, "..", "..", "docs")
+originDir = os.path.join(docsDir, "origin_text") + "/"
+extractedDir = os.path.join(docsDir, "extracted_text")
+
+# Exit status for a task whose dependencies aren't installed, so the harness can skip it rather than fail.
+MISSING_DEPENDENCY = 3
+
+DISCOURSE_VARS = ["wordy", "succinct", "bigwords", "slang", "formal", "alliteration", "noalliteration", "avoidme", "likesimile", "dislikesimile", "avoiddialogue", "depressive", "optimist", "subjective", "objective"]
+
+
+def showUsage():
+	print """Usage: python2.7 benchtasks.py options task
+Tasks: collapse, differ, discourse
+Arguments:
+  --help              Show this message
+  --repeat=N          Times to run the task (default 3)
+  --seed=x            Seed for collapse (default 45443)
+  --candidates=N      Versions for differ (default 6)
+  --chapter=x         Chapter for differ (default prologue)
+"""
+
+
+def main():
+	repeat = 3
+	seed = 45443
+	candidates = 6
+	chapter = "prologue"
+
+	opts, args = getopt.getopt(sys.argv[1:], "", ["help", "repeat=", "seed=", "candidates=", "chapter="])
+	if len(args) != 1 or args[0] not in tasks:
+		showUsage()
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt == "--help":
+			showUsage()
+			sys.exit()
+		elif opt == "--repeat":
+			repeat = int(arg)
+		elif opt == "--seed":
+			seed = int(arg)
+		elif opt == "--candidates":
+			candidates = int(arg)
+		elif opt == "--chapter":
+			chapter = arg
+
+	task = args[0]
+	try:
+		times, info = timeTask(task, repeat, seed = seed, candidates = candidates, chapter = chapter)
+	except ImportError as e:
+		if not isMissingModule(e):
+			raise
+		print >> sys.stderr, "Missing dependency: %s" % e
+		sys.exit(MISSING_DEPENDENCY)
+	print json.dumps({"task": task, "times": times, "info": info})
+
+def timeTask(task, repeat, **options):
+	setup, run = tasks[task]
+	state = setup(**options)
+	times = []
+	for x in range(repeat):
+		# The tasks print as they go; keep that out of the result.
+		savedStdout = sys.stdout
+		sys.stdout = StringIO()
+		started = time.time()
+		try:
+			info = run(state)
+		finally:
+			sys.stdout = savedStdout
+		times.append(time.time() - started)
+	return times, info
+
+# An import of a module that isn't installed (or isn't in this tree), as opposed to a broken import from one that is.
+def isMissingModule(e):
+	m = re.match(r"No module named (\S+)", str(e))
+	return m is not None and not os.path.exists(os.path.join(here, m.group(1).split(".")[0] + ".py"))
+
+
+# collapse
+
+def setupCollapse(seed, **kwargs):
+	import fileio
+	import filecache
+	import hasher
+	import quantparse
+	fileList = fileio.getFilesFromManifest(filecache.readInputFile(originDir + "manifest.txt"))
+	fileContents = filecache.loadManifestFromFileList(originDir, fileList)
+	params = quantparse.ParseParams(chooseStrategy = "random", setDefines = [], doConfirm = False, discourseVarChance = 80, onlyShow = [], endMatter = [])
+	params.fileSetKey = hasher.hash(''.join(fileList))
+	return {"seed": seed, "fileContents": fileContents, "params": params}
+
+def runCollapse(state):
+	import chooser
+	import collapse
+	chooser.setSeed(state["seed"])
+	chooser.resetAllIters()
+	res = collapse.go(state["fileContents"], ''.join(state["fileContents"]), state["params"])
+	if not res.isValid:
+		raise ValueError(str(res))
+	return {"seed": state["seed"], "characters": len(res.package)}
+
+
+# differ
+
+def setupDiffer(candidates, chapter, **kwargs):
+	texts = []
+	for path in sorted(glob.glob(os.path.join(extractedDir, "version_*.json")))[:candidates]:
+		with open(path) as f:
+			texts.append("\n".join(json.load(f).get(chapter, [])))
+	if len(texts) < 3:
+		raise ValueError("differ needs at least 3 versions in %s" % extractedDir)
+	return {"texts": texts, "chapter": chapter}
+
+def runDiffer(state):
+	import differ
+	pair = differ.getTwoLeastSimilar(state["texts"])
+	return {"candidates": len(state["texts"]), "chapter": state["chapter"], "pair": list(pair)}
+
+
+# discourse
+
+class Alternatives:
+	def __init__(self, texts):
+		self.alts = [Alternative(txt) for txt in texts]
+	def getLongest(self):
+		return max([alt.txt for alt in self.alts], key = len)
+	def getShortest(self):
+		return min([alt.txt for alt in self.alts], key = len)
+
+class Alternative:
+	def __init__(self, txt):
+		self.txt = txt
+
+class DiscourseVars:
+	def check(self, name):
+		return name in DISCOURSE_VARS
+
+def setupDiscourse(**kwargs):
+	import fileio
+	import filecache
+	import variantsites
+	import provenance
+	seqs = []
+	for name in fileio.getFilesFromManifest(filecache.readInputFile(originDir + "manifest.txt")):
+		text = variantsites.blankComments(filecache.readInputFile(originDir + name))
+		for m in variantsites.ctrlSeqRegex.finditer(text):
+			if provenance.headerRegex.match(m.group(1)):
+				continue
+			body = text[m.start() + 1:m.end() - 1]
+			label = provenance.labelRegex.match(body)
+			start = label.end() if label else 0
+			alts = [body[a:b] for a, b in provenance.splitAlternatives(body, start)]
+			alts = [alt[provenance.prefixRegex.match(alt).end():] for alt in alts]
+			alts = [alt for alt in alts if alt.strip() != ""]
+			if len(alts) > 0:
+				seqs.append(alts)
+	return {"seqs": seqs}
+
+def runDiscourse(state):
+	import chooser
+	import discourseVars
+	chooser.setSeed(1)
+	discourseVars.resetStats()
+	dvars = DiscourseVars()
+	for alts in state["seqs"]:
+		discourseVars.getDiscoursePreferredVersion(Alternatives(alts), dvars)
+	return {"sequences": len(state["seqs"])}
+
+
+tasks = {
+	"collapse": (setupCollapse, runCollapse),
+	"differ": (setupDiffer, runDiffer),
+	"discourse": (setupDiscourse, runDiscourse)
+}
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# coding=utf-8
+
+# Serves any seed's chapter on demand, so the variorum can browse seeds nobody has extracted from an EPUB. The source is read and lexed once at startup (the "program"); each request then registers the seed's variables from those tokens and collapses just the one chapter, the same way --only=<chapter> does. Recently requested chapters are kept in an LRU cache.
+
+# Note that, as with --only, a chapter is collapsed as if it were the only one selected: the seed's variables are the ones its full book uses, but the chapter's own alternatives are drawn from the start of the random stream rather than where the full book would be by then. With --chapterStreams each chapter has its own stream (see collapse.goSubstreams), so a served chapter is exactly that chapter of the seed's book collapsed with collapser.py --chapterStreams.
+
+# GET /chapters                      The chapter names, in order
+# GET /chapter?seed=x&chapter=ch16   {"seed", "chapter", "text", "paragraphs", "variables"}
+
+import sys
+import getopt
+import json
+import urlparse
+import BaseHTTPServer
+from collections import OrderedDict
+
+import fileio
+import filecache
+import quantlex
+import quantparse
+import chooser
+import hasher
+import variables
+import collapse
+
+
+def showUsage():
+	print """Usage: python2.7 chapterserver.py options
+Arguments:
+  --help              Show this message
+  --input=x,y,z       Alternate file(s) or manifest file(s) to load
+                        (default: full-book-manifest.txt)
+  --port=x            Serve chapters over HTTP on this port (default: 8000)
+  --seed=x            Instead of serving, print this seed's chapter...
+  --chapter=x         ...with this name (e.g. ch16)
+  --cacheSize=x       Number of collapsed chapters to keep (default: 128)
+  --chapterStreams    Collapse chapters in their own random streams, as
+                        collapser.py --chapterStreams does
+"""
+
+
+def main():
+	inputFiles = ["full-book-manifest.txt"]
+	inputFileDir = "chapters/"
+	port = 8000
+	seed = -1
+	chapter = ""
+	cacheSize = 128
+	chapterStreams = False
+
+	opts, args = getopt.getopt(sys.argv[1:], "", ["help", "input=", "port=", "seed=", "chapter=", "cacheSize=", "chapterStreams"])
+	if len(args) > 0:
+		print "Unrecognized arguments: %s" % args
+		sys.exit()
+	for opt, arg in opts:
+		if opt == "--input":
+			inputFiles = arg.split(',')
+		elif opt == "--help":
+			showUsage()
+			sys.exit()
+		elif opt in ["--port", "--seed", "--cacheSize"]:
+			try:
+				value = int(arg)
+			except:
+				print "Invalid %s parameter '%s': must be an integer." % (opt, arg)
+				sys.exit()
+			if opt == "--port":
+				port = value
+			elif opt == "--seed":
+				seed = value
+			elif value < 1:
+				print "Invalid --cacheSize parameter '%s': must be at least 1." % arg
+				sys.exit()
+			else:
+				cacheSize = value
+		elif opt == "--chapter":
+			chapter = arg
+		elif opt == "--chapterStreams":
+			chapterStreams = True
+
+	program = Program(inputFiles, inputFileDir, chapterStreams)
+	chapters = ChapterCache(program, cacheSize)
+
+	if seed != -1 or chapter != "":
+		if seed == -1 or chapter == "":
+			print "--seed and --chapter must be used together."
+			sys.exit()
+		if program.findChapter(chapter) is None:
+			print "Unknown chapter '%s'; chapters are: %s" % (chapter, ", ".join(program.chapterNames()))
+			sys.exit()
+		print chapters.get(seed, chapter)["text"]
+		return
+
+	serve(chapters, port)
+
+
+# The source files, lexed once.
+class Program:
+
+	def __init__(self, inputFiles, inputFileDir, chapterStreams = False):
+		self.chapterStreams = chapterStreams
+		self.fileList = []
+		self.fileContents = []
+		for iFile in inputFiles:
+			inputText = filecache.readInputFile(inputFileDir + iFile)
+			if inputText[:10] == "# MANIFEST":
+				names = fileio.getFilesFromManifest(inputText)
+				self.fileList.extend(names)
+				self.fileContents.extend(filecache.loadManifestFromFileList(inputFileDir, names))
+			else:
+				self.fileList.append(iFile)
+				self.fileContents.append(fileio.getFileId(iFile) + inputText)
+		self.fileSetKey = hasher.hash(''.join(self.fileList))
+		result = collapse.lexChunks(self.fileContents)
+		if not result.isValid:
+			print result
+			sys.exit()
+		self.tokens = result.package
+		self.chapterTokens = {}
+
+	def chapterNames(self):
+		return [name.replace(".txt", "") for name in self.fileList]
+
+	# The position of a chapter given as "ch16" or "ch16.txt", or None.
+	def findChapter(self, name):
+		if name in self.fileList:
+			return self.fileList.index(name)
+		if name in self.chapterNames():
+			return self.chapterNames().index(name)
+		return None
+
+	def collapseChapter(self, seed, name):
+		pos = self.findChapter(name)
+		text = self.fileContents[pos]
+		params = quantparse.ParseParams(chooseStrategy = "random", setDefines = [], doConfirm = False, discourseVarChance = 80, onlyShow = [self.fileList[pos]], endMatter = [])
+		params.fileSetKey = self.fileSetKey
+		chooser.setSeed(seed)
+		chooser.resetAllIters()
+		if self.chapterStreams:
+			res = collapse.goSubstreamTokens(self.tokens, self.fileContents, [text], [self.fileList[pos]], params)
+		else:
+			# Copies, since defining and stripping work through the token lists.
+			res = collapse.goTokens(list(self.tokens), list(self.lexChapter(pos)), text, params)
+		if not res.isValid:
+			raise ValueError(str(res))
+		return res.package, sorted([v for v in variables.showVars() if v != ""])
+
+
+	def lexChapter(self, pos):
+		if pos not in self.chapterTokens:
+			result = quantlex.lex(self.fileContents[pos])
+			if not result.isValid:
+				raise ValueError(str(result))
+			self.chapterTokens[pos] = result.package
+		return self.chapterTokens[pos]
+
+
+# The most recently requested chapters, keyed by (seed, chapter).
+class ChapterCache:
+
+	def __init__(self, program, size):
+		self.program = program
+		self.size = size
+		self.entries = OrderedDict()
+
+	def get(self, seed, name):
+		key = (seed, self.program.fileList[self.program.findChapter(name)])
+		if key in self.entries:
+			entry = self.entries.pop(key)
+		else:
+			text, setVars = self.program.collapseChapter(seed, name)
+			entry = {
+				"seed": seed,
+				"chapter": key[1].replace(".txt", ""),
+				"text": text,
+				"paragraphs": [para.strip() for para in text.split("\n\n") if para.strip() != ""],
+				"variables": setVars
+			}
+			if len(self.entries) >= self.size:
+				self.entries.popitem(last = False)
+		self.entries[key] = entry
+		return entry
+
+
+# Collapsing uses module-level state (variables, macros, the random stream), so requests are handled one at a time.
+def serve(chapters, port):
+	ChapterRequestHandler.chapters = chapters
+	server = BaseHTTPServer.HTTPServer(("", port), ChapterRequestHandler)
+	print "Serving %d chapters on port %d" % (len(chapters.program.fileList), port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+class ChapterRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	chapters = None
+
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		query = urlparse.parse_qs(url.query)
+		program = self.chapters.program
+		if url.path == "/chapters":
+			self.respond(200, {"chapters": program.chapterNames()})
+		elif url.path == "/chapter":
+			try:
+				seed = int(query["seed"][0])
+				name = query["chapter"][0]
+			except (KeyError, ValueError):
+				self.respond(400, {"error": "seed (an integer) and chapter are required"})
+				return
+			if program.findChapter(name) is None:
+				self.respond(404, {"error": "unknown chapter '%s'" % name})
+				return
+			try:
+				self.respond(200, self.chapters.get(seed, name))
+			except Exception as e:
+				self.respond(500, {"error": "%s: %s" % (type(e).__name__, e)})
+		else:
+			self.respond(404, {"error": "not found"})
+
+	def respond(self, status, data):
+		body = json.dumps(data)
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json; charset=utf-8")
+		self.send_header("Access-Control-Allow-Origin", "*")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+if __name__ == "__main__":
+	main()
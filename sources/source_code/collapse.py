@@ -4,50 +4,265 @@
 
 
 
+import os
+import re
+import cPickle
+import hashlib
+import multiprocessing
+import time
+
 import quantlex
 import quantparse
 import variables
 import macros
 import chooser
+import variantsites
+import optimizer
+import provenance
+import profiler
+import discourseVars
 
 
-# Main entry point.
-def go(fullText, selectedText, params, returnTokensOnly = False):
+# Main entry point. fullTexts is the list of every loaded file's contents, which are lexed one at a time rather than joined into one big string; they're only used for their variable and macro definitions.
+# If the texts were marked with a provenance.SourceMap, pass it as sourceMap: the markers are stripped from the rendered text and the result gets a .provenance map of where each span came from.
+def go(fullTexts, selectedText, params, returnTokensOnly = False, sourceMap = None):
 
     # Lex the full input text.
-    result = quantlex.lex(fullText)
+    with profiler.phase("lex"):
+        result = lexChunks(fullTexts)
     if not result.isValid:
     	return result
     tokens = result.package
 
     # Calculate and pre-set variables for Longest/Shortest case.
-    if params.chooseStrategy in ["longest", "shortest"]:
-        params.setDefines = getDefinesForLongestShortest(tokens, params)
+    presetLongestShortest(tokens, fullTexts, params, sourceMap)
+
+    # Now re-lex the selection we want to render.
+    with profiler.phase("lex"):
+        result = quantlex.lex(selectedText)
+    if not result.isValid:
+        return result
+    return goTokens(tokens, result.package, selectedText, params, returnTokensOnly, sourceMap)
+
+# The rest of go(), for callers that lex once and collapse many times (see chapterserver.py): fullTokens and selectedTokens are the lexed full text and selection.
+def goTokens(fullTokens, selectedTokens, selectedText, params, returnTokensOnly = False, sourceMap = None):
 
     # Register all the variables and macros from the full text.
     variables.reset()
     macros.reset()        
-    variables.handleDefs(tokens, params)
-    macros.handleDefs(tokens, params)
+    with profiler.phase("handleDefs"):
+        variables.handleDefs(fullTokens, params)
+        macros.handleDefs(fullTokens, params)
 
-    # Now re-lex the selection we want to render, and strip variable/macro defs.
-    result = quantlex.lex(selectedText)
-    if not result.isValid:
-        return result
-    tokens = result.package
-    preppedTokens = variables.stripDefs(tokens, params)
-    preppedTokens = macros.stripMacros(preppedTokens, params)
+    # Strip variable/macro defs from the selection.
+    with profiler.phase("strip"):
+        preppedTokens = variables.stripDefs(selectedTokens, params)
+        preppedTokens = macros.stripMacros(preppedTokens, params)
     if returnTokensOnly:
         return preppedTokens
 
     # And finally, parse and render the selection.
-    rendered = quantparse.parse(preppedTokens, selectedText, params)
+    with profiler.phase("parse"):
+        rendered = quantparse.parse(preppedTokens, selectedText, params)
     print "\nvars: %s\n" % sorted(variables.showVars())
+    return extractProvenance(rendered, sourceMap)
+
+def presetLongestShortest(tokens, fullTexts, params, sourceMap):
+    if params.chooseStrategy in ["longest", "shortest"]:
+        if sourceMap is None:
+            params.setDefines = getDefinesForLongestShortest(tokens, fullTexts, params)
+        else:
+            # Measure lengths without the markers.
+            plainTexts = [provenance.strip(text) for text in fullTexts]
+            params.setDefines = getDefinesForLongestShortest(lexChunks(plainTexts).package, plainTexts, params)
+
+
+# Chapter substreams (collapser.py --chapterStreams). Rather than one random stream consumed front to back, each selected file draws from its own stream, seeded from the book's stream base and the file's name, so a chapter's text doesn't depend on anything before it: chapters can be collapsed in parallel, or one at a time on their own, and give the same result. Variables and sticky macros are still settled on the main stream first, so a seed sets the same variables either way and a sticky macro keeps one value across the whole book; each chapter then starts from a copy of that state.
+
+stickyMacroRegex = re.compile(r"\[STICKY_MACRO\s+([^\]]+)\]")
+
+# Same as go(), with the selection given as separate texts (and their names) collapsed in their own substreams, using up to workers processes.
+def goSubstreams(fullTexts, selectedTexts, selectedNames, params, workers = 1, sourceMap = None):
+    with profiler.phase("lex"):
+        result = lexChunks(fullTexts)
+    if not result.isValid:
+        return result
+    tokens = result.package
+    presetLongestShortest(tokens, fullTexts, params, sourceMap)
+    return goSubstreamTokens(tokens, fullTexts, selectedTexts, selectedNames, params, workers, sourceMap)
+
+def goSubstreamTokens(fullTokens, fullTexts, selectedTexts, selectedNames, params, workers = 1, sourceMap = None):
+    variables.reset()
+    macros.reset()
+    with profiler.phase("handleDefs"):
+        variables.handleDefs(list(fullTokens), params)
+        macros.handleDefs(list(fullTokens), params)
+    streamBase = chooser.number(1000000000)
+    resolveStickyMacros(fullTexts, params)
+    streamState = saveStreamState()
+    rendered = collapseSubstreams(streamState, selectedTexts, selectedNames, params, streamBase, workers, sourceMap)
+    print "\nvars: %s\n" % sorted(variables.showVars())
+    # Kept so end matter can be added later in its own substreams.
+    rendered.streamBase = streamBase
+    rendered.streamState = streamState
+    return rendered
+
+# A sticky macro is decided the first time it's expanded, so expand each one once here, on the main stream, before any chapter can.
+def resolveStickyMacros(fullTexts, params):
+    names = []
+    for text in fullTexts:
+        for name in stickyMacroRegex.findall(text):
+            if name.strip() not in names:
+                names.append(name.strip())
+    for name in names:
+        res = goContinue("{%s}" % name, params)
+        if not res.isValid:
+            print res
+
+# The variables and macros as set up on the main stream, pickled, so every chapter (in this process or a worker) can start from its own copy. Each module keeps its state in a private global (like variables.__v).
+def saveStreamState():
+    state = {}
+    for module in [variables, macros]:
+        state[module.__name__] = dict([(key, value) for key, value in vars(module).items() if key.startswith("__") and not key.endswith("__")])
+    return cPickle.dumps(state, 2)
+
+def restoreStreamState(streamState):
+    state = cPickle.loads(streamState)
+    for module in [variables, macros]:
+        for key, value in state[module.__name__].items():
+            setattr(module, key, value)
+
+def substreamSeed(streamBase, name):
+    return int(hashlib.md5("%d:%s" % (streamBase, name)).hexdigest()[:8], 16)
+
+# Worker processes for collapseSubstreams, started on first use and kept for the rest of the run; collapser.py calls closePool() when it's done.
+pool = None
+poolSize = 0
+jobCount = 0
+
+def getPool(workers):
+    global pool, poolSize
+    if pool is None or poolSize < workers:
+        closePool()
+        pool = multiprocessing.Pool(workers)
+        poolSize = workers
+    return pool
+
+def closePool():
+    global pool, poolSize
+    if pool is not None:
+        pool.close()
+        pool.join()
+    pool = None
+    poolSize = 0
+
+# Collapse each selected text in its own substream, starting from the saved variables and macros, and join the results. Also used to add end matter to a book collapsed this way.
+def collapseSubstreams(streamState, selectedTexts, selectedNames, params, streamBase, workers = 1, sourceMap = None):
+    global jobCount
+    jobCount += 1
+    job = {
+        "key": "%d-%d" % (os.getpid(), jobCount),
+        "state": streamState,
+        "texts": selectedTexts,
+        "names": selectedNames,
+        "params": params,
+        "streamBase": streamBase,
+        "sourceMap": sourceMap
+    }
+    if workers > 1 and len(selectedTexts) > 1:
+        # Pickled once here; each worker unpickles it once per book (see collapseSubstream).
+        jobData = cPickle.dumps(job, 2)
+        outputs = getPool(workers).map(collapseSubstream, [(job["key"], jobData, pos) for pos in range(len(selectedTexts))])
+        # Discourse scoring in the workers counts towards this book's stats.
+        for rendered in outputs:
+            for key, count in getattr(rendered, "dpStats", {}).items():
+                discourseVars.dpStats[key] = discourseVars.dpStats.get(key, 0) + count
+    else:
+        outputs = [collapseSubstreamJob(job, pos) for pos in range(len(selectedTexts))]
+    # Leave this process's variables and macros as the book set them.
+    restoreStreamState(streamState)
+
+    texts = []
+    spans = []
+    offset = 0
+    for rendered in outputs:
+        if not rendered.isValid:
+            return rendered
+        for start, end, siteId, alt in rendered.provenance:
+            spans.append([start + offset, end + offset, siteId, alt])
+        texts.append(rendered.package)
+        offset += len(rendered.package)
+    rendered = outputs[0]
+    rendered.package = "".join(texts)
+    rendered.provenance = provenance.Provenance(sourceMap, spans) if sourceMap is not None else None
+    return rendered
+
+# The job a worker process last unpickled, as (key, job).
+workerJob = None
+
+# Runs in a worker process.
+def collapseSubstream(task):
+    global workerJob
+    key, jobData, pos = task
+    if workerJob is None or workerJob[0] != key:
+        workerJob = (key, cPickle.loads(jobData))
+    statsBefore = discourseVars.dpStats
+    countsBefore = dict(statsBefore)
+    rendered = collapseSubstreamJob(workerJob[1], pos)
+    if discourseVars.dpStats is statsBefore:
+        rendered.dpStats = dict([(k, v - countsBefore.get(k, 0)) for k, v in discourseVars.dpStats.items()])
+    else:
+        rendered.dpStats = dict(discourseVars.dpStats)
+    return rendered
+
+def collapseSubstreamJob(job, pos):
+    restoreStreamState(job["state"])
+    chooser.setSeed(substreamSeed(job["streamBase"], job["names"][pos]))
+    chooser.resetAllIters()
+    rendered = goContinue(job["texts"][pos], job["params"], sourceMap = job["sourceMap"])
+    # Only the spans go back to the parent, not the whole source map.
+    if job["sourceMap"] is not None and rendered.isValid:
+        rendered.provenance = rendered.provenance.spans
+    else:
+        rendered.provenance = []
+    return rendered
+
+# Lex a list of texts as if they were one, returning a single result with all their tokens.
+def lexChunks(texts):
+    if len(texts) == 0:
+        # Same as lexing the texts joined together: an empty, valid result.
+        return quantlex.lex("")
+    tokens = []
+    for text in texts:
+        result = quantlex.lex(text)
+        if not result.isValid:
+            return result
+        tokens.extend(result.package)
+    result.package = tokens
+    return result
+
+# Collapse more text on top of the last call to go(), without resetting variables or macros: used to append end matter to an already-collapsed book.
+def goContinue(selectedText, params, sourceMap = None):
+    with profiler.phase("lex"):
+        result = quantlex.lex(selectedText)
+    if not result.isValid:
+        return result
+    tokens = result.package
+    with profiler.phase("strip"):
+        preppedTokens = variables.stripDefs(tokens, params)
+        preppedTokens = macros.stripMacros(preppedTokens, params)
+    with profiler.phase("parse"):
+        rendered = quantparse.parse(preppedTokens, selectedText, params)
+    return extractProvenance(rendered, sourceMap)
+
+def extractProvenance(rendered, sourceMap):
+    if sourceMap is not None and rendered.isValid:
+        rendered.package, rendered.provenance = sourceMap.extract(rendered.package)
     return rendered
 
 # TODO: Exclude "singular" variables. 
 # TODO: Warning flag, some of these are not showing up with ^opposites, i.e. thoreauflag, 
-def getDefinesForLongestShortest(tokens, parseParams):
+def getDefinesForLongestShortest(tokens, fullTexts, parseParams):
     print "Calculating %s defines (ignoring seed)..." % parseParams.chooseStrategy
     bestDefines = []
 
@@ -58,12 +273,20 @@ def getDefinesForLongestShortest(tokens, parseParams):
     tempTokens = variables.handleDefs(tempTokens, parseParams)
     tempTokens = macros.handleDefs(tempTokens, parseParams)
     parseParamsCopy = parseParams.copy()
-    chooser.setSeed(chooser.number(100000))
+    measureSeed = chooser.number(100000)
+
+    # Rather than re-rendering the whole book for every option, only re-render the control sequences and macros each group can actually affect.
+    siteIndex = variantsites.SiteIndex(fullTexts)
+    print "Found %d variable-dependent sites." % len(siteIndex.sites)
 
     # Now for each option in a define group, see which one is best.
     groups = variables.__v.varGroups.keys()
+    allOpts = []
+    greedyAssignment = []
+    isShortest = parseParams.chooseStrategy == "shortest"
     for groupname in groups:
         optsToTry = list(variables.__v.varGroups[groupname])
+        affectedSites = siteIndex.sitesAffectedBy(optsToTry)
 
         # If just one option, we want to try it as True and False.
         if len(optsToTry) is 1:
@@ -72,7 +295,6 @@ def getDefinesForLongestShortest(tokens, parseParams):
         bestPos = -1
         bestLen = -1
         secondBestLen = -1
-        isShortest = parseParams.chooseStrategy == "shortest"
         if isShortest:
             secondBestLen = 999999999
             bestLen = 999999999
@@ -82,7 +304,8 @@ def getDefinesForLongestShortest(tokens, parseParams):
             if len(key) > 0 and key[0] != "^":
                 variables.__v.variables[key] = True
 
-            thisLen = len(quantparse.handleParsing(tempTokens, parseParamsCopy))
+            # Same seed for every site and option, so random choices within the sites don't count as a difference; optimizer.LengthModel measures the same way.
+            thisLen = variantsites.totalRenderedLength(affectedSites, parseParamsCopy, measureSeed)
 
             isBetter = False
             if isShortest:
@@ -98,5 +321,19 @@ def getDefinesForLongestShortest(tokens, parseParams):
 
         print "Best was %s (%d chars %s than next best)" % (optsToTry[bestPos], abs(bestLen - secondBestLen), "longer" if parseParams.chooseStrategy == "longest" else "shorter")
         bestDefines.append(optsToTry[bestPos])
+        allOpts.append(optsToTry)
+        greedyAssignment.append(bestPos)
+
+    # The greedy picks above each assume every other variable is off, so look for a better combination across groups that share text.
+    optimizeTime = getattr(parseParams, "optimizeTime", optimizer.DEFAULT_TIME_BUDGET)
+    if optimizeTime > 0:
+        started = time.time()
+        model = optimizer.LengthModel(siteIndex, allOpts, parseParamsCopy, measureSeed)
+        assignment, isExact = optimizer.optimize(model, greedyAssignment, isShortest, optimizeTime)
+        searchTime = time.time() - started
+        greedyLen = model.totalLength(greedyAssignment)
+        optimizedLen = model.totalLength(assignment)
+        print "Optimized defines are %d chars %s than greedy (%s; %d site renders in %.1fs)" % (abs(optimizedLen - greedyLen), "shorter" if isShortest else "longer", "exact" if isExact else "best found in time budget", model.renders, searchTime)
+        bestDefines = [allOpts[pos][opt] for pos, opt in enumerate(assignment)]
 
     return bestDefines
@@ -13,31 +13,89 @@
 
 import sys
 import getopt
+import importlib
 import re
+import random
+import copy
+import types
+import threading
+import glob
+import os
+import zipfile
 
 import fileio
+import filecache
+import artifactcache
+import eventlog
+import profiler
 import collapse
 import quantparse
 import chooser
 import differ
 import hasher
+import optimizer
+import pagecount
+import provenance
 import variables
 import result
 import renderer
-import terminal
-import renderer_latex
-import renderer_text
-import renderer_html
-import renderer_web
-import renderer_markdown
-import renderer_epub
-import renderer_kpf
-import renderer_tweet
 
 outputDir = "output/"
 workDir = "work/"
 alternateOutputFile = "alternate"
 
+# The most recent main-body collapse, kept so a re-render that only adds end matter doesn't need to collapse the whole book again.
+lastCollapse = None
+
+# Strategies whose end-matter re-render can reuse lastCollapse. Their choices come only from the seeded random stream and chooser's own state, so carrying on from where those were saved gives the same text as a full collapse; longest and shortest also search over variables, and are always collapsed again.
+reusableStrategies = ["random", "author"]
+
+# Extensions of the files renderers write to outputDir, for the event log.
+outputExtensions = {"pdf": "pdf", "epub": "epub"}
+
+# The renderer for each output format, as (module, class). A renderer's module is only imported the first time its format is rendered, so a run doesn't pay for loading backends it never uses. Formats mapped to None are recognized but not currently supported. Use registerRenderer to add a format.
+renderers = {
+	"pdf": ("renderer_latex", "RendererLatex"),
+	"txt": ("renderer_text", "RendererText"),
+	"html": ("renderer_html", "RendererHTML"),
+	"web": ("renderer_web", "RendererWeb"),
+	"md": ("renderer_markdown", "RendererMarkdown"),
+	"epub": ("renderer_epub", "RendererEPub"),
+	# 231222: KPF is deprecated (was renderer_kpf.RendererKPF); .mobi (renderer_mobi.RendererMobi) is also unsupported.
+	"kpf": None,
+	"tweet": ("renderer_tweet", "RendererTweet")
+}
+
+def registerRenderer(outputFormat, moduleName, className, extension = None):
+	renderers[outputFormat] = (moduleName, className)
+	if extension is not None:
+		outputExtensions[outputFormat] = extension
+
+def getRendererClass(outputFormat):
+	entry = renderers.get(outputFormat)
+	if entry is None:
+		return None
+	return getattr(importlib.import_module(entry[0]), entry[1])
+
+# Import every renderer now, for long-running callers (genservice.py) that fork workers and want each one to start with them loaded. A renderer that can't be imported here is reported, and fails only the jobs that use it.
+def preloadRenderers():
+	for outputFormat in sorted(renderers):
+		if renderers[outputFormat] is None:
+			continue
+		try:
+			getRendererClass(outputFormat)
+		except ImportError as e:
+			print "Couldn't preload the %s renderer: %s" % (outputFormat, e)
+
+# Whether to write each collapsed text to work/collapsed.txt for debugging.
+saveCollapsed = False
+
+# Whether to write a provenance map (see provenance.py) for each book to work/provenance-<fileId>.json, and the map for the text most recently collapsed.
+saveProvenance = False
+lastProvenance = None
+
+# Whether extra output formats for the same collapse (see renderFormats) are rendered side by side (--concurrentRender). Off by default: the renderers haven't all been checked for sharing workDir with each other.
+renderConcurrently = False
 
 
 def showUsage():
@@ -50,7 +108,9 @@ Arguments:
   --output=x	      Format to output (default none)
                       "pdf" (for POD), "pdfdigital" (for online use),
                       "txt", "html", "web", "md", "epub", "kpf", "tweet",
-                      "ebookorder"
+                      "ebookorder" (pdfdigital and epub from one collapse;
+                        the epub gets the end matter picked for the pdf)
+                      A list (x,y) renders each format from one collapse
   --file=x            Write output to this filename (default = seed/strategy)
   --seed=             What seed to use in book generation (default: next)
              N          Use the given integer
@@ -63,6 +123,10 @@ Arguments:
              "pair"     Two versions optimizing for difference
              "longest"
              "shortest"
+  --optimizeTime=N    Most seconds to spend searching for the longest/
+                        shortest combination of variables (default 10,
+                        0 = greedy); the search stops as soon as it's done,
+                        which for most books is well inside this
   --times=N           How many times to run this command.
   --set=x,y,z	      A list of variables to set true for this run.
                       Preface with ^ to negate
@@ -72,13 +136,57 @@ Arguments:
   --skipFront         Skip frontmatter
   --endMatter=x,y     Add specific end matter files (default auto)
   --skipEndMatter	  Don't add end matter
+  --concurrentRender  Render multiple formats (ebookorder) at the same time
+                        instead of one after another
+  --log=x             Append a JSON Lines event log (seeds, variables, phase
+                        timings, output files, errors) to this file
+  --saveCollapsed     Write the collapsed text to work/collapsed.txt
+  --provenance        Write work/provenance-<file>.json, mapping each span of
+                        the collapsed text to the source file, control
+                        sequence and alternative it came from (implies
+                        --skipConfirm); with --strategy=pair, pick the pair
+                        by comparing these choices instead of texts
+  --verifyReuse       When re-rendering with end matter, also collapse the
+                        whole book again and check the output is identical
+                        (only random and author reuse the first collapse;
+                        other strategies always collapse again)
+  --chapterStreams    Give each chapter its own random stream, derived from
+                        the seed and the chapter, instead of one stream for
+                        the whole book (the same seed gives a different book
+                        than without this)
+  --collapseWorkers=N With --chapterStreams, collapse chapters in N
+                        processes at once (default 1)
+  --cacheDir=x        Keep finished books (pdf, epub) in this directory
+                        and reuse them when the same edition is requested
+                        again with nothing relevant changed
+  --cacheSize=N       Megabytes to keep in --cacheDir (default 2048)
+  --profile=x         Write wall and CPU time for each phase of each book
+                        (reading, lexing, definitions, parsing, discourse
+                        scoring, rendering, zipping) to this JSON file
+  --profileMode=x     "time" (default), "cprofile" (also the hottest
+                        functions in each phase; only the main thread is
+                        profiled, so formats rendered by --concurrentRender
+                        and zipping aren't) or "memory" (also memory
+                        allocated per phase; needs tracemalloc)
 """
 
 
-def main():
+# argv is the command line arguments, as in sys.argv[1:] (the default). main() can be called again in the same process (see genservice.py), so it starts by resetting anything the last run set.
+def main(argv = None):
+	global renderConcurrently, saveCollapsed, saveProvenance, lastCollapse, lastProvenance
 
 	print """Collapser\n"""
 
+	if argv is None:
+		argv = sys.argv[1:]
+	renderConcurrently = False
+	saveCollapsed = False
+	saveProvenance = False
+	lastCollapse = None
+	lastProvenance = None
+	profiler.reset()
+	artifactcache.disable()
+
 	inputFiles = ["full-book-manifest.txt"]
 	inputFileDir = "chapters/"
 	outputFile = ""
@@ -98,10 +206,19 @@ def main():
 	isDigital = False
 	copies = 1
 	onlyShow = []
-
-	VALID_OUTPUTS = ["pdf", "pdfdigital", "txt", "html", "web", "md", "epub", "kpf", "tweet", "ebookorder", "none"]
-
-	opts, args = getopt.getopt(sys.argv[1:], "", ["help", "seed=", "strategy=", "output=", "skipConfirm", "skipFront", "set=", "discourseVarChance=", "skipPadding", "input=", "only=", "endMatter=", "skipEndMatter", "file=", "gen=", "times="])
+	optimizeTime = optimizer.DEFAULT_TIME_BUDGET
+	verifyReuse = False
+	extraFormats = []
+	chapterStreams = False
+	collapseWorkers = 1
+	cacheDir = ""
+	cacheSize = None
+	profilePath = ""
+	profileMode = "time"
+
+	VALID_OUTPUTS = sorted(renderers.keys()) + ["pdfdigital", "ebookorder", "none"]
+
+	opts, args = getopt.getopt(argv, "", ["help", "seed=", "strategy=", "output=", "skipConfirm", "skipFront", "set=", "discourseVarChance=", "skipPadding", "input=", "only=", "endMatter=", "skipEndMatter", "file=", "gen=", "times=", "optimizeTime=", "verifyReuse", "concurrentRender", "saveCollapsed", "provenance", "log=", "chapterStreams", "collapseWorkers=", "cacheDir=", "cacheSize=", "profile=", "profileMode="])
 	if len(args) > 0:
 		print "Unrecognized arguments: %s" % args
 		sys.exit()
@@ -144,7 +261,24 @@ def main():
 			except:
 				print "Invalid --times parameter '%s': must be an integer > 0" % arg
 				sys.exit()
+		elif opt == "--optimizeTime":
+			try:
+				optimizeTime = int(arg)
+				assert optimizeTime >= 0
+			except:
+				print "Invalid --optimizeTime parameter '%s': must be an integer >= 0" % arg
+				sys.exit()
 		elif opt == "--output":
+			if arg.find(",") >= 0:
+				extraFormats = arg.split(",")[1:]
+				arg = arg.split(",")[0]
+				for fmt in extraFormats:
+					if fmt not in VALID_OUTPUTS or fmt in ["pdfdigital", "ebookorder", "none"]:
+						print "Invalid --output parameter '%s': formats in a list must be one of %s" % (fmt, VALID_OUTPUTS)
+						sys.exit()
+					if arg == "ebookorder" and fmt in ["pdf", "epub"]:
+						print "Invalid --output parameter '%s': ebookorder already renders pdf and epub" % fmt
+						sys.exit()
 			if arg != "" and arg not in VALID_OUTPUTS:
 				print "Invalid --output parameter '%s': must be one of %s" % (arg, VALID_OUTPUTS)
 			if arg == "pdfdigital":
@@ -168,6 +302,41 @@ def main():
 			except:
 				print "Invalid --discourseVarChance parameter '%s': not an integer." % arg
 				sys.exit()
+		elif opt == "--concurrentRender":
+			renderConcurrently = True
+		elif opt == "--log":
+			eventlog.start(arg)
+		elif opt == "--saveCollapsed":
+			saveCollapsed = True
+		elif opt == "--provenance":
+			saveProvenance = True
+		elif opt == "--verifyReuse":
+			verifyReuse = True
+		elif opt == "--chapterStreams":
+			chapterStreams = True
+		elif opt == "--collapseWorkers":
+			try:
+				collapseWorkers = int(arg)
+				assert collapseWorkers > 0
+			except:
+				print "Invalid --collapseWorkers parameter '%s': must be an integer > 0" % arg
+				sys.exit()
+		elif opt == "--profile":
+			profilePath = arg
+		elif opt == "--profileMode":
+			if arg not in profiler.MODES:
+				print "Invalid --profileMode parameter '%s': must be one of %s" % (arg, profiler.MODES)
+				sys.exit()
+			profileMode = arg
+		elif opt == "--cacheDir":
+			cacheDir = arg
+		elif opt == "--cacheSize":
+			try:
+				cacheSize = int(arg)
+				assert cacheSize > 0
+			except:
+				print "Invalid --cacheSize parameter '%s': must be an integer > 0" % arg
+				sys.exit()
 		elif opt == "--skipPadding":
 			skipPadding = True
 		elif opt == "--endMatter":
@@ -179,6 +348,15 @@ def main():
 				sys.exit()
 			endMatter = []
 
+	if saveProvenance and doConfirm:
+		# Confirmation is keyed on the source text, which provenance markers change.
+		print "(Skipping variant confirmation because of --provenance.)"
+		doConfirm = False
+
+	if collapseWorkers > 1 and not chapterStreams:
+		print "*** --collapseWorkers needs --chapterStreams: with a single random stream, chapters can only be collapsed in order ***\n"
+		sys.exit()
+
 	if seed is not -1 and strategy != "random":
 		print "*** You set seed to %d but strategy to '%s'; a seed can only be used when strategy is 'random' ***\n" % (seed, strategy)
 		sys.exit()
@@ -192,9 +370,32 @@ def main():
 		print "Setting output file to strategy name '%s' (b/c we don't have a seed for strategies other than random and pair)" % outputFile
 
 	parseParams = quantparse.ParseParams(chooseStrategy = strategy, setDefines = setDefines, doConfirm = doConfirm, discourseVarChance = discourseVarChance, onlyShow = onlyShow, endMatter = endMatter)
+	parseParams.optimizeTime = optimizeTime
+	parseParams.verifyReuse = verifyReuse
+	parseParams.chapterStreams = chapterStreams
+	parseParams.collapseWorkers = collapseWorkers
 	renderParams = renderer.RenderParams(outputFormat = outputFormat, fileId = outputFile, seed = seed, randSeed = randSeed, doFront = doFront, skipPadding = skipPadding, workDir = workDir, outputDir = outputDir, isDigital = isDigital, copies = copies, parseParams = parseParams, finalOutput = True, pairInfo = [], generation = generation)
+	renderParams.extraFormats = extraFormats
 
-	makeBooks(inputFiles, inputFileDir, parseParams, renderParams)
+	if cacheDir != "":
+		artifactcache.enable(cacheDir, cacheSize)
+
+	if profilePath != "" and not profiler.start(profileMode):
+		print "--profileMode=%s needs the tracemalloc module, which isn't available." % profileMode
+		sys.exit()
+
+	preloadSources(inputFiles, inputFileDir, parseParams)
+	try:
+		makeBooks(inputFiles, inputFileDir, parseParams, renderParams)
+	finally:
+		# makeBooks waits for its zip threads when it finishes, but not when it exits early (a pair that can't be made, say); they still write to the event log, so don't leave them running past the run.
+		waitForZipPackages()
+		# Chapter workers (--collapseWorkers) are kept for the whole run.
+		collapse.closePool()
+
+	if profilePath != "":
+		profiler.write(profilePath)
+		print "Wrote profile to %s" % profilePath
 
 
 
@@ -208,18 +409,15 @@ def makeBooks(inputFiles, inputFileDir, parseParams, renderParams):
 	while copies >= 1:
 
 		if renderParams.outputFormat == "ebookorder":
+			# The epub is rendered from the same collapse as the pdf.
+			# 231222 removing KPF (was also an extra format here) because this format is now deprecated.
 			renderParams.outputFormat = "pdf"
 			renderParams.isDigital = True
+			# Any other formats asked for (--output=ebookorder,txt) come from the same collapse too.
+			orderedFormats = renderParams.extraFormats
+			renderParams.extraFormats = ["epub"] + orderedFormats
 			renderAccordingToStrategy(inputFiles, inputFileDir, parseParams, renderParams, skippedSeeds, origEndMatter)
-			# renderParams.seed (or .pairInfo) should now be set to what it was on the first run.
-
-			# 231222 removing KPF because this format is now deprecated.
-			# renderParams.outputFormat = "kpf"
-			# renderParams.isDigital = False
-			# renderAccordingToStrategy(inputFiles, inputFileDir, parseParams, renderParams, skippedSeeds, origEndMatter)
-			
-			renderParams.outputFormat = "epub"
-			renderAccordingToStrategy(inputFiles, inputFileDir, parseParams, renderParams, skippedSeeds, origEndMatter)
+			renderParams.extraFormats = orderedFormats
 
 			outDir = renderParams.outputDir
 			if len(renderParams.pairInfo) == 0:
@@ -241,33 +439,67 @@ def makeBooks(inputFiles, inputFileDir, parseParams, renderParams):
 		if copies > 0:
 			print "\n\n%d cop%s left to generate.\n" % (copies, "y" if copies is 1 else "ies")
 
+	waitForZipPackages()
+
 	if len(skippedSeeds) > 0:
 		print "\n\n*** ERRORS (%d) prevented some copies being generated. Bad seeds were: %s\n" % (len(skippedSeeds), skippedSeeds)
 
 
+# Zip packages being written in the background, so the next book can start rendering meanwhile; makeBooks waits for them before it returns.
+zipThreads = []
+
 def makeZipPackage(outDir, seed):
 	fn = "%s%s" % (outDir, seed)
 	# files = ["%s.pdf" % fn, "%s.epub" % fn, "%s.kpf" % fn]
 	files = ["%s.pdf" % fn, "%s.epub" % fn]
-	terminal.zip(files, "%ssubcutanean-%s.zip" % (outDir, seed), removeAfter = False)
+	zipFile = "%ssubcutanean-%s.zip" % (outDir, seed)
+	thread = threading.Thread(target = writeZipPackage, args = (files, zipFile, seed, profiler.currentBook()))
+	thread.start()
+	zipThreads.append(thread)
+
+def writeZipPackage(files, zipFile, seed, book):
+	try:
+		with profiler.phase("zip", book = book):
+			writeZip(files, zipFile)
+		eventlog.output("zip", zipFile, seed = seed)
+	except (IOError, OSError, zipfile.BadZipfile) as e:
+		print "\n*** ERROR packaging %s: %s\n" % (zipFile, e)
+		eventlog.error("Couldn't write %s: %s" % (zipFile, e), seed = seed)
+
+# The PDF and EPUB are already compressed, so they're stored rather than deflated again, each streamed into the archive from disk. The zip only appears under its real name once it's complete.
+def writeZip(files, zipFile):
+	tmpFile = zipFile + ".tmp"
+	archive = zipfile.ZipFile(tmpFile, "w", zipfile.ZIP_STORED, allowZip64 = True)
+	try:
+		for path in files:
+			archive.write(path, os.path.basename(path))
+	finally:
+		archive.close()
+	os.rename(tmpFile, zipFile)
+
+def waitForZipPackages():
+	while len(zipThreads) > 0:
+		zipThreads.pop(0).join()
 
 
 def renderAccordingToStrategy(inputFiles, inputFileDir, parseParams, renderParams, skippedSeeds, origEndMatter):
 	if parseParams.chooseStrategy == "pair":
 		try:
 			makePairOfBooks(inputFiles, inputFileDir, parseParams, renderParams)
-		except renderer.TooLongError as e:
+		except (renderer.TooLongError, pagecount.TooLongEstimateError) as e:
 			print "\n*** ERROR : %s\n" % e.strerror
 			print "*** We could not generate both books, so halting."
+			eventlog.error(e.strerror)
 			sys.exit()
 		parseParams.chooseStrategy = "pair"
 
 	else:
 		try:
 			makeBookWithEndMatter(inputFiles, inputFileDir, parseParams, renderParams)
-		except renderer.TooLongError as e:
+		except (renderer.TooLongError, pagecount.TooLongEstimateError) as e:
 			print "\n*** ERROR : %s\n" % e.strerror
 			skippedSeeds.append(renderParams.seed)	
+			eventlog.error(e.strerror)
 
 	# Stuff that should be reset after each individual generation.
 	renderParams.fileId = ""
@@ -277,32 +509,102 @@ def renderAccordingToStrategy(inputFiles, inputFileDir, parseParams, renderParam
 
 
 def makeBookWithEndMatter(inputFiles, inputFileDir, parseParams, renderParams):
+	key = artifactKey(inputFiles, inputFileDir, parseParams, renderParams)
+	if key is not None and restoreBook(key, parseParams, renderParams):
+		return
+
 	doingEndMatter = len(parseParams.endMatter) == 1 and parseParams.endMatter[0] == "auto"
 	if doingEndMatter:
 		savedSkipPadding = renderParams.skipPadding
 		renderParams.skipPadding = True
 		renderParams.finalOutput = False
 
-	makeBook(inputFiles, inputFileDir, parseParams, renderParams)
+	collapsedText = makeBook(inputFiles, inputFileDir, parseParams, renderParams, withExtraFormats = not doingEndMatter)
 
 	#End Matter
 	if doingEndMatter:
 		endMatters = renderParams.renderer.suggestEndMatters()
 		print "Suggested End Matter: %s" % endMatters
-		if len(endMatters) > 0:
+		if len(endMatters) == 0:
+			renderExtraFormats(collapsedText, renderParams)
+		else:
 			print "Re-rendering..."
 			parseParams.endMatter = endMatters
 			renderParams.randSeed = False
 			parseParams.doConfirm = False
 			renderParams.skipPadding = savedSkipPadding
 			renderParams.finalOutput = True
-			makeBook(inputFiles, inputFileDir, parseParams, renderParams)	
+			makeBook(inputFiles, inputFileDir, parseParams, renderParams, reusePrelim = canReusePrelim(parseParams), withExtraFormats = True)
+
+	if key is not None:
+		artifactcache.store(key, bookPaths(renderParams), {"seed": renderParams.seed, "fileId": str(renderParams.fileId), "variables": sorted(variables.showVars())})
+
+# The artifact cache key for the book makeBookWithEndMatter would make, or None if it can't be cached: caching is off, the seed isn't known in advance, only some chapters are being shown (--only), or a format doesn't write a file we know the name of.
+def artifactKey(inputFiles, inputFileDir, parseParams, renderParams):
+	if not artifactcache.isEnabled():
+		return None
+	if len(parseParams.onlyShow) > 0:
+		return None
+	if parseParams.chooseStrategy not in ["random", "author"]:
+		return None
+	if parseParams.chooseStrategy == "random" and (renderParams.randSeed or renderParams.seed == -1):
+		return None
+	formats = [renderParams.outputFormat] + getattr(renderParams, "extraFormats", [])
+	for outputFormat in formats:
+		if outputFormat not in outputExtensions:
+			return None
+	texts = []
+	fileList = []
+	for iFile in inputFiles:
+		res = readManifestOrFile(iFile, inputFileDir, parseParams)
+		texts.extend(res["files"])
+		fileList.extend(res["fileList"])
+	for path in sorted(glob.glob(inputFileDir + "end-*.txt")):
+		texts.append(filecache.readInputFile(path))
+	return artifactcache.makeKey({
+		"seed": renderParams.seed,
+		"generation": renderParams.generation,
+		"strategy": parseParams.chooseStrategy,
+		"setDefines": sorted(parseParams.setDefines),
+		"endMatter": parseParams.endMatter,
+		"formats": formats,
+		"isDigital": renderParams.isDigital,
+		"doFront": renderParams.doFront,
+		"skipPadding": renderParams.skipPadding,
+		"discourseVarChance": parseParams.discourseVarChance,
+		"chapterStreams": getattr(parseParams, "chapterStreams", False),
+		"fileSetKey": hasher.hash(''.join(fileList)),
+		"sources": artifactcache.contentHash(texts),
+		"code": artifactcache.codeHash()
+	})
+
+def bookPaths(renderParams):
+	paths = {}
+	for outputFormat in [renderParams.outputFormat] + getattr(renderParams, "extraFormats", []):
+		paths[outputFormat] = "%s%s.%s" % (renderParams.outputDir, renderParams.fileId, outputExtensions[outputFormat])
+	return paths
+
+def restoreBook(key, parseParams, renderParams):
+	setOutputFile(renderParams, parseParams)
+	paths = bookPaths(renderParams)
+	info = artifactcache.restore(key, paths)
+	if info is None:
+		return False
+	print "\n\n*** makeBook %s (from artifact cache) ****************************\n" % renderParams.fileId
+	eventlog.bookStarted(renderParams, parseParams, prelim = False)
+	# As makeBook would have logged them, for add_variables.py.
+	eventlog.variables(info.get("variables", []))
+	for outputFormat in sorted(paths):
+		eventlog.output(outputFormat, paths[outputFormat])
+	eventlog.bookFinished()
+	return True
 
 def makePairOfBooks(inputFiles, inputFileDir, parseParams, renderParams, manualSeeds=None):
 	tries = 20
 	texts = []
 	seeds = []
 	signatures = []
+	choiceVectors = []
 	origEndMatter = parseParams.endMatter
 
 	if len(renderParams.pairInfo) == 0:
@@ -321,10 +623,16 @@ def makePairOfBooks(inputFiles, inputFileDir, parseParams, renderParams, manualS
 			texts.append(collapsed)
 			signature = getSignature(collapsed)
 			signatures.append(signature)
+			if saveProvenance:
+				choiceVectors.append(lastProvenance.choices())
 			# fileio.writeOutputFile("work/signature-%s.txt" % seed, signature)
 			lastSeed = seed
 			seed = chooser.nextSeed(renderParams.generation)
-		leastSimilarPair = differ.getTwoLeastSimilar(signatures)
+		if saveProvenance:
+			# Compare the choices each seed made rather than diffing texts.
+			leastSimilarPair = differ.getTwoLeastSimilarChoices(choiceVectors, signatures)
+		else:
+			leastSimilarPair = differ.getTwoLeastSimilar(signatures)
 		text0 = texts[leastSimilarPair[0]]
 		seed0 = seeds[leastSimilarPair[0]]
 		text1 = texts[leastSimilarPair[1]]
@@ -352,13 +660,46 @@ def getSignature(txt):
 	sig = variables.__v.getSignature()
 	return sig
 
-def makeBook(inputFiles, inputFileDir, parseParams, renderParams):
-	setFinalSeed(renderParams, parseParams)
-	setOutputFile(renderParams, parseParams)
-	chooser.resetAllIters()
-	print "\n\n*** makeBook %s %s****************************\n" % (renderParams.fileId, "(prelim) " if not renderParams.finalOutput else "")
-	collapsedText = collapseInputText(inputFiles, inputFileDir, parseParams)
-	render(collapsedText, renderParams)
+def makeBook(inputFiles, inputFileDir, parseParams, renderParams, reusePrelim = False, withExtraFormats = True):
+	if reusePrelim:
+		print "\n\n*** makeBook %s (reusing prelim collapse) ****************************\n" % renderParams.fileId
+		eventlog.bookStarted(renderParams, parseParams, prelim = False)
+		with eventlog.phase("collapse"):
+			collapsedText = collapseEndMatter(inputFileDir, parseParams)
+			if getattr(parseParams, "verifyReuse", False):
+				collapsedText = verifyReusedCollapse(collapsedText, inputFiles, inputFileDir, parseParams, renderParams)
+	else:
+		setFinalSeed(renderParams, parseParams)
+		setOutputFile(renderParams, parseParams)
+		chooser.resetAllIters()
+		print "\n\n*** makeBook %s %s****************************\n" % (renderParams.fileId, "(prelim) " if not renderParams.finalOutput else "")
+		eventlog.bookStarted(renderParams, parseParams, prelim = not withExtraFormats)
+		with eventlog.phase("collapse"):
+			collapsedText = collapseInputText(inputFiles, inputFileDir, parseParams)
+	eventlog.variables(variables.showVars())
+	if saveProvenance:
+		writeProvenance(renderParams)
+	checkPageEstimate(collapsedText, parseParams, renderParams)
+	with eventlog.phase("render"):
+		if withExtraFormats:
+			renderFormats(collapsedText, renderParams)
+		else:
+			render(collapsedText, renderParams)
+	eventlog.bookFinished()
+	return collapsedText
+
+# pagecount's estimate is of the body alone, so only check collapses that don't have end matter yet: the prelim render before end matter is picked, or a book without any. Once end matter is in, it was picked to fit, and the renderer has the last word. Digital PDFs aren't printed, so they aren't held to the print page count.
+def checkPageEstimate(collapsedText, parseParams, renderParams):
+	if renderParams.outputFormat != "pdf" or renderParams.isDigital:
+		return
+	if len(parseParams.endMatter) > 0 and parseParams.endMatter != ["auto"]:
+		return
+	pagecount.check(collapsedText)
+
+def writeProvenance(renderParams):
+	path = "%sprovenance-%s.json" % (workDir, renderParams.fileId)
+	fileio.writeOutputFile(path, lastProvenance.toJson())
+	eventlog.output("provenance", path)
 
 def setFinalSeed(renderParams, parseParams):
 	thisSeed = renderParams.seed
@@ -382,56 +723,120 @@ def setOutputFile(renderParams, parseParams):
 		renderParams.fileId = renderParams.seed
 
 
-def render(collapsedText, renderParams):
+def render(collapsedText, renderParams, logOutput = True):
 	outputFormat = renderParams.outputFormat
 	if outputFormat != "":
-		if outputFormat == "pdf":
-			renderParams.renderer = renderer_latex.RendererLatex(collapsedText, renderParams)
-		elif outputFormat == "txt":
-			renderParams.renderer = renderer_text.RendererText(collapsedText, renderParams)
-		elif outputFormat == "html":
-			renderParams.renderer = renderer_html.RendererHTML(collapsedText, renderParams)
-		elif outputFormat == "web":
-			renderParams.renderer = renderer_web.RendererWeb(collapsedText, renderParams)
-		elif outputFormat == "md":
-			renderParams.renderer = renderer_markdown.RendererMarkdown(collapsedText, renderParams)
-		elif outputFormat == "epub":
-			renderParams.renderer = renderer_epub.RendererEPub(collapsedText, renderParams)
-		elif outputFormat == "mobi":
-			print ".mobi is not currently supported."
-			# renderParams.renderer = renderer_mobi.RendererMobi(collapsedText, renderParams)
-		elif outputFormat == "kpf":
-			print ".kpf is not currently supported."
-			# renderParams.renderer = renderer_kpf.RendererKPF(collapsedText, renderParams)
-		elif outputFormat == "tweet":
-			renderParams.renderer = renderer_tweet.RendererTweet(collapsedText, renderParams)
+		rendererClass = getRendererClass(outputFormat)
+		if rendererClass is not None:
+			renderParams.renderer = rendererClass(collapsedText, renderParams)
+		elif outputFormat in renderers:
+			print ".%s is not currently supported." % outputFormat
 
 		if renderParams.renderer is None:
 			print "No rendering requested or available."
 		else:
 			renderParams.renderer.render()
+			if logOutput:
+				logRenderedOutput(renderParams)
+
+def outputPath(renderParams):
+	if renderParams.outputFormat not in outputExtensions:
+		return None
+	return "%s%s.%s" % (renderParams.outputDir, renderParams.fileId, outputExtensions[renderParams.outputFormat])
+
+def logRenderedOutput(renderParams):
+	eventlog.output(renderParams.outputFormat, outputPath(renderParams))
 
 
 
+# Render the collapsed text in renderParams.outputFormat plus any renderParams.extraFormats. Each extra format gets its own copy of renderParams and, with --concurrentRender, its own thread; the main format renders on this thread so its errors (like TooLongError) reach the caller as usual, and if it fails the extra formats' files are removed, since the book is being skipped.
+def renderFormats(collapsedText, renderParams):
+	extraParams = []
+	for outputFormat in getattr(renderParams, "extraFormats", []):
+		params = copy.copy(renderParams)
+		params.outputFormat = outputFormat
+		params.renderer = None
+		params.extraFormats = []
+		extraParams.append(params)
+
+	if not renderConcurrently or len(extraParams) == 0:
+		render(collapsedText, renderParams)
+		for params in extraParams:
+			render(collapsedText, params)
+		return
+
+	errors = []
+	def renderInThread(params):
+		try:
+			render(collapsedText, params, logOutput = False)
+		except:
+			errors.append(sys.exc_info())
+	threads = [threading.Thread(target = renderInThread, args = (params,)) for params in extraParams]
+	for thread in threads:
+		thread.start()
+	try:
+		render(collapsedText, renderParams)
+	except:
+		failure = sys.exc_info()
+		for thread in threads:
+			thread.join()
+		removeRenderedOutputs(extraParams)
+		raise failure[0], failure[1], failure[2]
+	for thread in threads:
+		thread.join()
+	if len(errors) > 0:
+		raise errors[0][0], errors[0][1], errors[0][2]
+	# Only logged now the whole book has been rendered.
+	for params in extraParams:
+		if params.renderer is not None:
+			logRenderedOutput(params)
+
+def removeRenderedOutputs(paramsList):
+	for params in paramsList:
+		path = outputPath(params)
+		if path is not None and os.path.exists(path):
+			os.remove(path)
+			print "Removed %s" % path
+
+def renderExtraFormats(collapsedText, renderParams):
+	extraFormats = getattr(renderParams, "extraFormats", [])
+	if len(extraFormats) == 0:
+		return
+	params = copy.copy(renderParams)
+	params.outputFormat = extraFormats[0]
+	params.renderer = None
+	params.extraFormats = extraFormats[1:]
+	renderFormats(collapsedText, params)
+
 def collapseInputText(inputFiles, inputFileDir, parseParams):
+	global lastCollapse, lastProvenance
 	params = parseParams
 	fileContents = []
 	fileList = []
 	for iFile in inputFiles:
 		res = readManifestOrFile(iFile, inputFileDir, params)
-		fileContents = fileContents + res["files"]
-		fileList = fileList + res["fileList"]
+		fileContents.extend(res["files"])
+		fileList.extend(res["fileList"])
 	fileSetKey = hasher.hash(''.join(fileList))
 	params.fileSetKey = fileSetKey
 
+	sourceMap = None
+	if saveProvenance:
+		sourceMap = provenance.SourceMap()
+		fileContents = [sourceMap.mark(text, fileList[pos]) for pos, text in enumerate(fileContents)]
+
+	# Note that when everything is selected, end matter is also part of the full text (for its definitions).
 	selectionTexts = []
+	selectionNames = []
 	if len(params.onlyShow) == 0:
 		selectionTexts = fileContents
+		selectionNames = list(fileList)
 	else:
 		for pos, file in enumerate(fileContents):
 			if fileList[pos] in params.onlyShow:
 				print "Selecting %s" % fileList[pos]
 				selectionTexts.append(file)
+				selectionNames.append(fileList[pos])
 		if len(selectionTexts) == 0:
 			print "Something went wrong; nothing was selected for output. params.onlyShow was '%s'" % params.onlyShow
 			sys.exit()
@@ -441,53 +846,162 @@ def collapseInputText(inputFiles, inputFileDir, parseParams):
 		for em in params.endMatter:
 			em = readManifestOrFile(em, inputFileDir, params)
 			emContents = em["files"][0]
+			if sourceMap is not None:
+				emContents = sourceMap.mark(emContents, em["fileList"][0])
 			selectionTexts.append(emContents)
+			selectionNames.append(em["fileList"][0])
 
-	joinedSelectionTexts = ''.join(selectionTexts)
-	joinedAllTexts = ''.join(fileContents)
 	try:
-		res = collapse.go(joinedAllTexts, joinedSelectionTexts, params)
+		if getattr(params, "chapterStreams", False):
+			res = collapse.goSubstreams(fileContents, selectionTexts, selectionNames, params, getattr(params, "collapseWorkers", 1), sourceMap = sourceMap)
+		else:
+			res = collapse.go(fileContents, ''.join(selectionTexts), params, sourceMap = sourceMap)
 	except result.ParseException as e:
 		print e.result
+		eventlog.error(str(e.result))
 		sys.exit()
 	if not res.isValid:
 		print res
+		eventlog.error(str(res))
 		sys.exit()
 	collapsedText = res.package
+	lastCollapse = {
+		"text": collapsedText,
+		"randomState": random.getstate(),
+		"chooserState": saveChooserState(),
+		"sourceMap": sourceMap,
+		"provenance": getattr(res, "provenance", None),
+		"streamState": getattr(res, "streamState", None),
+		"streamBase": getattr(res, "streamBase", None)
+	}
+	if sourceMap is not None:
+		lastProvenance = cleanupProvenance(collapsedText, res.provenance)
 	collapsedText = postCollapseCleanup(collapsedText)
 
 	if len(variables.showVars()) < 4:
 		print "Suspiciously low number of variables set (%d). At this point we should have set every variable defined in the whole project. Stopping."
 		sys.exit()
 
-	fileio.writeOutputFile(workDir + "collapsed.txt", collapsedText)
+	if saveCollapsed:
+		fileio.writeOutputFile(workDir + "collapsed.txt", collapsedText)
 
 	return collapsedText
 
-def postCollapseCleanup(txt):
-	txt = txt.replace("AUTHOREMAIL", "aareed + subq @ gmail.com")
-	return txt
+# Collapse just the requested end matter and append it to the last main-body collapse, picking up the variables, macros, random stream and chooser state right where that collapse left off (or, with --chapterStreams, in the end matter's own substreams).
+def collapseEndMatter(inputFileDir, parseParams):
+	global lastProvenance
+	params = parseParams
+	random.setstate(lastCollapse["randomState"])
+	restoreChooserState(lastCollapse["chooserState"])
+	sourceMap = lastCollapse["sourceMap"]
+	emTexts = []
+	emNames = []
+	for em in params.endMatter:
+		em = readManifestOrFile(em, inputFileDir, params)
+		emContents = em["files"][0]
+		if sourceMap is not None:
+			emContents = sourceMap.mark(emContents, em["fileList"][0])
+		emTexts.append(emContents)
+		emNames.append(em["fileList"][0])
+	try:
+		if lastCollapse["streamBase"] is not None:
+			res = collapse.collapseSubstreams(lastCollapse["streamState"], emTexts, emNames, params, lastCollapse["streamBase"], getattr(params, "collapseWorkers", 1), sourceMap = sourceMap)
+		else:
+			res = collapse.goContinue(''.join(emTexts), params, sourceMap = sourceMap)
+	except result.ParseException as e:
+		print e.result
+		eventlog.error(str(e.result))
+		sys.exit()
+	if not res.isValid:
+		print res
+		eventlog.error(str(res))
+		sys.exit()
+	if sourceMap is not None:
+		lastProvenance = cleanupProvenance(lastCollapse["text"] + res.package, lastCollapse["provenance"].append(res.provenance, len(lastCollapse["text"])))
+	collapsedText = postCollapseCleanup(lastCollapse["text"] + res.package)
 
-def readManifestOrFile(inputFile, inputFileDir, params):
-	filePath = inputFileDir + inputFile
-	inputText = fileio.readInputFile(filePath)
-	fileList = []
-	files = []
-	if inputText[:10] == "# MANIFEST":
-		print "Reading manifest '%s'" % filePath
-		fileList = fileio.getFilesFromManifest(inputText)
-		files = fileio.loadManifestFromFileList(inputFileDir, fileList)
+	if saveCollapsed:
+		fileio.writeOutputFile(workDir + "collapsed.txt", collapsedText)
+
+	return collapsedText
+
+# Whether the end-matter render can carry on from lastCollapse rather than collapsing the whole book again.
+def canReusePrelim(parseParams):
+	return parseParams.chooseStrategy in reusableStrategies and lastCollapse is not None and lastCollapse["chooserState"] is not None
+
+# Besides the random stream, chooser keeps state of its own (the iterators resetAllIters resets), which carrying on from lastCollapse has to restore too. Snapshot its module-level data, or return None if some of it can't be copied, in which case the end matter is collapsed with the whole book again instead.
+def saveChooserState():
+	state = {}
+	for key, value in vars(chooser).items():
+		if (key.startswith("__") and key.endswith("__")) or callable(value) or isinstance(value, types.ModuleType):
+			continue
+		try:
+			state[key] = copy.deepcopy(value)
+		except Exception:
+			return None
+	return state
+
+def restoreChooserState(state):
+	for key, value in state.items():
+		# A copy, so the same snapshot can be restored again.
+		setattr(chooser, key, copy.deepcopy(value))
+
+# Collapse the whole book again the old way and make sure reusing the prelim collapse gave the same result.
+def verifyReusedCollapse(reusedText, inputFiles, inputFileDir, parseParams, renderParams):
+	setFinalSeed(renderParams, parseParams)
+	chooser.resetAllIters()
+	fullText = collapseInputText(inputFiles, inputFileDir, parseParams)
+	if fullText == reusedText:
+		print "Verified: reused collapse is identical to a full collapse."
 	else:
-		print "Reading file '%s'" % filePath
-		fileHeader = fileio.getFileId(inputFile)
-		fileList = [inputFile]
-		files = [fileHeader + inputText]
-	return {
-		"fileList": fileList,
-		"files": files
-	}
+		differAt = 0
+		while differAt < min(len(fullText), len(reusedText)) and fullText[differAt] == reusedText[differAt]:
+			differAt += 1
+		print "*** WARNING: reused collapse differs from a full collapse (first difference at char %d of %d); using the full collapse." % (differAt, len(fullText))
+	return fullText
+
+cleanupReplacements = [
+	("AUTHOREMAIL", "aareed + subq @ gmail.com")
+]
+
+def postCollapseCleanup(txt):
+	for old, new in cleanupReplacements:
+		txt = txt.replace(old, new)
+	return txt
 
+# The provenance map for postCollapseCleanup(txt), given the map for txt.
+def cleanupProvenance(txt, prov):
+	for old, new in cleanupReplacements:
+		txt, prov = prov.replace(txt, old, new)
+	return prov
 
+def readManifestOrFile(inputFile, inputFileDir, params):
+	with profiler.phase("read"):
+		filePath = inputFileDir + inputFile
+		inputText = filecache.readInputFile(filePath)
+		fileList = []
+		files = []
+		if inputText[:10] == "# MANIFEST":
+			print "Reading manifest '%s'" % filePath
+			fileList = fileio.getFilesFromManifest(inputText)
+			files = filecache.loadManifestFromFileList(inputFileDir, fileList)
+		else:
+			print "Reading file '%s'" % filePath
+			fileHeader = fileio.getFileId(inputFile)
+			fileList = [inputFile]
+			files = [fileHeader + inputText]
+		return {
+			"fileList": fileList,
+			"files": files
+		}
+
+# Read the input files and every end matter file into filecache up front, so later books (and any worker processes forked from this one) don't go back to disk.
+def preloadSources(inputFiles, inputFileDir, parseParams):
+	for iFile in inputFiles:
+		readManifestOrFile(iFile, inputFileDir, parseParams)
+	for path in sorted(glob.glob(inputFileDir + "end-*.txt")):
+		readManifestOrFile(os.path.basename(path), inputFileDir, parseParams)
 
 
-main()
+if __name__ == "__main__":
+	main()
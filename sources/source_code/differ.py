@@ -4,6 +4,12 @@ import difflib
 import itertools
 import sys
 
+# NumPy makes comparing a whole population of choice vectors fast, but isn't required.
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 def getTwoLeastSimilar(texts):
 
 	# Find lowest similarity.
@@ -46,3 +52,60 @@ def penaltyIfHaveTheSame(text1, text2, penalty, wordArr):
 			return penalty
 	return 0.0
 
+
+
+# Comparing choice vectors (see provenance.Provenance.choices) rather than texts: each is one integer per variant site, the alternative that seed chose there (-1 if it printed nothing). Vectors from the same source files line up site for site.
+
+# Fraction of sites where two seeds made the same choice (1.0 means identical).
+def choiceSimilarity(choices1, choices2):
+	if len(choices1) == 0:
+		return 1.0
+	same = sum([1 for pos in range(len(choices1)) if choices1[pos] == choices2[pos]])
+	return float(same) / len(choices1)
+
+# The sites where two seeds chose differently.
+def choiceDifferences(choices1, choices2):
+	return [pos for pos in range(len(choices1)) if choices1[pos] != choices2[pos]]
+
+# How many sites in each source file changed between two seeds. sites and files are from the provenance source map.
+def changesByFile(choices1, choices2, sites, files):
+	counts = {}
+	for pos in choiceDifferences(choices1, choices2):
+		name = files[sites[pos][0]]
+		counts[name] = counts.get(name, 0) + 1
+	return counts
+
+# similarity[i][j] for every pair of seeds.
+def choiceSimilarityMatrix(vectors):
+	if numpy is not None:
+		# Choice codes always fit in 64 bits (see provenance.occurrenceCode); saying so keeps numpy from falling back to slow object arrays.
+		arr = numpy.array(vectors, dtype = numpy.int64)
+		return [list((arr == arr[i]).mean(axis = 1)) for i in range(len(vectors))]
+	return [[choiceSimilarity(v1, v2) for v2 in vectors] for v1 in vectors]
+
+# Same as getTwoLeastSimilar, from choice vectors; signatures (if given) are used for the same shared-variable penalties.
+def getTwoLeastSimilarChoices(vectors, signatures = None):
+	if len(vectors) <= 2:
+		print "Error: differ.getTwoLeastSimilarChoices was only sent %d vectors; expected more." % len(vectors)
+		sys.exit()
+
+	matrix = choiceSimilarityMatrix(vectors)
+	lowestSimilarityScore = 1.0
+	leastSimilarPair = [-1, 1]
+
+	for pair in itertools.combinations(range(len(vectors)), 2):
+		similarity = matrix[pair[0]][pair[1]]
+		if signatures is not None:
+			similarity += penaltyIfHaveTheSame(signatures[pair[0]], signatures[pair[1]], 0.05, ["dadphone", "bradphone"])
+			similarity += penaltyIfHaveTheSame(signatures[pair[0]], signatures[pair[1]], 0.10, ["gayniko", "firmniko", "originalniko"])
+		if similarity < lowestSimilarityScore:
+			lowestSimilarityScore = similarity
+			leastSimilarPair = pair
+
+	if lowestSimilarityScore >= 0.999:
+		print "Error: lowestSimilarityScore was too close 1.0 indicating texts were not generated differently."
+		sys.exit()
+
+	print "Best match was pair %s with similarity %f" % (leastSimilarPair, round(lowestSimilarityScore, 3))
+
+	return leastSimilarPair
@@ -3,6 +3,8 @@
 
 import re
 import chooser
+import provenance
+import profiler
 from textblob import TextBlob
 
 dpStats = {}
@@ -40,6 +42,7 @@ def show_trace():
 	if showTrace:
 		print trace_output
 
+@profiler.timed("discourse")
 def getDiscoursePreferredVersion(alts, vars):
 	# For each discourse variable set, rank each alt for desireability. Return something weighted for the highest-ranked options.
 	# TODO only outside quoted dialogue.
@@ -61,20 +64,22 @@ def getDiscoursePreferredVersion(alts, vars):
 	skipBiggest = False
 
 	for pos, item in enumerate(alts.alts):
+		# Weigh the text as written, without any provenance markers.
+		txt = provenance.strip(item.txt)
 
 		if vars.check("wordy"):
-			if len(item.txt) == len(alts.getLongest()) and len(item.txt) > 30:
+			if len(txt) == len(provenance.strip(alts.getLongest())) and len(txt) > 30:
 				trace("(Rewarding '%s' b/c @wordy and this is longest)" % item.txt)
 				dpStats["wordy"] += 1
 				dpQuality[pos] += 1
 		elif vars.check("succinct"):
-			if len(item.txt) == len(alts.getShortest()):
+			if len(txt) == len(provenance.strip(alts.getShortest())):
 				trace("(Rewarding '%s' b/c @succinct and this is shortest)" % item.txt)
 				dpStats["succinct"] += 1
 				dpQuality[pos] += 1
 
 		if vars.check("bigwords"):
-			wordLen = getAvgWordLen(item.txt)
+			wordLen = getAvgWordLen(txt)
 			if wordLen <= 2:
 				skipBiggest = True
 			elif wordLen > biggestWordLen:
@@ -82,7 +87,7 @@ def getDiscoursePreferredVersion(alts, vars):
 				biggestWordLen = wordLen
 
 		if vars.check("slang") or vars.check("formal"):
-			slanginess = findSlangWords(item.txt)
+			slanginess = findSlangWords(txt)
 			if slanginess > 0:
 				if vars.check("slang"):
 					trace("(Rewarding '%s' b/c @slang and %d informal words found." % (item.txt, slanginess))
@@ -94,7 +99,7 @@ def getDiscoursePreferredVersion(alts, vars):
 					dpQuality[pos] -= 1
 
 		if vars.check("alliteration") or vars.check("noalliteration"):
-			alliterations = findAlliteration(item.txt)
+			alliterations = findAlliteration(txt)
 			if alliterations > 0:
 				if vars.check("alliteration"):
 					trace("(Rewarding '%s' b/c @alliteration and %d instances found." % (item.txt, alliterations))
@@ -106,14 +111,14 @@ def getDiscoursePreferredVersion(alts, vars):
 					dpQuality[pos] -= alliterations
 
 		if vars.check("avoidme"):
-			mewords = findMeWords(item.txt)
+			mewords = findMeWords(txt)
 			if mewords > 0:
 				trace("(Penalizing '%s' b/c @avoidme and %d me words found." % (item.txt, mewords))
 				dpStats["avoidme"] += 1
 				dpQuality[pos] -= mewords
 
 		if vars.check("likesimile") or vars.check("dislikesimile"):
-			simileWords = findSimileWords(item.txt)
+			simileWords = findSimileWords(txt)
 			if simileWords > 0:
 				if vars.check("likesimile"):
 					trace("(Rewarding '%s' b/c @likesimile and %d simile words found." % (item.txt, simileWords))
@@ -126,14 +131,14 @@ def getDiscoursePreferredVersion(alts, vars):
 					dpQuality[pos] -= 2
 
 		if vars.check("avoiddialogue"):
-			mayHaveDialogue = isSomethingQuoted(item.txt)
+			mayHaveDialogue = isSomethingQuoted(txt)
 			if mayHaveDialogue:
 				trace("(Penalizing '%s' b/c @avoiddialogue and some was found." % item.txt)
 				dpStats["avoiddialogue"] += 1
 				dpQuality[pos] -= 1
 
 		if vars.check("depressive") or vars.check("optimist") or vars.check("subjective") or vars.check("objective"):
-			safetxt = unicode(item.txt, "utf-8").encode('ascii', 'replace')
+			safetxt = unicode(txt, "utf-8").encode('ascii', 'replace')
 			tb = TextBlob(safetxt)
 			polarity = tb.sentiment.polarity
 			subjectivity = tb.sentiment.subjectivity
@@ -0,0 +1,88 @@
+# coding=utf-8
+# Optional machine-readable log of a collapser.py run (--log=file): one JSON object per line for each thing that happens to a book (started, variables set, time spent per phase, files written, errors), so tools like docs/add_variables.py can read results without scraping the printed output. Does nothing unless start() was called.
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import profiler
+
+logFile = None
+lock = threading.Lock()
+book = {}
+
+
+def start(path):
+	global logFile
+	logFile = open(path, "a")
+
+def stop():
+	global logFile
+	with lock:
+		if logFile is not None:
+			logFile.close()
+			logFile = None
+
+def isLogging():
+	return logFile is not None
+
+def write(event, **fields):
+	if logFile is None:
+		return
+	fields["event"] = event
+	fields["time"] = round(time.time(), 3)
+	for key in ["seed", "generation", "strategy"]:
+		if key in book and key not in fields:
+			fields[key] = book[key]
+	with lock:
+		# Checked again under the lock, in case stop() closed the log meanwhile.
+		if logFile is None:
+			return
+		logFile.write(json.dumps(fields, sort_keys = True) + "\n")
+		logFile.flush()
+
+def bookStarted(renderParams, parseParams, prelim):
+	global book
+	book = {
+		"seed": renderParams.seed,
+		"generation": renderParams.generation,
+		"strategy": parseParams.chooseStrategy,
+		"timings": {},
+		"started": time.time()
+	}
+	profiler.bookStarted(renderParams.fileId, renderParams.seed, prelim)
+	write("book", fileId = str(renderParams.fileId), prelim = prelim, endMatter = parseParams.endMatter, setDefines = parseParams.setDefines)
+
+def bookFinished():
+	if "started" not in book:
+		return
+	timings = dict([(name, round(secs, 3)) for name, secs in book["timings"].items()])
+	write("bookDone", seconds = round(time.time() - book["started"], 3), timings = timings)
+
+def variables(varList):
+	write("variables", variables = sorted([v for v in varList if v != ""]))
+
+def output(outputFormat, path, seed = None):
+	if seed is None:
+		write("output", format = outputFormat, path = path)
+	else:
+		write("output", format = outputFormat, path = path, seed = seed)
+
+def error(message, seed = None):
+	if seed is None:
+		write("error", message = message)
+	else:
+		write("error", message = message, seed = seed)
+
+# Time a phase of the current book: with eventlog.phase("render"): ... The phase is also handed to the profiler, so book phases are only declared here.
+@contextmanager
+def phase(name):
+	started = time.time()
+	try:
+		with profiler.phase(name):
+			yield
+	finally:
+		if "timings" in book:
+			with lock:
+				book["timings"][name] = book["timings"].get(name, 0) + time.time() - started
@@ -0,0 +1,33 @@
+# Keeps source files in memory for the life of the process, so repeated collapses (many copies, end matter re-renders, pair candidates) don't keep re-reading the same manifest and chapters from disk. Entries are checked against each file's mtime and size, so an edited file is picked up on its next read. Worker processes forked after a preload() share the parent's copy.
+
+import os
+
+import fileio
+
+cache = {}
+
+
+def fileKey(path):
+	st = os.stat(path)
+	return (path, st.st_mtime, st.st_size)
+
+def cached(key, loader):
+	entry = cache.get(key[0])
+	if entry is not None and entry[0] == key:
+		return entry[1]
+	contents = loader()
+	cache[key[0]] = (key, contents)
+	return contents
+
+# Same as fileio.readInputFile.
+def readInputFile(path):
+	return cached(fileKey(path), lambda: fileio.readInputFile(path))
+
+# Same as fileio.loadManifestFromFileList: valid as long as none of the listed files have changed.
+def loadManifestFromFileList(inputFileDir, fileList):
+	keys = tuple([fileKey(inputFileDir + f) for f in fileList])
+	key = ("manifest:" + inputFileDir + ",".join(fileList), keys)
+	return cached(key, lambda: fileio.loadManifestFromFileList(inputFileDir, fileList))
+
+def clear():
+	cache.clear()
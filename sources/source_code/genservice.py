@@ -0,0 +1,244 @@
+#!/usr/bin/python
+# coding=utf-8
+
+# A long-running generation service. Orders go into a job queue (a SQLite database) as collapser.py command lines; a pool of worker processes, each with collapser, the renderers and the source files already loaded, takes them one at a time and records their status, output files and any error. Running an order then costs its collapse and render and nothing else, and several orders can run side by side.
+
+# Run from this directory, like collapser.py:
+#   python2.7 genservice.py --serve --workers=2
+#   python2.7 genservice.py --submit="--seed=58123 --output=ebookorder"
+#   python2.7 genservice.py --status=3
+#   python2.7 genservice.py --list
+
+import os
+import sys
+import time
+import json
+import shlex
+import getopt
+import sqlite3
+import traceback
+import multiprocessing
+
+import eventlog
+import collapser
+
+DEFAULT_DB = "work/jobs.sqlite"
+POLL_SECONDS = 1.0
+
+schema = """CREATE TABLE IF NOT EXISTS jobs (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	args TEXT NOT NULL,
+	status TEXT NOT NULL,
+	submitted REAL NOT NULL,
+	started REAL,
+	finished REAL,
+	worker INTEGER,
+	outputs TEXT,
+	error TEXT,
+	log TEXT
+)"""
+
+
+def showUsage():
+	print """Usage: python2.7 genservice.py options
+Arguments:
+  --help              Show this message
+  --db=x              Job queue database (default: %s)
+  --serve             Run the service until interrupted
+  --workers=N         With --serve, how many jobs to run at once (default 1)
+  --submit="args"     Queue a job: collapser.py arguments, as one string
+  --status=N          Show a job's status, output files and any error
+  --list              Show every job
+""" % DEFAULT_DB
+
+
+def main():
+	db = DEFAULT_DB
+	action = ""
+	workers = 1
+	jobArgs = ""
+	jobId = -1
+
+	opts, args = getopt.getopt(sys.argv[1:], "", ["help", "db=", "serve", "workers=", "submit=", "status=", "list"])
+	if len(args) > 0:
+		print "Unrecognized arguments: %s" % args
+		sys.exit()
+	for opt, arg in opts:
+		if opt == "--help":
+			showUsage()
+			sys.exit()
+		elif opt == "--db":
+			db = arg
+		elif opt == "--serve":
+			action = "serve"
+		elif opt == "--workers":
+			try:
+				workers = int(arg)
+				assert workers > 0
+			except:
+				print "Invalid --workers parameter '%s': must be an integer > 0" % arg
+				sys.exit()
+		elif opt == "--submit":
+			action = "submit"
+			jobArgs = arg
+		elif opt == "--status":
+			action = "status"
+			try:
+				jobId = int(arg)
+			except:
+				print "Invalid --status parameter '%s': not a job number." % arg
+				sys.exit()
+		elif opt == "--list":
+			action = "list"
+
+	if action == "serve":
+		serve(db, workers)
+	elif action == "submit":
+		print "Queued job %d" % submit(db, shlex.split(jobArgs))
+	elif action == "status":
+		job = getJob(db, jobId)
+		if job is None:
+			print "No job %d" % jobId
+		else:
+			print json.dumps(job, indent = 2, sort_keys = True)
+	elif action == "list":
+		for job in listJobs(db):
+			print "%4d  %-8s %s" % (job["id"], job["status"], " ".join(job["args"]))
+	else:
+		showUsage()
+
+
+# Queue
+
+def connect(db):
+	if os.path.dirname(db) != "" and not os.path.isdir(os.path.dirname(db)):
+		os.makedirs(os.path.dirname(db))
+	conn = sqlite3.connect(db, timeout = 30, isolation_level = None)
+	conn.row_factory = sqlite3.Row
+	conn.execute(schema)
+	return conn
+
+# Queue a job (a list of collapser.py arguments) and return its id. Anything that can write to the database can do this, e.g. the handler behind the variorum's order form.
+def submit(db, args):
+	for arg in args:
+		if arg.startswith("--log"):
+			print "Jobs can't set --log: the service keeps its own log for each job."
+			sys.exit()
+	conn = connect(db)
+	cur = conn.execute("INSERT INTO jobs (args, status, submitted) VALUES (?, 'queued', ?)", (json.dumps(unattended(args)), time.time()))
+	conn.close()
+	return cur.lastrowid
+
+# Workers have no terminal (stdin is /dev/null), so a job that stopped to ask for confirmation would fail; every job runs with --skipConfirm.
+def unattended(args):
+	if "--skipConfirm" in args:
+		return args
+	return args + ["--skipConfirm"]
+
+def jobFromRow(row):
+	job = dict(zip(row.keys(), tuple(row)))
+	job["args"] = json.loads(job["args"])
+	job["outputs"] = json.loads(job["outputs"]) if job["outputs"] else []
+	return job
+
+def getJob(db, jobId):
+	conn = connect(db)
+	row = conn.execute("SELECT * FROM jobs WHERE id = ?", (jobId,)).fetchone()
+	conn.close()
+	return jobFromRow(row) if row is not None else None
+
+def listJobs(db):
+	conn = connect(db)
+	jobs = [jobFromRow(row) for row in conn.execute("SELECT * FROM jobs ORDER BY id")]
+	conn.close()
+	return jobs
+
+# Take the oldest queued job, or return None.
+def claim(conn, workerId):
+	conn.execute("BEGIN IMMEDIATE")
+	row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+	if row is None:
+		conn.execute("COMMIT")
+		return None
+	conn.execute("UPDATE jobs SET status = 'running', started = ?, worker = ? WHERE id = ?", (time.time(), workerId, row["id"]))
+	conn.execute("COMMIT")
+	return jobFromRow(row)
+
+def finish(conn, jobId, status, outputs, error):
+	conn.execute("UPDATE jobs SET status = ?, finished = ?, outputs = ?, error = ? WHERE id = ?", (status, time.time(), json.dumps(outputs), error, jobId))
+
+
+# Service
+
+def serve(db, workers):
+	conn = connect(db)
+	# Jobs left running by a service that was stopped start over.
+	conn.execute("UPDATE jobs SET status = 'queued', started = NULL, worker = NULL WHERE status = 'running'")
+	conn.close()
+
+	# Load the default sources and the renderers once, before forking, so every worker starts with them.
+	collapser.preloadSources(["full-book-manifest.txt"], "chapters/", None)
+	collapser.preloadRenderers()
+
+	processes = [multiprocessing.Process(target = workerLoop, args = (db, workerId)) for workerId in range(workers)]
+	for process in processes:
+		process.start()
+	print "Generation service running with %d worker%s on %s" % (workers, "" if workers == 1 else "s", db)
+	try:
+		for process in processes:
+			process.join()
+	except KeyboardInterrupt:
+		for process in processes:
+			process.terminate()
+
+def workerLoop(db, workerId):
+	conn = connect(db)
+	try:
+		while True:
+			job = claim(conn, workerId)
+			if job is None:
+				time.sleep(POLL_SECONDS)
+				continue
+			status, outputs, error = runJob(job, conn)
+			finish(conn, job["id"], status, outputs, error)
+	except KeyboardInterrupt:
+		pass
+
+# Run one job's collapser.py arguments in this process, with its printed output going to work/job-<id>.txt and its events to work/job-<id>.jsonl. Returns (status, output files, error).
+def runJob(job, conn):
+	logPath = "%sjob-%d.txt" % (collapser.workDir, job["id"])
+	eventPath = "%sjob-%d.jsonl" % (collapser.workDir, job["id"])
+	conn.execute("UPDATE jobs SET log = ? WHERE id = ?", (logPath, job["id"]))
+	if os.path.exists(eventPath):
+		os.remove(eventPath)
+
+	savedStdout = sys.stdout
+	sys.stdout = open(logPath, "w")
+	error = None
+	try:
+		eventlog.start(eventPath)
+		# Jobs queued by something other than submit() may not have --skipConfirm yet.
+		collapser.main([arg.encode("utf-8") for arg in unattended(job["args"])])
+	except SystemExit:
+		# collapser.py exits on bad arguments and failed collapses; the reason is in the job's log.
+		error = "collapser.py exited early; see %s" % logPath
+	except Exception:
+		error = traceback.format_exc()
+		print error
+	finally:
+		eventlog.stop()
+		sys.stdout.close()
+		sys.stdout = savedStdout
+
+	outputs = []
+	for line in open(eventPath) if os.path.exists(eventPath) else []:
+		event = json.loads(line)
+		if event["event"] == "output" and event.get("path"):
+			outputs.append({"format": event["format"], "path": event["path"], "seed": event.get("seed")})
+		elif event["event"] == "error" and error is None:
+			error = event["message"]
+	return ("failed" if error is not None else "done"), outputs, error
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,145 @@
+# coding=utf-8
+# Searches for the globally longest or shortest combination of variable group options. The greedy pass in collapse.getDefinesForLongestShortest scores each group with every other variable turned off, which misses text gated on more than one group; here the book's length is modelled as a sum over variant sites, each of which only depends on the groups it references, so interacting groups can be searched together.
+
+import itertools
+import time
+
+import variables
+import variantsites
+
+# The most seconds to spend searching, unless --optimizeTime says otherwise. 0 keeps the greedy answer. This is only a cap: optimize() returns as soon as every component has been searched exhaustively or its local search stops improving, so a run only takes this long when the search really needs it.
+DEFAULT_TIME_BUDGET = 10
+
+# Components with at most this many combinations are searched exhaustively; bigger ones get a local search.
+EXHAUSTIVE_LIMIT = 5000
+
+
+class LengthModel:
+
+	def __init__(self, siteIndex, groups, params, seed):
+		# groups is a list of option lists, in the same format getDefinesForLongestShortest uses: a bare variable name sets that variable, "^name" leaves it unset.
+		self.groups = groups
+		self.params = params
+		self.seed = seed
+		self.cache = {}
+		self.renders = 0
+		groupForVar = {}
+		for groupPos, opts in enumerate(groups):
+			for opt in opts:
+				groupForVar[opt.lstrip("^").lower()] = groupPos
+		self.sites = []
+		self.sitesForGroup = [[] for g in groups]
+		for site in siteIndex.sites:
+			siteGroups = sorted(set([groupForVar[v] for v in site.variables if v in groupForVar]))
+			if len(siteGroups) == 0:
+				continue
+			self.sites.append((site, siteGroups))
+			for groupPos in siteGroups:
+				self.sitesForGroup[groupPos].append(len(self.sites) - 1)
+
+	def siteLength(self, sitePos, assignment):
+		site, siteGroups = self.sites[sitePos]
+		key = (sitePos, tuple([assignment[g] for g in siteGroups]))
+		if key not in self.cache:
+			setOptions([self.groups[g][assignment[g]] for g in siteGroups])
+			self.cache[key] = variantsites.renderedLength(site, self.params, self.seed)
+			self.renders += 1
+		return self.cache[key]
+
+	def lengthOfSites(self, sitePositions, assignment):
+		total = 0
+		for sitePos in sitePositions:
+			total += self.siteLength(sitePos, assignment)
+		return total
+
+	def totalLength(self, assignment):
+		return self.lengthOfSites(range(len(self.sites)), assignment)
+
+	# Groups that share a site have to be decided together; anything else can be decided independently.
+	def components(self):
+		parent = range(len(self.groups))
+		def find(x):
+			while parent[x] != x:
+				parent[x] = parent[parent[x]]
+				x = parent[x]
+			return x
+		for site, siteGroups in self.sites:
+			for groupPos in siteGroups[1:]:
+				parent[find(groupPos)] = find(siteGroups[0])
+		found = {}
+		for groupPos in range(len(self.groups)):
+			found.setdefault(find(groupPos), []).append(groupPos)
+		return [found[key] for key in sorted(found.keys())]
+
+	def sitesForComponent(self, component):
+		sitePositions = set()
+		for groupPos in component:
+			sitePositions.update(self.sitesForGroup[groupPos])
+		return sorted(sitePositions)
+
+
+# Turn every variable off, then turn on the given options.
+def setOptions(opts):
+	variables.setAllTo(False)
+	for opt in opts:
+		if len(opt) > 0 and opt[0] != "^":
+			variables.__v.variables[opt] = True
+
+
+# Return (assignment, isExact) where assignment is a list of option positions, one per group.
+def optimize(model, startAssignment, isShortest, timeBudget):
+	deadline = time.time() + timeBudget
+	assignment = list(startAssignment)
+	isExact = True
+
+	def isBetter(a, b):
+		return a < b if isShortest else a > b
+
+	for component in model.components():
+		sitePositions = model.sitesForComponent(component)
+		if len(sitePositions) == 0:
+			continue
+		combinations = 1
+		for groupPos in component:
+			combinations *= len(model.groups[groupPos])
+
+		if combinations <= EXHAUSTIVE_LIMIT:
+			bestLen = model.lengthOfSites(sitePositions, assignment)
+			bestOpts = [assignment[g] for g in component]
+			trial = list(assignment)
+			for opts in itertools.product(*[range(len(model.groups[g])) for g in component]):
+				if time.time() > deadline:
+					isExact = False
+					break
+				for pos, groupPos in enumerate(component):
+					trial[groupPos] = opts[pos]
+				thisLen = model.lengthOfSites(sitePositions, trial)
+				if isBetter(thisLen, bestLen):
+					bestLen = thisLen
+					bestOpts = list(opts)
+			for pos, groupPos in enumerate(component):
+				assignment[groupPos] = bestOpts[pos]
+		else:
+			isExact = False
+			improved = True
+			while improved and time.time() <= deadline:
+				improved = False
+				for groupPos in component:
+					groupSites = model.sitesForGroup[groupPos]
+					bestOpt = assignment[groupPos]
+					bestLen = model.lengthOfSites(groupSites, assignment)
+					for opt in range(len(model.groups[groupPos])):
+						assignment[groupPos] = opt
+						thisLen = model.lengthOfSites(groupSites, assignment)
+						if isBetter(thisLen, bestLen):
+							bestLen = thisLen
+							bestOpt = opt
+							improved = True
+					assignment[groupPos] = bestOpt
+
+		if time.time() > deadline:
+			isExact = False
+			print "Optimizer ran out of time (%ds); keeping the best assignment found so far." % timeBudget
+			break
+
+	return assignment, isExact
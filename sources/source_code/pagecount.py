@@ -0,0 +1,112 @@
+# coding=utf-8
+# Predicts how many pages a collapsed text will come to in the LaTeX (POD) render, so seeds that will be too long can be rejected before spending time on a full PDF build. check() is given the main body only, before any end matter is picked (the prelim collapse), so the estimate is of the body plus the fixed front and back pages. Only print PDFs are checked.
+
+import glob
+import os
+import re
+import sys
+import zipfile
+
+# Fitted against the 25 test books in sources/test_subcutaneans (run this file on that folder to recalibrate) as pages = bodyChars * CHARS_WEIGHT + endMatterChars * END_MATTER_WEIGHT + FIXED_PAGES, where the body is the first BODY_CHAPTERS chapters of each book's EPUB (the text a prelim collapse covers) and the end matter is the rest. Only the body term is used to estimate: check() is only given collapses without end matter (see collapser.checkPageEstimate). FIXED_PAGES covers the front matter and the end pages every book has. Worst error on those books was 2.2 pages, and 3.2 pages for each book predicted from a fit to the other 24.
+CHARS_WEIGHT = 0.000508
+END_MATTER_WEIGHT = 0.000177
+FIXED_PAGES = 41.0
+BODY_CHAPTERS = 22
+
+# The print book's page count: renderer_latex pads every book up to it (unless --skipPadding) and the end matter is picked to fill the space left, so a body that's already longer has nowhere to go. The test books above predate this template (ten of them are under 232 pages), so they calibrate the estimate but not the limit.
+PAGE_LIMIT = 232
+# Only reject books we're confident are over the limit, allowing for the worst error seen predicting a book it wasn't fitted to; the real check still happens in the renderer.
+SAFETY_MARGIN = 4
+
+
+class TooLongEstimateError(Exception):
+
+	def __init__(self, estimate):
+		self.estimate = estimate
+		self.strerror = "Book is predicted to be %d pages, more than the limit of %d." % (estimate, PAGE_LIMIT)
+
+
+formatCodeRegex = re.compile(r"\{(?:i|b|verse|verse_inline)/([^{}]*)\}")
+otherCodeRegex = re.compile(r"\{[^{}]*\}")
+whitespaceRegex = re.compile(r"\s+")
+
+# Reduce collapsed text to roughly what ends up on the page.
+def printedChars(txt):
+	txt = formatCodeRegex.sub(r"\1", txt)
+	txt = otherCodeRegex.sub(" ", txt)
+	txt = txt.replace("---", "-").replace("\\\\", " ")
+	txt = whitespaceRegex.sub(" ", txt)
+	return len(txt)
+
+def estimatePages(txt):
+	return int(round(printedChars(txt) * CHARS_WEIGHT + FIXED_PAGES))
+
+def isTooLong(estimate):
+	return estimate - SAFETY_MARGIN > PAGE_LIMIT
+
+# Raise TooLongEstimateError if the collapsed text is sure to be too long for print.
+def check(txt):
+	estimate = estimatePages(txt)
+	print "Estimated length: %d pages" % estimate
+	if isTooLong(estimate):
+		raise TooLongEstimateError(estimate)
+	return estimate
+
+
+# Calibration: fit CHARS_WEIGHT, END_MATTER_WEIGHT and FIXED_PAGES from past renders, each a folder with a matching .pdf and .epub.
+def pdfPageCount(path):
+	data = open(path, "rb").read()
+	counts = re.findall(r"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)", data)
+	return max([int(c) for c in counts])
+
+# Characters in the body and end matter chapters of an EPUB, as (body, endMatter).
+def epubChars(path):
+	body = []
+	endMatter = []
+	z = zipfile.ZipFile(path)
+	chapters = sorted([name for name in z.namelist() if name.startswith("EPUB/text/ch")])
+	for pos, name in enumerate(chapters):
+		txt = re.sub(r"<[^>]+>", " ", z.read(name))
+		if pos < BODY_CHAPTERS:
+			body.append(txt)
+		else:
+			endMatter.append(txt)
+	return len(whitespaceRegex.sub(" ", " ".join(body))), len(whitespaceRegex.sub(" ", " ".join(endMatter)))
+
+def calibrate(samples):
+	# Least squares fit of pages = weight * body + endMatterWeight * endMatter + fixed, from samples of (body, endMatter, pages).
+	n = float(len(samples))
+	means = [sum([s[i] for s in samples]) / n for i in range(3)]
+	def sumOfProducts(i, j):
+		return sum([(s[i] - means[i]) * (s[j] - means[j]) for s in samples])
+	det = sumOfProducts(0, 0) * sumOfProducts(1, 1) - sumOfProducts(0, 1) ** 2
+	weight = (sumOfProducts(0, 2) * sumOfProducts(1, 1) - sumOfProducts(1, 2) * sumOfProducts(0, 1)) / det
+	endMatterWeight = (sumOfProducts(1, 2) * sumOfProducts(0, 0) - sumOfProducts(0, 2) * sumOfProducts(0, 1)) / det
+	return weight, endMatterWeight, means[2] - weight * means[0] - endMatterWeight * means[1]
+
+def fitError(fit, sample):
+	weight, endMatterWeight, fixed = fit
+	return abs(sample[0] * weight + sample[1] * endMatterWeight + fixed - sample[2])
+
+def main():
+	if len(sys.argv) < 2:
+		print "Usage: python2.7 pagecount.py folder-of-past-renders"
+		sys.exit()
+	samples = []
+	for pdf in sorted(glob.glob(os.path.join(sys.argv[1], "*", "*.pdf"))):
+		epub = pdf[:-4] + ".epub"
+		if os.path.exists(epub):
+			body, endMatter = epubChars(epub)
+			samples.append((body, endMatter, pdfPageCount(pdf)))
+	if len(samples) < 4:
+		print "Need at least four pdf/epub pairs to calibrate."
+		sys.exit()
+	fit = calibrate(samples)
+	worst = max([fitError(fit, s) for s in samples])
+	# Each book predicted from a fit to all the others: a fairer guide to SAFETY_MARGIN.
+	heldOut = max([fitError(calibrate(samples[:pos] + samples[pos + 1:]), s) for pos, s in enumerate(samples)])
+	print "Calibrated from %d books: CHARS_WEIGHT = %f, END_MATTER_WEIGHT = %f, FIXED_PAGES = %.1f (worst error %.1f pages, %.1f held out)" % (len(samples), fit[0], fit[1], fit[2], worst, heldOut)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,164 @@
+# coding=utf-8
+# Optional profiling of a collapser.py run (--profile=file): wall and CPU time for each phase of each book (reading sources, lexing, handling definitions, stripping definitions, parsing, discourse scoring, rendering, zipping), written as one JSON report with totals and per-book averages over every book in the run (e.g. --times=N). With --profileMode=cprofile each phase also runs under cProfile and the report includes its hottest functions; with --profileMode=memory it records how much memory each phase allocated, where tracemalloc is available. Does nothing unless start() was called.
+
+# Phases can nest (discourse scoring happens during parsing), so each phase's time includes any phases inside it. CPU time is for the whole process, so it includes other threads rendering at the same time. Chapters collapsed in worker processes (--collapseWorkers) are only timed as a whole.
+
+import os
+import time
+import json
+import pstats
+import cProfile
+import threading
+from StringIO import StringIO
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+MODES = ["time", "cprofile", "memory"]
+CPROFILE_LINES = 25
+
+enabled = False
+mode = "time"
+books = []
+current = None
+outside = None
+profiles = {}
+activeProfile = None
+lock = threading.Lock()
+
+
+def reset():
+	global enabled, mode, books, current, outside, profiles, activeProfile
+	enabled = False
+	mode = "time"
+	books = []
+	current = None
+	outside = {"fileId": None, "phases": {}}
+	profiles = {}
+	activeProfile = None
+
+def start(profileMode = "time"):
+	global enabled, mode
+	if profileMode == "memory" and tracemalloc is None:
+		return False
+	reset()
+	enabled = True
+	mode = profileMode
+	if mode == "memory" and not tracemalloc.is_tracing():
+		tracemalloc.start()
+	return True
+
+def bookStarted(fileId, seed, prelim):
+	global current
+	if not enabled:
+		return
+	current = {"fileId": str(fileId), "seed": seed, "prelim": prelim, "phases": {}}
+	with lock:
+		books.append(current)
+
+# The book phases are being recorded against, for work carried on after the next book starts (like zipping).
+def currentBook():
+	return current
+
+def cpuTime():
+	t = os.times()
+	return t[0] + t[1]
+
+# Time a phase of the current book (or the given one): with profiler.phase("parse"): ...
+@contextmanager
+def phase(name, book = None):
+	global activeProfile
+	if not enabled:
+		yield
+		return
+	if book is None:
+		book = current if current is not None else outside
+	profile = None
+	if mode == "cprofile" and activeProfile is None and threading.current_thread().name == "MainThread":
+		# Only one profiler can be active at a time, so nested phases are counted in the outer one.
+		with lock:
+			profile = profiles.setdefault(name, cProfile.Profile())
+		activeProfile = profile
+		profile.enable()
+	memStart = tracemalloc.get_traced_memory()[0] if mode == "memory" else 0
+	wallStart = time.time()
+	cpuStart = cpuTime()
+	try:
+		yield
+	finally:
+		wall = time.time() - wallStart
+		cpu = cpuTime() - cpuStart
+		if profile is not None:
+			profile.disable()
+			activeProfile = None
+		with lock:
+			stats = book["phases"].setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+			stats["wall"] += wall
+			stats["cpu"] += cpu
+			stats["calls"] += 1
+			if mode == "memory":
+				memNow, peak = tracemalloc.get_traced_memory()
+				stats["memGrowth"] = stats.get("memGrowth", 0) + memNow - memStart
+				stats["memPeak"] = max(stats.get("memPeak", 0), peak)
+
+# Decorator version of phase(), for functions called from code we don't control (like the parser calling discourseVars).
+def timed(name):
+	def decorate(fn):
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return fn(*args, **kwargs)
+			with phase(name):
+				return fn(*args, **kwargs)
+		return wrapper
+	return decorate
+
+def addPhases(totals, phases):
+	for name, stats in phases.items():
+		total = totals.setdefault(name, {})
+		for key, value in stats.items():
+			if key == "memPeak":
+				total[key] = max(total.get(key, 0), value)
+			else:
+				total[key] = total.get(key, 0) + value
+
+def rounded(phases):
+	return dict([(name, dict([(key, round(value, 4) if isinstance(value, float) else value) for key, value in stats.items()])) for name, stats in phases.items()])
+
+def report():
+	bookTotals = {}
+	for book in books:
+		addPhases(bookTotals, book["phases"])
+	# A book's prelim render (before end matter is picked) and its final render are one book.
+	bookCount = len(set([(book["fileId"], book["seed"]) for book in books]))
+	perBook = {}
+	for name, stats in bookTotals.items():
+		perBook[name] = {"wall": stats["wall"] / bookCount, "cpu": stats["cpu"] / bookCount}
+	totals = {}
+	addPhases(totals, bookTotals)
+	addPhases(totals, outside["phases"])
+	result = {
+		"mode": mode,
+		"books": [dict(book, phases = rounded(book["phases"])) for book in books],
+		"outsideBooks": rounded(outside["phases"]),
+		"totals": rounded(totals),
+		"perBook": rounded(perBook)
+	}
+	if mode == "cprofile":
+		result["cprofile"] = {}
+		for name, profile in profiles.items():
+			out = StringIO()
+			pstats.Stats(profile, stream = out).sort_stats("cumulative").print_stats(CPROFILE_LINES)
+			result["cprofile"][name] = out.getvalue()
+	return result
+
+def write(path):
+	with open(path, "w") as f:
+		json.dump(report(), f, indent = 1, sort_keys = True)
+
+
+reset()
@@ -0,0 +1,203 @@
+# coding=utf-8
+# Optional provenance map for a collapse (--provenance): for each span of the collapsed text, which source file, control sequence ("site") and alternative it came from. Before lexing, every alternative of every control sequence is wrapped in invisible marker characters carrying its site and alternative number; after parsing, the markers are read back out of the rendered text and removed, leaving the text exactly as it would otherwise be plus a list of spans. Comparing two seeds is then a matter of comparing which alternative each site chose.
+
+# Markers are made of control characters that never appear in the manuscript and aren't letters or whitespace, so nothing that capitalizes or collapses whitespace touches them. An alternative's markers go just inside its leading and trailing whitespace, after any ~, 80>, ^ or @var> prefix. Alternatives with no text are left unmarked (so [alpha|] still means what it did): if one of those is chosen, or a single-alternative sequence prints nothing, the site simply doesn't appear in the spans.
+
+import re
+import json
+import hashlib
+
+import variantsites
+
+BEGIN = "\x01"
+ALT = "\x02"
+END = "\x03"
+CLOSE = "\x04"
+DIGITS = "".join([chr(0x10 + d) for d in range(10)])
+
+# Alternative numbers are always two digits, so every marked alternative of a site grows by the same amount and comparisons of their lengths are unaffected.
+ALT_WIDTH = 2
+# Codes for sites printed more than once start here, above any alternative number, and stay below 2 ** 63 so a choice vector always fits in 64-bit integers.
+MULTI_CODE_BASE = 10 ** ALT_WIDTH
+MULTI_CODE_RANGE = 2 ** 62
+
+markerRegex = re.compile(BEGIN + "([" + DIGITS + "]+)(?:" + ALT + "([" + DIGITS + "]{%d})" % ALT_WIDTH + CLOSE + "|" + END + ")")
+headerRegex = re.compile(r"^(?:DEFINE|MACRO|STICKY_MACRO|LABEL)\s")
+labelRegex = re.compile(r"^\*\w+\*")
+prefixRegex = re.compile(r"^(~)?(\d+>)?(\^)?(@[A-Za-z_][\w\-]*>)?")
+
+
+def encode(number, width = 0):
+	return "".join([DIGITS[int(d)] for d in str(number).zfill(width)])
+
+def decode(digits):
+	return int("".join([str(DIGITS.index(d)) for d in digits]))
+
+# Remove any markers from a string (e.g. an alternative being weighed by discourseVars).
+def strip(txt):
+	if txt.find(BEGIN) < 0:
+		return txt
+	return markerRegex.sub("", txt)
+
+
+class SourceMap:
+
+	def __init__(self):
+		self.files = []
+		self.sites = []   # [fileIndex, line, number of alternatives]
+		self.marked = {}
+
+	# Return text with every alternative of every control sequence wrapped in markers. Marking the same file again returns the same text, so a file can be used both for its definitions and as part of the selection.
+	def mark(self, text, fileName):
+		key = (fileName, text)
+		if key in self.marked:
+			return self.marked[key]
+		if fileName not in self.files:
+			self.files.append(fileName)
+		fileIndex = self.files.index(fileName)
+
+		# Find control sequences with comments blanked out, but copy the original text.
+		searchText = variantsites.blankComments(text)
+		out = []
+		pos = 0
+		for m in variantsites.ctrlSeqRegex.finditer(searchText):
+			if headerRegex.match(m.group(1)):
+				continue
+			bodyStart = m.start() + 1
+			out.append(text[pos:bodyStart])
+			line = text.count("\n", 0, m.start()) + 1
+			out.append(self.markSequence(text[bodyStart:m.end() - 1], searchText[bodyStart:m.end() - 1], fileIndex, line))
+			pos = m.end() - 1
+		out.append(text[pos:])
+		marked = "".join(out)
+		self.marked[key] = marked
+		return marked
+
+	def markSequence(self, body, searchBody, fileIndex, line):
+		siteId = len(self.sites)
+		site = encode(siteId)
+		out = []
+		label = labelRegex.match(body)
+		start = 0
+		if label:
+			out.append(body[:label.end()])
+			start = label.end()
+		alts = splitAlternatives(searchBody, start)
+		for num, (altStart, altEnd) in enumerate(alts):
+			if num > 0:
+				out.append("|")
+			alt = body[altStart:altEnd]
+			prefix = prefixRegex.match(alt).end()
+			content = alt[prefix:]
+			if content.strip() == "":
+				out.append(alt)
+				continue
+			lead = len(content) - len(content.lstrip())
+			trail = len(content.rstrip())
+			out.append(alt[:prefix] + content[:lead])
+			out.append(BEGIN + site + ALT + encode(num, ALT_WIDTH) + CLOSE)
+			out.append(content[lead:trail])
+			out.append(BEGIN + site + END)
+			out.append(content[trail:])
+		self.sites.append([fileIndex, line, len(alts)])
+		return "".join(out)
+
+	# Remove the markers from rendered text, returning the clean text and its Provenance.
+	def extract(self, txt):
+		out = []
+		spans = []
+		openSpans = []
+		pos = 0
+		cleanLen = 0
+		for m in markerRegex.finditer(txt):
+			out.append(txt[pos:m.start()])
+			cleanLen += m.start() - pos
+			pos = m.end()
+			siteId = decode(m.group(1))
+			if m.group(2) is not None:
+				openSpans.append([cleanLen, siteId, decode(m.group(2))])
+				continue
+			# Close the most recent span for this site; anything opened inside it and never closed ends here too.
+			while len(openSpans) > 0:
+				start, openSite, alt = openSpans.pop()
+				spans.append([start, cleanLen, openSite, alt])
+				if openSite == siteId:
+					break
+		out.append(txt[pos:])
+		cleanLen += len(txt) - pos
+		for start, siteId, alt in openSpans:
+			spans.append([start, cleanLen, siteId, alt])
+		spans.sort()
+		return "".join(out), Provenance(self, spans)
+
+
+class Provenance:
+
+	def __init__(self, sourceMap, spans):
+		self.sourceMap = sourceMap
+		self.spans = spans   # [start, end, siteId, alternative], by start
+
+	# This map followed by another, whose text was appended after offset characters of this one's.
+	def append(self, other, offset):
+		return Provenance(self.sourceMap, self.spans + [[s + offset, e + offset, site, alt] for s, e, site, alt in other.spans])
+
+	# Same as txt.replace(old, new), keeping the spans lined up with the new text.
+	def replace(self, txt, old, new):
+		delta = len(new) - len(old)
+		if delta == 0 or txt.find(old) < 0:
+			return txt.replace(old, new), self
+		spans = [list(span) for span in self.spans]
+		shift = 0
+		pos = txt.find(old)
+		while pos >= 0:
+			at = pos + shift
+			for span in spans:
+				if span[0] > at:
+					span[0] += delta
+				if span[1] > at:
+					span[1] += delta
+			shift += delta
+			pos = txt.find(old, pos + len(old))
+		return txt.replace(old, new), Provenance(self.sourceMap, spans)
+
+	# What each site chose, one integer per site in the source map: the alternative it printed, or -1 if it never printed anything. A site rendered more than once (say, inside a macro used in several places) gets occurrenceCode of every alternative it printed, in order, so a seed that only changes a later occurrence still counts as a change.
+	def choices(self):
+		occurrences = [[] for site in self.sourceMap.sites]
+		for start, end, siteId, alt in self.spans:
+			occurrences[siteId].append(alt)
+		return [occurrenceCode(alts) for alts in occurrences]
+
+	def toJson(self):
+		return json.dumps({
+			"files": self.sourceMap.files,
+			"sites": self.sourceMap.sites,
+			"spans": self.spans
+		}, separators = (",", ":"))
+
+
+# One integer for the alternatives a site printed, in order: -1 for none, the alternative itself for one, and for more a stable hash of the whole sequence, offset past MULTI_CODE_BASE so it can't be mistaken for a single alternative. Sites inside macros can print dozens of times, so the sequence is hashed rather than packed into a number that grows with it; the same sequence always gets the same code, whichever source map it came from.
+def occurrenceCode(alts):
+	if len(alts) == 0:
+		return -1
+	if len(alts) == 1:
+		return alts[0]
+	digest = hashlib.md5(",".join([str(alt) for alt in alts])).hexdigest()
+	return int(MULTI_CODE_BASE + int(digest[:16], 16) % MULTI_CODE_RANGE)
+
+
+# Start and end offsets of each |-separated alternative in a control sequence body, ignoring any | inside {braces}.
+def splitAlternatives(body, start):
+	alts = []
+	depth = 0
+	altStart = start
+	for pos in range(start, len(body)):
+		ch = body[pos]
+		if ch == "{":
+			depth += 1
+		elif ch == "}" and depth > 0:
+			depth -= 1
+		elif ch == "|" and depth == 0:
+			alts.append((altStart, pos))
+			altStart = pos + 1
+	alts.append((altStart, len(body)))
+	return alts
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# coding=utf-8
+
+# Compares a range of seeds by the choices they make rather than by their text. Each seed is collapsed (not rendered) with a provenance.SourceMap, giving one integer per variant site for what it chose there; similarity scores and per-chapter change counts come straight from those vectors, so no collapsed texts need to be diffed or kept around.
+
+import sys
+import getopt
+import json
+
+import fileio
+import filecache
+import quantparse
+import chooser
+import hasher
+import collapse
+import provenance
+import differ
+
+
+def showUsage():
+	print """Usage: python2.7 seedcompare.py options
+Arguments:
+  --help              Show this message
+  --input=x,y,z       Alternate file(s) or manifest file(s) to load
+                        (default: full-book-manifest.txt)
+  --seeds=x-y         Seeds to compare: a range, or a list (x,y,z)
+  --pair=x,y          Also report which chapters changed between these two seeds
+  --file=x            Write the comparison here as JSON (default: print a summary)
+  --verify            Also collapse each seed without provenance markers and
+                        check the text is the same as with them
+"""
+
+
+def main():
+	inputFiles = ["full-book-manifest.txt"]
+	inputFileDir = "chapters/"
+	seeds = []
+	pair = []
+	outputFile = ""
+	verify = False
+
+	opts, args = getopt.getopt(sys.argv[1:], "", ["help", "input=", "seeds=", "pair=", "file=", "verify"])
+	if len(args) > 0:
+		print "Unrecognized arguments: %s" % args
+		sys.exit()
+	for opt, arg in opts:
+		if opt == "--input":
+			inputFiles = arg.split(',')
+		elif opt == "--help":
+			showUsage()
+			sys.exit()
+		elif opt == "--seeds":
+			try:
+				seeds = parseSeeds(arg)
+			except:
+				print "Invalid --seeds parameter '%s': must be a range like 60001-60025 or a list of integers." % arg
+				sys.exit()
+		elif opt == "--pair":
+			try:
+				pair = [int(seed) for seed in arg.split(",")]
+			except:
+				pair = []
+			if len(pair) != 2:
+				print "Invalid --pair parameter '%s': must be two seeds like 60001,60002." % arg
+				sys.exit()
+		elif opt == "--file":
+			outputFile = arg
+		elif opt == "--verify":
+			verify = True
+
+	if len(seeds) < 2:
+		showUsage()
+		sys.exit()
+	for seed in pair:
+		if seed not in seeds:
+			seeds.append(seed)
+
+	sourceMap = provenance.SourceMap()
+	plainContents, fileList = readFiles(inputFiles, inputFileDir)
+	fileContents = [sourceMap.mark(text, fileList[pos]) for pos, text in enumerate(plainContents)]
+	params = newParseParams(hasher.hash(''.join(fileList)))
+	vectors = []
+	mismatches = []
+	for seed in seeds:
+		res = collapseSeed(seed, fileContents, params, sourceMap)
+		vectors.append(res.provenance.choices())
+		if verify and not verifyMarkers(seed, res.package, plainContents, params):
+			mismatches.append(seed)
+	comparison = compare(seeds, vectors, sourceMap, pair)
+
+	if outputFile == "":
+		printSummary(comparison)
+	else:
+		fileio.writeOutputFile(outputFile, json.dumps(comparison, indent = 1, sort_keys = True))
+		print "Wrote comparison of %d seeds to %s" % (len(seeds), outputFile)
+
+	if verify:
+		if len(mismatches) > 0:
+			print "\n*** WARNING: %d seed(s) collapsed differently with provenance markers: %s" % (len(mismatches), mismatches)
+			sys.exit(1)
+		print "\nVerified: all %d seeds collapse to the same text with and without provenance markers." % len(seeds)
+
+
+def parseSeeds(arg):
+	if arg.find("-") > 0:
+		first, last = arg.split("-")
+		return range(int(first), int(last) + 1)
+	return [int(seed) for seed in arg.split(",")]
+
+def newParseParams(fileSetKey):
+	params = quantparse.ParseParams(chooseStrategy = "random", setDefines = [], doConfirm = False, discourseVarChance = 80, onlyShow = [], endMatter = [])
+	params.fileSetKey = fileSetKey
+	return params
+
+# Every input file's contents, in order, and their names.
+def readFiles(inputFiles, inputFileDir):
+	fileContents = []
+	fileList = []
+	for iFile in inputFiles:
+		inputText = filecache.readInputFile(inputFileDir + iFile)
+		if inputText[:10] == "# MANIFEST":
+			names = fileio.getFilesFromManifest(inputText)
+			fileList.extend(names)
+			fileContents.extend(filecache.loadManifestFromFileList(inputFileDir, names))
+		else:
+			fileList.append(iFile)
+			fileContents.append(fileio.getFileId(iFile) + inputText)
+	return fileContents, fileList
+
+# Collapse the full text with this seed, the same way collapser.py does. With a sourceMap, the result's .provenance has the seed's choice vector.
+def collapseSeed(seed, fileContents, params, sourceMap = None):
+	chooser.setSeed(seed)
+	chooser.resetAllIters()
+	res = collapse.go(fileContents, ''.join(fileContents), params, sourceMap = sourceMap)
+	if not res.isValid:
+		print res
+		sys.exit()
+	return res
+
+# Marking the source mustn't change what a seed collapses to: collapse it again unmarked and check the text is the same as the marked collapse's once its markers are removed.
+def verifyMarkers(seed, markedText, plainContents, params):
+	plainText = collapseSeed(seed, plainContents, params).package
+	if plainText == markedText:
+		return True
+	differAt = 0
+	while differAt < min(len(plainText), len(markedText)) and plainText[differAt] == markedText[differAt]:
+		differAt += 1
+	print "*** Seed %d: the marked collapse differs from an unmarked one (first difference at char %d of %d)." % (seed, differAt, len(plainText))
+	return False
+
+def compare(seeds, vectors, sourceMap, pair):
+	matrix = differ.choiceSimilarityMatrix(vectors)
+	comparison = {
+		"seeds": seeds,
+		"files": sourceMap.files,
+		"sites": len(sourceMap.sites),
+		"similarity": [[round(float(score), 4) for score in row] for row in matrix]
+	}
+	least = None
+	for i in range(len(seeds)):
+		for j in range(i + 1, len(seeds)):
+			if least is None or matrix[i][j] < matrix[least[0]][least[1]]:
+				least = (i, j)
+	comparison["leastSimilar"] = describePair(seeds, vectors, sourceMap, matrix, least)
+	if len(pair) == 2:
+		comparison["pair"] = describePair(seeds, vectors, sourceMap, matrix, (seeds.index(pair[0]), seeds.index(pair[1])))
+	return comparison
+
+def describePair(seeds, vectors, sourceMap, matrix, pos):
+	i, j = pos
+	return {
+		"seeds": [seeds[i], seeds[j]],
+		"similarity": round(float(matrix[i][j]), 4),
+		"changedSites": len(differ.choiceDifferences(vectors[i], vectors[j])),
+		"changesByFile": differ.changesByFile(vectors[i], vectors[j], sourceMap.sites, sourceMap.files)
+	}
+
+def printSummary(comparison):
+	print "\nCompared %d seeds across %d variant sites." % (len(comparison["seeds"]), comparison["sites"])
+	for key in ["leastSimilar", "pair"]:
+		if key not in comparison:
+			continue
+		info = comparison[key]
+		print "\n%s and %s: similarity %.4f, %d sites changed" % (info["seeds"][0], info["seeds"][1], info["similarity"], info["changedSites"])
+		for name in comparison["files"]:
+			if name in info["changesByFile"]:
+				print "  %s: %d" % (name, info["changesByFile"][name])
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# coding=utf-8
+
+# Works out which variables a range of seeds will set, without collapsing or rendering any books. Only the DEFINE statements are lexed and resolved, in the same order and from the same random stream a real collapse uses, so the result matches the "vars:" line collapser.py prints for each seed.
+
+import sys
+import getopt
+import re
+import json
+import csv
+from StringIO import StringIO
+
+import fileio
+import filecache
+import quantlex
+import quantparse
+import chooser
+import variables
+
+defineRegex = re.compile(r"\[DEFINE\s[^\]]*\]")
+
+
+def showUsage():
+	print """Usage: python2.7 variableoracle.py options
+Arguments:
+  --help              Show this message
+  --input=x,y,z       Alternate file(s) or manifest file(s) to load
+                        (default: full-book-manifest.txt)
+  --seeds=x-y         Seeds to look up: a range, or a list (x,y,z)
+  --format=x          "json" (default) or "csv"
+  --file=x            Write the table here (default: print it)
+"""
+
+
+def main():
+	inputFiles = ["full-book-manifest.txt"]
+	inputFileDir = "chapters/"
+	seeds = []
+	outputFormat = "json"
+	outputFile = ""
+
+	opts, args = getopt.getopt(sys.argv[1:], "", ["help", "input=", "seeds=", "format=", "file="])
+	if len(args) > 0:
+		print "Unrecognized arguments: %s" % args
+		sys.exit()
+	for opt, arg in opts:
+		if opt == "--input":
+			inputFiles = arg.split(',')
+		elif opt == "--help":
+			showUsage()
+			sys.exit()
+		elif opt == "--seeds":
+			try:
+				seeds = parseSeeds(arg)
+			except:
+				print "Invalid --seeds parameter '%s': must be a range like 60001-60025 or a list of integers." % arg
+				sys.exit()
+		elif opt == "--format":
+			if arg not in ["json", "csv"]:
+				print "Invalid --format parameter '%s': must be json or csv." % arg
+				sys.exit()
+			outputFormat = arg
+		elif opt == "--file":
+			outputFile = arg
+
+	if len(seeds) == 0:
+		showUsage()
+		sys.exit()
+
+	tokens = lexDefines(inputFiles, inputFileDir)
+	seedVars = getVariablesForSeeds(seeds, tokens)
+
+	if outputFormat == "json":
+		output = json.dumps(seedVars, indent = 2, sort_keys = True)
+	else:
+		output = toCsv(seedVars)
+	if outputFile == "":
+		print output
+	else:
+		fileio.writeOutputFile(outputFile, output)
+		print "Wrote variables for %d seeds to %s" % (len(seedVars), outputFile)
+
+
+def parseSeeds(arg):
+	if arg.find("-") > 0:
+		first, last = arg.split("-")
+		return range(int(first), int(last) + 1)
+	return [int(seed) for seed in arg.split(",")]
+
+def newParseParams():
+	return quantparse.ParseParams(chooseStrategy = "random", setDefines = [], doConfirm = False, discourseVarChance = 80, onlyShow = [], endMatter = [])
+
+# Pull out just the DEFINE statements from every input file, in order, and lex them.
+def lexDefines(inputFiles, inputFileDir):
+	defines = []
+	for iFile in inputFiles:
+		for text in readFiles(iFile, inputFileDir):
+			for line in text.split("\n"):
+				if line[:1] != "#":
+					defines += defineRegex.findall(line)
+	result = quantlex.lex("\n".join(defines))
+	if not result.isValid:
+		print result
+		sys.exit()
+	return result.package
+
+def readFiles(inputFile, inputFileDir):
+	inputText = filecache.readInputFile(inputFileDir + inputFile)
+	if inputText[:10] == "# MANIFEST":
+		return filecache.loadManifestFromFileList(inputFileDir, fileio.getFilesFromManifest(inputText))
+	return [inputText]
+
+def getVariablesForSeeds(seeds, tokens):
+	params = newParseParams()
+	seedVars = {}
+	for seed in seeds:
+		chooser.setSeed(seed)
+		variables.reset()
+		variables.handleDefs(list(tokens), params)
+		seedVars[str(seed)] = sorted([v for v in variables.showVars() if v != ""])
+	return seedVars
+
+# One row per seed, one column per variable (1 if set).
+def toCsv(seedVars):
+	allVars = set()
+	for varList in seedVars.values():
+		allVars.update(varList)
+	allVars = sorted(allVars)
+	rows = []
+	for seed in sorted(seedVars.keys(), key = int):
+		setVars = set(seedVars[seed])
+		rows.append([seed] + [1 if v in setVars else 0 for v in allVars])
+	out = StringIO()
+	writer = csv.writer(out, lineterminator = "\n")
+	writer.writerow(["seed"] + allVars)
+	writer.writerows(rows)
+	return out.getvalue()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,143 @@
+# coding=utf-8
+# Finds the "variant sites" in a .quant source text: the control sequences and macro invocations whose output can change depending on which variables are set. Used to measure the effect of a variable locally (by re-rendering only the sites it touches) rather than re-rendering the whole book.
+
+import re
+
+import quantlex
+import quantparse
+import chooser
+
+
+ctrlSeqRegex = re.compile(r"\[([^\[\]]*)\]")
+braceRegex = re.compile(r"\{([^{}]*)\}")
+dollarMacroRegex = re.compile(r"\$([A-Za-z_][\w\-]*)")
+variableRegex = re.compile(r"@([A-Za-z_][\w\-]*)")
+macroHeaderRegex = re.compile(r"^(?:STICKY_MACRO|MACRO)\s+(.+)$")
+
+
+class Site:
+
+	def __init__(self, id, text, chunk, start):
+		self.id = id
+		self.text = text
+		self.chunk = chunk
+		self.start = start
+		self.variables = set()
+
+	def __repr__(self):
+		return "Site %d @%d:%d %s: '%s'" % (self.id, self.chunk, self.start, sorted(self.variables), self.text[:40])
+
+
+class SiteIndex:
+
+	# texts is the list of loaded files; a site's chunk is the position of the file it came from, and its start is the offset within that file.
+	def __init__(self, texts):
+		self.sites = []
+		self.macroBodies = {}
+		self.macroVariables = {}
+		self.sitesByVariable = {}
+		for chunk, text in enumerate(texts):
+			self.findSites(chunk, blankComments(text))
+		self.resolveVariables()
+
+	def findSites(self, chunk, text):
+		# Nesting is not allowed, so every [ ... ] is a complete control sequence. Macro invocations outside of control sequences are candidate sites too.
+		candidates = []
+		pos = 0
+		pendingMacro = None
+		for m in ctrlSeqRegex.finditer(text):
+			candidates += findBraceSites(text, pos, m.start())
+			pos = m.end()
+			body = m.group(1)
+			if pendingMacro is not None:
+				name, headerEnd = pendingMacro
+				pendingMacro = None
+				if text[headerEnd:m.start()].strip() == "":
+					self.macroBodies[name] = m.group(0)
+					continue
+			header = macroHeaderRegex.match(body)
+			if header:
+				pendingMacro = (header.group(1).strip(), m.end())
+				continue
+			if body.startswith("DEFINE ") or body.startswith("LABEL "):
+				continue
+			candidates.append((m.start(), m.group(0)))
+		candidates += findBraceSites(text, pos, len(text))
+		for start, siteText in candidates:
+			self.sites.append(Site(len(self.sites), siteText, chunk, start))
+
+	def resolveVariables(self):
+		for name in self.macroBodies:
+			self.variablesForMacro(name, [])
+		keptSites = []
+		for site in self.sites:
+			site.variables = self.variablesForText(site.text, [])
+			if len(site.variables) == 0:
+				continue
+			site.id = len(keptSites)
+			keptSites.append(site)
+			for var in site.variables:
+				self.sitesByVariable.setdefault(var, []).append(site)
+		self.sites = keptSites
+
+	def variablesForText(self, text, seen):
+		found = set([v.lower() for v in variableRegex.findall(text)])
+		for name in macroReferences(text):
+			if name in self.macroBodies:
+				found |= self.variablesForMacro(name, seen)
+		return found
+
+	def variablesForMacro(self, name, seen):
+		if name in self.macroVariables:
+			return self.macroVariables[name]
+		if name in seen:
+			return set()
+		found = self.variablesForText(self.macroBodies[name], seen + [name])
+		self.macroVariables[name] = found
+		return found
+
+	# Return the sites whose output might change if any of the given variables did.
+	def sitesAffectedBy(self, varNames):
+		found = {}
+		for var in varNames:
+			for site in self.sitesByVariable.get(var.lower(), []):
+				found[site.id] = site
+		return [found[key] for key in sorted(found.keys())]
+
+
+# Replace comment lines with spaces, so offsets still line up with the original text.
+def blankComments(text):
+	lines = text.split("\n")
+	for pos, line in enumerate(lines):
+		if line[:1] == "#":
+			lines[pos] = " " * len(line)
+	return "\n".join(lines)
+
+def findBraceSites(text, start, end):
+	sites = []
+	segment = text[start:end]
+	for m in braceRegex.finditer(segment):
+		sites.append((start + m.start(), m.group(0)))
+	for m in dollarMacroRegex.finditer(braceRegex.sub(lambda b: " " * len(b.group(0)), segment)):
+		sites.append((start + m.start(), m.group(0)))
+	return sorted(sites)
+
+def macroReferences(text):
+	names = [b.strip() for b in braceRegex.findall(text) if b.find("/") < 0]
+	names += dollarMacroRegex.findall(text)
+	return names
+
+# Render a single site on its own with the current variable state, returning the rendered length. Given a seed, the random stream is reset to it first, so a site's random choices don't depend on which sites were measured before it.
+def renderedLength(site, params, seed = None):
+	if seed is not None:
+		chooser.setSeed(seed)
+	result = quantlex.lex(site.text)
+	if not result.isValid:
+		return len(site.text)
+	return len(quantparse.handleParsing(result.package, params))
+
+def totalRenderedLength(sites, params, seed = None):
+	total = 0
+	for site in sites:
+		total += renderedLength(site, params, seed)
+	return total